@@ -0,0 +1,192 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from asyncio import AbstractEventLoop, Future, TimerHandle, get_running_loop
+from collections import deque
+from datetime import datetime
+from os import path, stat
+from time import monotonic
+from typing import Deque, Optional, Tuple
+
+from config import Config
+from defs import Mem, BANDWIDTH_QUANTUM, BANDWIDTH_BURST_SECONDS, BANDWIDTH_FILE_CHECK_INTERVAL, DOWNLOAD_STATUS_CHECK_TIMER
+from logger import Log
+
+__all__ = ('BandwidthShaper',)
+
+
+class ShapedRequest:
+    """Amount of bytes a transfer is waiting for"""
+    def __init__(self, remaining: int, fut: Future) -> None:
+        self.remaining = remaining
+        self.fut = fut
+
+
+class BandwidthShaper:
+    """
+    Global download bandwidth ceiling. Transfers report received data and are paused while they exceed their share.\n
+    Waiting transfers are served round-robin in quanta so each one gets a fair share, priority transfers (small files)
+    are served before everything else. Current limit comes from (in order): bandwidth file, bandwidth schedule, bandwidth.
+    Zero limit means no limit\n
+    **Static**
+    """
+    _tokens = 0.0
+    _last_refill = 0.0
+    _rate = 0
+    _queues = (deque(), deque())  # type: Tuple[Deque[ShapedRequest], Deque[ShapedRequest]]
+    _timer = None  # type: Optional[TimerHandle]
+    _loop = None  # type: Optional[AbstractEventLoop]
+    _file_rate = None  # type: Optional[int]
+    _file_mtime = 0.0
+    _file_checked = -BANDWIDTH_FILE_CHECK_INTERVAL
+    _last_wait = -1e9
+    waits = 0
+    bytes_shaped = 0
+
+    @staticmethod
+    def _bind(loop: AbstractEventLoop) -> None:
+        if BandwidthShaper._loop is not loop:
+            BandwidthShaper._loop = loop
+            for queue in BandwidthShaper._queues:
+                queue.clear()
+            BandwidthShaper._timer = None
+            BandwidthShaper._tokens = 0.0
+            BandwidthShaper._last_refill = loop.time()
+
+    @staticmethod
+    def _read_bandwidth_file() -> Optional[int]:
+        now = monotonic()
+        if now - BandwidthShaper._file_checked < BANDWIDTH_FILE_CHECK_INTERVAL:
+            return BandwidthShaper._file_rate
+        BandwidthShaper._file_checked = now
+        if not path.isfile(Config.bandwidth_file):
+            BandwidthShaper._file_rate = None
+            return None
+        mtime = stat(Config.bandwidth_file).st_mtime
+        if mtime != BandwidthShaper._file_mtime:
+            BandwidthShaper._file_mtime = mtime
+            try:
+                with open(Config.bandwidth_file, 'rt') as bfile:
+                    BandwidthShaper._file_rate = max(0, int(bfile.read().strip()))
+                Log.info(f'Bandwidth limit is set to {BandwidthShaper._file_rate:d} KB/s by bandwidth file')
+            except Exception:
+                Log.error(f'Error: invalid bandwidth file \'{Config.bandwidth_file}\' content, ignored')
+                BandwidthShaper._file_rate = None
+        return BandwidthShaper._file_rate
+
+    @staticmethod
+    def current_limit() -> int:
+        """Returns current bandwidth limit in KB/s"""
+        if Config.bandwidth_file:
+            file_rate = BandwidthShaper._read_bandwidth_file()
+            if file_rate is not None:
+                return file_rate
+        if Config.bandwidth_schedule:
+            now = datetime.now()
+            minute = now.hour * 60 + now.minute
+            for begin, end, rate in Config.bandwidth_schedule:  # type: int, int, int
+                if (begin <= minute < end) if begin <= end else (minute >= begin or minute < end):
+                    return rate
+        return Config.bandwidth
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(Config.bandwidth or Config.bandwidth_schedule or Config.bandwidth_file)
+
+    @staticmethod
+    def limiting() -> bool:
+        """Returns True if transfers had to wait for their share since last download status check"""
+        return monotonic() - BandwidthShaper._last_wait < DOWNLOAD_STATUS_CHECK_TIMER
+
+    @staticmethod
+    def _refill() -> None:
+        now = BandwidthShaper._loop.time()
+        rate = BandwidthShaper._rate = BandwidthShaper.current_limit() * Mem.KB
+        capacity = max(float(BANDWIDTH_QUANTUM), rate * BANDWIDTH_BURST_SECONDS)
+        BandwidthShaper._tokens = min(capacity, BandwidthShaper._tokens + (now - BandwidthShaper._last_refill) * rate)
+        BandwidthShaper._last_refill = now
+
+    @staticmethod
+    def _schedule(need: float) -> None:
+        if BandwidthShaper._timer is not None:
+            return
+        rate = BandwidthShaper._rate
+        delay = max(0.001, (need - BandwidthShaper._tokens) / rate) if rate > 0 else 0.0
+        BandwidthShaper._timer = BandwidthShaper._loop.call_later(min(delay, float(BANDWIDTH_FILE_CHECK_INTERVAL)), BandwidthShaper._wake)
+
+    @staticmethod
+    def _wake() -> None:
+        BandwidthShaper._timer = None
+        BandwidthShaper._refill()
+        unlimited = BandwidthShaper._rate <= 0
+        for queue in BandwidthShaper._queues:
+            while queue:
+                req = queue[0]
+                if req.fut.done():  # cancelled while waiting
+                    queue.popleft()
+                    continue
+                grant = req.remaining if unlimited else min(req.remaining, BANDWIDTH_QUANTUM)
+                if not unlimited and BandwidthShaper._tokens < grant:
+                    BandwidthShaper._schedule(grant)
+                    return
+                BandwidthShaper._tokens -= 0 if unlimited else grant
+                req.remaining -= grant
+                queue.popleft()
+                if req.remaining > 0:
+                    queue.append(req)  # round-robin: the rest is granted after others get their quantum
+                else:
+                    req.fut.set_result(None)
+
+    @staticmethod
+    async def consume(size: int, priority=False) -> None:
+        """Accounts **size** bytes received by a transfer, pauses it until its share allows it"""
+        if not BandwidthShaper.enabled() or size <= 0:
+            return
+        BandwidthShaper._bind(get_running_loop())
+        BandwidthShaper._refill()
+        BandwidthShaper.bytes_shaped += size
+        queues = BandwidthShaper._queues
+        if BandwidthShaper._rate <= 0:
+            return
+        if not any(queues) and BandwidthShaper._tokens >= size:
+            BandwidthShaper._tokens -= size
+            return
+        BandwidthShaper.waits += 1
+        BandwidthShaper._last_wait = monotonic()
+        fut = BandwidthShaper._loop.create_future()
+        queues[0 if priority else 1].append(ShapedRequest(size, fut))
+        BandwidthShaper._schedule(min(size, BANDWIDTH_QUANTUM))
+        try:
+            await fut
+        finally:
+            BandwidthShaper._last_wait = monotonic()
+
+    @staticmethod
+    def report() -> str:
+        limit = BandwidthShaper.current_limit()
+        waiting = sum(len(queue) for queue in BandwidthShaper._queues)
+        return (f'limit: {f"{limit:d} KB/s" if limit else "none"}, shaped {BandwidthShaper.bytes_shaped / Mem.MB:.2f} Mb,'
+                f' waits: {BandwidthShaper.waits:d}, waiting now: {waiting:d} (priority: {len(BandwidthShaper._queues[0]):d})')
+
+    @staticmethod
+    def reset() -> None:
+        BandwidthShaper._loop = None
+        BandwidthShaper._timer = None
+        BandwidthShaper._rate = 0
+        BandwidthShaper._file_rate = None
+        BandwidthShaper._file_mtime = 0.0
+        BandwidthShaper._file_checked = -BANDWIDTH_FILE_CHECK_INTERVAL
+        BandwidthShaper._last_wait = -1e9
+        BandwidthShaper.waits = BandwidthShaper.bytes_shaped = 0
+        for queue in BandwidthShaper._queues:
+            queue.clear()
+
+#
+#
+#########################################
@@ -11,23 +11,37 @@ from os import path
 from typing import List, Sequence, Tuple
 
 from defs import (
-    UTF8, APP_NAME, APP_VERSION, ACTION_STORE_TRUE, HELP_ARG_PATH, HELP_ARG_SEARCH_STR, HELP_ARG_PROXY, HELP_ARG_BEGIN_STOP_ID,
+    UTF8, APP_NAME, APP_VERSION, ACTION_STORE_TRUE, ACTION_APPEND, HELP_ARG_PATH, HELP_ARG_SEARCH_STR, HELP_ARG_PROXY, HELP_ARG_PROXY_FILE,
+    HELP_ARG_BEGIN_STOP_ID, HELP_ARG_PAGE_PREFETCH, PAGE_PREFETCH_DEFAULT, HELP_ARG_PAGE_WORKERS, PAGE_WORKERS_DEFAULT, HELP_ARG_SOURCE,
+    HELP_ARG_STREAM, HELP_ARG_SEEN_IDS,
     HELP_ARG_GET_MAXID, HELP_ARG_EXTRA_TAGS, HELP_ARG_UTPOLICY, UNTAGGED_POLICIES, DOWNLOAD_POLICY_DEFAULT, DOWNLOAD_MODES,
     DOWNLOAD_MODE_DEFAULT, NAMING_FLAGS_DEFAULT, LOGGING_FLAGS_DEFAULT, HELP_ARG_DMMODE, HELP_ARG_DWN_SCENARIO, HELP_ARG_MINRATING,
     HELP_ARG_MINSCORE, HELP_ARG_CMDFILE, HELP_ARG_NAMING, HELP_ARG_LOGGING, HELP_ARG_IDSEQUENCE, HELP_ARG_CONTINUE, HELP_ARG_UNFINISH,
     HELP_ARG_DUMP_INFO, HELP_ARG_TIMEOUT, HELP_ARG_UPLOADER, HELP_ARG_VERSION, HELP_ARG_SESSION_ID, SEARCH_RULES, SEARCH_RULE_DEFAULT,
     QUALITIES, DEFAULT_QUALITY, HELP_ARG_QUALITY, HELP_ARG_PLAYLIST, HELP_ARG_SEARCH_ACT, HELP_ARG_SEARCH_RULE, HELP_ARG_MODEL,
     HELP_ARG_THROTTLE, HELP_ARG_THROTTLE_AUTO, HELP_ARG_STORE_CONTINUE_CMDFILE, HELP_ARG_SKIP_EMPTY_LISTS, HELP_ARG_LOOKAHEAD,
+    HELP_ARG_REQUEST_RATE, HELP_ARG_REQUEST_BURST, HELP_ARG_PACING, CONNECT_REQUEST_RATE_DEFAULT, CONNECT_REQUEST_BURST_DEFAULT,
+    HELP_ARG_CACHE, HELP_ARG_CACHE_TTL_PAGES, HELP_ARG_CACHE_TTL_VIDEOS, HELP_ARG_CACHE_SIZE, CACHE_TTL_PAGES_DEFAULT,
+    CACHE_TTL_VIDEOS_DEFAULT, CACHE_SIZE_DEFAULT, HELP_ARG_PARSER_MODE, HELP_ARG_PARSER_WORKERS, PARSER_MODES, PARSER_MODE_DEFAULT,
+    PARSER_WORKERS_DEFAULT, HELP_ARG_CONN_LIMIT, HELP_ARG_CONN_LIMIT_PER_HOST, HELP_ARG_DNS_TTL, HELP_ARG_KEEPALIVE,
+    HELP_ARG_SOCKET_BUFFERS, CONNECTOR_LIMIT_DEFAULT, CONNECTOR_LIMIT_PER_HOST_DEFAULT, CONNECTOR_DNS_TTL_DEFAULT,
+    CONNECTOR_KEEPALIVE_DEFAULT, SOCKET_BUFFER_DEFAULT, HELP_ARG_RECORD, HELP_ARG_REPLAY, HELP_ARG_REPLAY_LATENCY,
+    HELP_ARG_REPLAY_BANDWIDTH, REPLAY_LATENCY_DEFAULT, REPLAY_BANDWIDTH_DEFAULT, HELP_ARG_SEGMENTS, HELP_ARG_SEGMENT_THRESHOLD,
+    SEGMENTS_DEFAULT, SEGMENT_THRESHOLD_DEFAULT, HELP_ARG_WRITE_BUFFER, HELP_ARG_WRITER_WORKERS, WRITE_BUFFER_DEFAULT,
+    WRITER_WORKERS_DEFAULT, HELP_ARG_PREALLOCATE, HELP_ARG_DROP_CACHE, HELP_ARG_FSYNC, HELP_ARG_BANDWIDTH, HELP_ARG_BANDWIDTH_SCHEDULE,
+    HELP_ARG_BANDWIDTH_FILE, BANDWIDTH_DEFAULT, HELP_ARG_JOURNAL, HELP_ARG_MANIFEST, HELP_ARG_VERIFY_PATH, HELP_ARG_VERIFY_WORKERS,
+    HELP_ARG_QUEUE_POLICY, HELP_ARG_SIZE_PROBE, QUEUE_POLICIES, QUEUE_POLICY_DEFAULT, HELP_ARG_MIN_FREE_SPACE, MIN_FREE_SPACE_DEFAULT,
 )
 from logger import Log
 from scenario import DownloadScenario
-from tagger import valid_extra_tag, valid_playlist_name, valid_playlist_id, valid_tags, valid_artists, valid_categories
+from tagger import valid_extra_tag, valid_playlist_name, valid_playlist_id, valid_tags, valid_artists, valid_categories, valid_page_source
 from validators import (
-    valid_int, positive_nonzero_int, valid_rating, valid_path, valid_filepath_abs, valid_search_string, valid_proxy, naming_flags,
-    log_level, valid_session_id,
+    valid_int, positive_nonzero_int, positive_nonzero_float, valid_rating, valid_path, valid_filepath_abs, valid_search_string, valid_proxy,
+    naming_flags, log_level, valid_session_id, valid_pacing, positive_int, valid_socket_buffers, valid_proxy_file,
+    valid_filepath_new, valid_bandwidth_schedule,
 )
 
-__all__ = ('prepare_arglist', 'HelpPrintExitException')
+__all__ = ('prepare_arglist', 'prepare_arglist_verify', 'HelpPrintExitException')
 
 UTP_DEFAULT = DOWNLOAD_POLICY_DEFAULT
 """'nofilters'"""
@@ -128,10 +142,64 @@ def add_common_args(parser_or_group: ArgumentParser) -> None:
     parser_or_group.add_argument('-minrating', '--minimum-rating', metavar='#rating', default=0, help=HELP_ARG_MINRATING, type=valid_rating)
     parser_or_group.add_argument('-minscore', '--minimum-score', metavar='#score', default=None, help=HELP_ARG_MINSCORE, type=valid_int)
     parser_or_group.add_argument('-utp', '--untagged-policy', default=UTP_DEFAULT, help=HELP_ARG_UTPOLICY, choices=UNTAGGED_POLICIES)
-    parser_or_group.add_argument('-proxy', metavar='#type://a.d.d.r:port', default=None, help=HELP_ARG_PROXY, type=valid_proxy)
+    parser_or_group.add_argument('-proxy', metavar='#type://a.d.d.r:port', default=None, help=HELP_ARG_PROXY, type=valid_proxy,
+                                 action=ACTION_APPEND)
+    parser_or_group.add_argument('--proxy-file', metavar='#filepath', default=None, help=HELP_ARG_PROXY_FILE, type=valid_proxy_file)
     parser_or_group.add_argument('-timeout', metavar='#seconds', default=0, help=HELP_ARG_TIMEOUT, type=positive_nonzero_int)
+    parser_or_group.add_argument('-rate', '--request-rate', metavar='#rps', default=CONNECT_REQUEST_RATE_DEFAULT,
+                                 help=HELP_ARG_REQUEST_RATE, type=positive_nonzero_float)
+    parser_or_group.add_argument('-burst', '--request-burst', metavar='#number', default=CONNECT_REQUEST_BURST_DEFAULT,
+                                 help=HELP_ARG_REQUEST_BURST, type=positive_nonzero_int)
+    parser_or_group.add_argument('--pacing', metavar='#class:rate:burst:limit[,...]', default=None, help=HELP_ARG_PACING, type=valid_pacing)
+    parser_or_group.add_argument('--conn-limit', metavar='#number', default=CONNECTOR_LIMIT_DEFAULT, help=HELP_ARG_CONN_LIMIT,
+                                 type=positive_int)
+    parser_or_group.add_argument('--conn-limit-per-host', metavar='#number', default=CONNECTOR_LIMIT_PER_HOST_DEFAULT,
+                                 help=HELP_ARG_CONN_LIMIT_PER_HOST, type=positive_int)
+    parser_or_group.add_argument('--dns-ttl', metavar='#seconds', default=CONNECTOR_DNS_TTL_DEFAULT, help=HELP_ARG_DNS_TTL,
+                                 type=positive_int)
+    parser_or_group.add_argument('--keepalive', metavar='#seconds', default=CONNECTOR_KEEPALIVE_DEFAULT, help=HELP_ARG_KEEPALIVE,
+                                 type=positive_int)
+    parser_or_group.add_argument('--socket-buffers', metavar='#KB[:KB]', default=(SOCKET_BUFFER_DEFAULT, SOCKET_BUFFER_DEFAULT),
+                                 help=HELP_ARG_SOCKET_BUFFERS, type=valid_socket_buffers)
+    parser_or_group.add_argument('--record', metavar='#folder', default=None, help=HELP_ARG_RECORD, type=valid_path)
+    parser_or_group.add_argument('--replay', metavar='#folder', default=None, help=HELP_ARG_REPLAY, type=valid_path)
+    parser_or_group.add_argument('--replay-latency', metavar='#ms', default=REPLAY_LATENCY_DEFAULT, help=HELP_ARG_REPLAY_LATENCY,
+                                 type=positive_int)
+    parser_or_group.add_argument('--replay-bandwidth', metavar='#KB/s', default=REPLAY_BANDWIDTH_DEFAULT, help=HELP_ARG_REPLAY_BANDWIDTH,
+                                 type=positive_int)
+    parser_or_group.add_argument('-cache', action=ACTION_STORE_TRUE, help=HELP_ARG_CACHE)
+    parser_or_group.add_argument('--cache-ttl-pages', metavar='#minutes', default=CACHE_TTL_PAGES_DEFAULT, help=HELP_ARG_CACHE_TTL_PAGES,
+                                 type=positive_nonzero_int)
+    parser_or_group.add_argument('--cache-ttl-videos', metavar='#minutes', default=CACHE_TTL_VIDEOS_DEFAULT, help=HELP_ARG_CACHE_TTL_VIDEOS,
+                                 type=positive_nonzero_int)
+    parser_or_group.add_argument('--cache-size', metavar='#MB', default=CACHE_SIZE_DEFAULT, help=HELP_ARG_CACHE_SIZE,
+                                 type=positive_nonzero_int)
+    parser_or_group.add_argument('--parser-mode', default=PARSER_MODE_DEFAULT, help=HELP_ARG_PARSER_MODE, choices=PARSER_MODES)
+    parser_or_group.add_argument('--parser-workers', metavar='#number', default=PARSER_WORKERS_DEFAULT, help=HELP_ARG_PARSER_WORKERS,
+                                 type=positive_nonzero_int)
     parser_or_group.add_argument('-throttle', metavar='#rate', default=0, help=HELP_ARG_THROTTLE, type=positive_nonzero_int)
     parser_or_group.add_argument('-athrottle', '--throttle-auto', action=ACTION_STORE_TRUE, help=HELP_ARG_THROTTLE_AUTO)
+    parser_or_group.add_argument('--segments', metavar='#number', default=SEGMENTS_DEFAULT, help=HELP_ARG_SEGMENTS, type=positive_int)
+    parser_or_group.add_argument('--segment-threshold', metavar='#MB', default=SEGMENT_THRESHOLD_DEFAULT, help=HELP_ARG_SEGMENT_THRESHOLD,
+                                 type=positive_nonzero_int)
+    parser_or_group.add_argument('--write-buffer', metavar='#MB', default=WRITE_BUFFER_DEFAULT, help=HELP_ARG_WRITE_BUFFER,
+                                 type=positive_nonzero_int)
+    parser_or_group.add_argument('--writer-workers', metavar='#number', default=WRITER_WORKERS_DEFAULT, help=HELP_ARG_WRITER_WORKERS,
+                                 type=positive_nonzero_int)
+    parser_or_group.add_argument('--preallocate', action=ACTION_STORE_TRUE, help=HELP_ARG_PREALLOCATE)
+    parser_or_group.add_argument('--drop-cache', action=ACTION_STORE_TRUE, help=HELP_ARG_DROP_CACHE)
+    parser_or_group.add_argument('--fsync', action=ACTION_STORE_TRUE, help=HELP_ARG_FSYNC)
+    parser_or_group.add_argument('--bandwidth', metavar='#KB/s', default=BANDWIDTH_DEFAULT, help=HELP_ARG_BANDWIDTH, type=positive_int)
+    parser_or_group.add_argument('--bandwidth-schedule', metavar='#HH:MM-HH:MM=rate[,...]', default=None, help=HELP_ARG_BANDWIDTH_SCHEDULE,
+                                 type=valid_bandwidth_schedule)
+    parser_or_group.add_argument('--bandwidth-file', metavar='#filepath', default=None, help=HELP_ARG_BANDWIDTH_FILE,
+                                 type=valid_filepath_new)
+    parser_or_group.add_argument('--journal', metavar='#filepath', default=None, help=HELP_ARG_JOURNAL, type=valid_filepath_new)
+    parser_or_group.add_argument('--manifest', action=ACTION_STORE_TRUE, help=HELP_ARG_MANIFEST)
+    parser_or_group.add_argument('--queue-policy', default=QUEUE_POLICY_DEFAULT, help=HELP_ARG_QUEUE_POLICY, choices=QUEUE_POLICIES)
+    parser_or_group.add_argument('--size-probe', action=ACTION_STORE_TRUE, help=HELP_ARG_SIZE_PROBE)
+    parser_or_group.add_argument('--min-free-space', metavar='#MB', default=MIN_FREE_SPACE_DEFAULT, help=HELP_ARG_MIN_FREE_SPACE,
+                                 type=positive_int)
     parser_or_group.add_argument('-continue', '--continue-mode', action=ACTION_STORE_TRUE, help=HELP_ARG_CONTINUE)
     parser_or_group.add_argument('-unfinish', '--keep-unfinished', action=ACTION_STORE_TRUE, help=HELP_ARG_UNFINISH)
     parser_or_group.add_argument('-naming', default=NAMING_DEFAULT, help=HELP_ARG_NAMING, type=naming_flags)
@@ -175,6 +243,12 @@ def prepare_arglist_pages(args: Sequence[str]) -> Namespace:
     arggr_count_or_end.add_argument('-end', metavar='#number', default=1, help='End page number', type=positive_nonzero_int)
     par_cmd.add_argument('-stop_id', metavar='#number', default=1, help='', type=positive_nonzero_int)
     par_cmd.add_argument('-begin_id', metavar='#number', default=10**9, help=HELP_ARG_BEGIN_STOP_ID, type=positive_nonzero_int)
+    par_cmd.add_argument('--page-prefetch', metavar='#number', default=PAGE_PREFETCH_DEFAULT, help=HELP_ARG_PAGE_PREFETCH,
+                         type=positive_int)
+    par_cmd.add_argument('--page-workers', metavar='#number', default=PAGE_WORKERS_DEFAULT, help=HELP_ARG_PAGE_WORKERS,
+                         type=positive_int)
+    par_cmd.add_argument('--stream', action=ACTION_STORE_TRUE, help=HELP_ARG_STREAM)
+    par_cmd.add_argument('--seen-ids', metavar='#filepath', default=None, help=HELP_ARG_SEEN_IDS, type=valid_filepath_new)
     arggr_pl_upl = par_cmd.add_mutually_exclusive_group()
     arggr_pl_upl.add_argument('-playlist_id', metavar='#number', default=(0, ''), help='', type=valid_playlist_id)
     arggr_pl_upl.add_argument('-playlist_name', metavar='#name', default=(0, ''), help=HELP_ARG_PLAYLIST, type=valid_playlist_name)
@@ -187,11 +261,25 @@ def prepare_arglist_pages(args: Sequence[str]) -> Namespace:
     par_cmd.add_argument('-search_rule_tag', default=SEARCH_RULE_DEFAULT, help='', choices=SEARCH_RULES)
     par_cmd.add_argument('-search_rule_art', default=SEARCH_RULE_DEFAULT, help='', choices=SEARCH_RULES)
     par_cmd.add_argument('-search_rule_cat', default=SEARCH_RULE_DEFAULT, help=HELP_ARG_SEARCH_RULE, choices=SEARCH_RULES)
+    par_cmd.add_argument('--source', metavar='#kind:value', action=ACTION_APPEND, help=HELP_ARG_SOURCE, type=valid_page_source)
 
     add_common_args(par_cmd)
     return execute_parser(parser, par_cmd, args, True)
 
 
+def prepare_arglist_verify(args: Sequence[str]) -> Namespace:
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument('--help', action='help', help='Print this message')
+    parser.add_argument('--version', action='version', help=HELP_ARG_VERSION, version=f'{APP_NAME} {APP_VERSION}')
+    parser.add_argument('-path', default=valid_path(path.abspath(path.curdir)), help=HELP_ARG_VERIFY_PATH, type=valid_path)
+    parser.add_argument('--workers', metavar='#number', default=0, help=HELP_ARG_VERIFY_WORKERS, type=positive_int)
+    parser.add_argument('-log', '--log-level', default=LOGGING_DEFAULT, help=HELP_ARG_LOGGING, type=log_level)
+    try:
+        return parser.parse_args(args)
+    except SystemExit:
+        raise HelpPrintExitException
+
+
 def prepare_arglist(args: Sequence[str], pages: bool) -> Namespace:
     if pages:
         return prepare_arglist_pages(args)
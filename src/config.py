@@ -7,11 +7,19 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 #
 
 from argparse import Namespace
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 
 from aiohttp import ClientTimeout
 
-from defs import CONNECT_TIMEOUT_BASE
+from defs import (
+    RequestClass, CONNECT_TIMEOUT_BASE, CONNECT_REQUEST_RATE_DEFAULT, CONNECT_REQUEST_BURST_DEFAULT, MEDIA_PACING_DEFAULT,
+    THUMBNAIL_PACING_DEFAULT, PROBE_PACING_DEFAULT, CACHE_TTL_PAGES_DEFAULT, CACHE_TTL_VIDEOS_DEFAULT, CACHE_SIZE_DEFAULT,
+    PARSER_MODE_DEFAULT, PARSER_WORKERS_DEFAULT, CONNECTOR_LIMIT_DEFAULT, CONNECTOR_LIMIT_PER_HOST_DEFAULT, CONNECTOR_DNS_TTL_DEFAULT,
+    CONNECTOR_KEEPALIVE_DEFAULT, SOCKET_BUFFER_DEFAULT, REPLAY_LATENCY_DEFAULT, REPLAY_BANDWIDTH_DEFAULT,
+    PAGE_PREFETCH_DEFAULT, PAGE_WORKERS_DEFAULT, SEGMENTS_DEFAULT, SEGMENT_THRESHOLD_DEFAULT,
+    WRITE_BUFFER_DEFAULT, WRITER_WORKERS_DEFAULT, BANDWIDTH_DEFAULT, QUEUE_POLICY_DEFAULT, MIN_FREE_SPACE_DEFAULT,
+)
+from psource import PageSource
 
 __all__ = ('Config',)
 
@@ -21,6 +29,7 @@ class BaseConfig:
     def __init__(self) -> None:
         self.dest_base = None  # type: Optional[str]
         self.proxy = None  # type: Optional[str]
+        self.proxies = list()  # type: List[str]
         self.session_id = None  # type: Optional[str]
         self.min_rating = None  # type: Optional[int]
         self.min_score = None  # type: Optional[int]
@@ -40,8 +49,41 @@ class BaseConfig:
         self.naming_flags = self.logging_flags = 0
         self.start = self.end = self.start_id = self.end_id = 0
         self.timeout = None  # type: Optional[ClientTimeout]
+        self.request_rate = CONNECT_REQUEST_RATE_DEFAULT  # type: float
+        self.request_burst = CONNECT_REQUEST_BURST_DEFAULT  # type: int
+        self.pacing = BaseConfig.default_pacing(self.request_rate, self.request_burst)  # type: Dict[RequestClass, Tuple[float, int, int]]
+        self.conn_limit = CONNECTOR_LIMIT_DEFAULT  # type: int
+        self.conn_limit_per_host = CONNECTOR_LIMIT_PER_HOST_DEFAULT  # type: int
+        self.dns_ttl = CONNECTOR_DNS_TTL_DEFAULT  # type: int
+        self.keepalive = CONNECTOR_KEEPALIVE_DEFAULT  # type: int
+        self.socket_buffers = (SOCKET_BUFFER_DEFAULT, SOCKET_BUFFER_DEFAULT)  # type: Tuple[int, int]
+        self.record = None  # type: Optional[str]
+        self.replay = None  # type: Optional[str]
+        self.replay_latency = REPLAY_LATENCY_DEFAULT  # type: int
+        self.replay_bandwidth = REPLAY_BANDWIDTH_DEFAULT  # type: int
+        self.cache = None  # type: Optional[bool]
+        self.cache_ttl_pages = CACHE_TTL_PAGES_DEFAULT  # type: int
+        self.cache_ttl_videos = CACHE_TTL_VIDEOS_DEFAULT  # type: int
+        self.cache_size = CACHE_SIZE_DEFAULT  # type: int
+        self.parser_mode = PARSER_MODE_DEFAULT  # type: str
+        self.parser_workers = PARSER_WORKERS_DEFAULT  # type: int
         self.throttle = None  # type: Optional[int]
         self.throttle_auto = None  # type: Optional[bool]
+        self.segments = SEGMENTS_DEFAULT  # type: int
+        self.segment_threshold = SEGMENT_THRESHOLD_DEFAULT  # type: int
+        self.write_buffer = WRITE_BUFFER_DEFAULT  # type: int
+        self.writer_workers = WRITER_WORKERS_DEFAULT  # type: int
+        self.preallocate = None  # type: Optional[bool]
+        self.drop_cache = None  # type: Optional[bool]
+        self.fsync = None  # type: Optional[bool]
+        self.bandwidth = BANDWIDTH_DEFAULT  # type: int
+        self.bandwidth_schedule = None  # type: Optional[List[Tuple[int, int, int]]]
+        self.bandwidth_file = None  # type: Optional[str]
+        self.journal = None  # type: Optional[str]
+        self.manifest = None  # type: Optional[bool]
+        self.queue_policy = QUEUE_POLICY_DEFAULT  # type: str
+        self.size_probe = None  # type: Optional[bool]
+        self.min_free_space = MIN_FREE_SPACE_DEFAULT  # type: int
         self.store_continue_cmdfile = None  # type: Optional[bool]
         # module-specific params (pages only or ids only)
         self.use_id_sequence = None  # type: Optional[bool]
@@ -53,13 +95,19 @@ class BaseConfig:
         self.playlist_name = None  # type: Optional[str]
         self.uploader = None  # type: Optional[int]
         self.model = None  # type: Optional[str]
+        self.page_sources = None  # type: Optional[List[PageSource]]
         self.get_maxid = None  # type: Optional[bool]
+        self.page_prefetch = PAGE_PREFETCH_DEFAULT  # type: int
+        self.page_workers = PAGE_WORKERS_DEFAULT  # type: int
+        self.stream = None  # type: Optional[bool]
+        self.seen_ids = None  # type: Optional[str]
         # extras (can't be set through cmdline arguments)
         self.nodelay = False
 
     def read(self, params: Namespace, pages: bool) -> None:
         self.dest_base = params.path
-        self.proxy = params.proxy
+        self.proxies = list(dict.fromkeys((params.proxy or []) + (params.proxy_file or [])))
+        self.proxy = self.proxies[0] if self.proxies else None
         # session_id only exists in RV and RC
         self.session_id = getattr(params, 'session_id', self.session_id)
         self.min_rating = params.minimum_rating
@@ -84,8 +132,42 @@ class BaseConfig:
         self.start_id = params.stop_id if pages else self.start
         self.end_id = params.begin_id if pages else self.end
         self.timeout = ClientTimeout(total=None, connect=params.timeout or CONNECT_TIMEOUT_BASE)
+        self.request_rate = params.request_rate
+        self.request_burst = params.request_burst
+        self.pacing = BaseConfig.default_pacing(self.request_rate, self.request_burst, params.segments)
+        self.pacing.update(params.pacing or {})
+        self.conn_limit = params.conn_limit
+        self.conn_limit_per_host = params.conn_limit_per_host
+        self.dns_ttl = params.dns_ttl
+        self.keepalive = params.keepalive
+        self.socket_buffers = params.socket_buffers
+        self.record = params.record
+        self.replay = params.replay
+        self.replay_latency = params.replay_latency
+        self.replay_bandwidth = params.replay_bandwidth
+        self.cache = params.cache
+        self.cache_ttl_pages = params.cache_ttl_pages
+        self.cache_ttl_videos = params.cache_ttl_videos
+        self.cache_size = params.cache_size
+        self.parser_mode = params.parser_mode
+        self.parser_workers = params.parser_workers
         self.throttle = params.throttle
         self.throttle_auto = params.throttle_auto
+        self.segments = params.segments
+        self.segment_threshold = params.segment_threshold
+        self.write_buffer = params.write_buffer
+        self.writer_workers = params.writer_workers
+        self.preallocate = params.preallocate
+        self.drop_cache = params.drop_cache
+        self.fsync = params.fsync
+        self.bandwidth = params.bandwidth
+        self.bandwidth_schedule = params.bandwidth_schedule
+        self.bandwidth_file = params.bandwidth_file
+        self.journal = params.journal
+        self.manifest = params.manifest
+        self.queue_policy = params.queue_policy
+        self.size_probe = params.size_probe
+        self.min_free_space = params.min_free_space
         self.store_continue_cmdfile = params.store_continue_cmdfile
         # module-specific params (pages only or ids only)
         self.use_id_sequence = getattr(params, 'use_id_sequence', self.use_id_sequence)
@@ -102,7 +184,22 @@ class BaseConfig:
         ) if hasattr(params, 'playlist_id') or hasattr(params, 'playlist_name') else (self.playlist_id, self.playlist_name)
         self.uploader = getattr(params, 'uploader', self.uploader)
         self.model = getattr(params, 'model', self.model)
+        self.page_sources = getattr(params, 'source', None) or []
         self.get_maxid = getattr(params, 'get_maxid', self.get_maxid)
+        self.page_prefetch = getattr(params, 'page_prefetch', self.page_prefetch)
+        self.page_workers = getattr(params, 'page_workers', self.page_workers)
+        self.stream = getattr(params, 'stream', self.stream)
+        self.seen_ids = getattr(params, 'seen_ids', self.seen_ids)
+
+    @staticmethod
+    def default_pacing(api_rate: float, api_burst: int, segments=SEGMENTS_DEFAULT) -> Dict[RequestClass, Tuple[float, int, int]]:
+        media_rate, media_burst, media_limit = MEDIA_PACING_DEFAULT
+        return {
+            RequestClass.API: (api_rate, api_burst, 0),
+            RequestClass.MEDIA: (media_rate, media_burst, media_limit * max(1, segments)),  # every segment is a request of its own
+            RequestClass.THUMBNAIL: THUMBNAIL_PACING_DEFAULT,
+            RequestClass.PROBE: PROBE_PACING_DEFAULT,
+        }
 
     @property
     def utp(self) -> Optional[str]:
@@ -14,8 +14,38 @@ APP_NAME = 'RV'
 APP_VERSION = '1.6.283'
 
 CONNECT_RETRIES_BASE = 50
+CONNECT_RETRIES_403_BASE = 25
+# retry delay is 'base * 2^(attempt - 1)' capped at max, then jittered down by up to a half
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 60.0
+RETRY_AFTER_MAX = 300.0
+# host is paused if at least ERROR_RATIO of last WINDOW (but no less than MIN_REQUESTS) requests failed
+BREAKER_WINDOW = 20
+BREAKER_MIN_REQUESTS = 10
+BREAKER_ERROR_RATIO = 0.5
+BREAKER_COOLDOWN_BASE = 15.0
+BREAKER_COOLDOWN_MAX = 300.0
 CONNECT_TIMEOUT_BASE = 10
 CONNECT_REQUEST_DELAY = 0.7
+CONNECT_REQUEST_RATE_DEFAULT = 1.0 / CONNECT_REQUEST_DELAY
+CONNECT_REQUEST_BURST_DEFAULT = 1
+# connection pool, zero limit means calculate automatically, zero per-host limit means no limit, zero buffer size means system default
+CONNECTOR_LIMIT_DEFAULT = 0
+CONNECTOR_LIMIT_PER_HOST_DEFAULT = 0
+CONNECTOR_DNS_TTL_DEFAULT = 300
+CONNECTOR_KEEPALIVE_DEFAULT = 30
+SOCKET_BUFFER_DEFAULT = 0
+REPLAY_LATENCY_DEFAULT = 0
+REPLAY_BANDWIDTH_DEFAULT = 0
+# proxy pool health: stats are exponentially weighted moving averages, failing proxy is quarantined after FAILURES failures in a row
+# or once its error rate reaches ERROR_RATE (after MIN_REQUESTS requests), quarantine time doubles each time up to MAX
+PROXY_HEALTH_EWMA_ALPHA = 0.2
+PROXY_QUARANTINE_FAILURES = 3
+PROXY_QUARANTINE_MIN_REQUESTS = 5
+PROXY_QUARANTINE_ERROR_RATE = 0.5
+PROXY_QUARANTINE_BASE = 30.0
+PROXY_QUARANTINE_MAX = 600.0
+PROXY_THROUGHPUT_MIN_BYTES = 256 * 1024
 
 MAX_DEST_SCAN_SUB_DEPTH = 1
 MAX_VIDEOS_QUEUE_SIZE = 8
@@ -27,7 +57,61 @@ DOWNLOAD_CONTINUE_FILE_CHECK_TIMER = 30
 SCREENSHOTS_COUNT = 10
 FULLPATH_MAX_BASE_LEN = 240
 
+
+class RequestClass(IntEnum):
+    API = 0
+    MEDIA = 1
+    THUMBNAIL = 2
+    PROBE = 3
+
+    def __str__(self) -> str:
+        return self.name.lower()
+
+
+REQUEST_CLASSES = {str(rc): rc for rc in RequestClass}
+"""{\n\n'api': RequestClass.API,\n\n'media': RequestClass.MEDIA,\n\n'thumbnail': RequestClass.THUMBNAIL,\n
+'probe': RequestClass.PROBE\n\n}"""
+# request class pacing: (rate, burst, max simultaneous requests), zero rate or limit means no limit
+MEDIA_PACING_DEFAULT = (0.0, 1, MAX_VIDEOS_QUEUE_SIZE)
+THUMBNAIL_PACING_DEFAULT = (10.0, SCREENSHOTS_COUNT, 4)
+PROBE_PACING_DEFAULT = (5.0, 4, 4)
+
 PREFIX = 'rv_'
+CACHE_DIR_NAME = f'{PREFIX}!cache'
+CACHE_TTL_PAGES_DEFAULT = 60
+CACHE_TTL_VIDEOS_DEFAULT = 15  # video info holds signed media links which expire
+CACHE_SIZE_DEFAULT = 1024
+PARSER_MODE_INLINE = 'inline'
+PARSER_MODE_THREAD = 'thread'
+PARSER_MODE_PROCESS = 'process'
+PARSER_MODES = (PARSER_MODE_INLINE, PARSER_MODE_THREAD, PARSER_MODE_PROCESS)
+"""('inline','thread','process')"""
+PARSER_MODE_DEFAULT = PARSER_MODE_THREAD
+PARSER_WORKERS_DEFAULT = 2
+PAGE_PREFETCH_DEFAULT = 2
+PAGE_WORKERS_DEFAULT = 0
+PAGE_RETRIES_MAX = 3
+STREAM_BUFFER_SIZE = 50
+SEGMENTS_DEFAULT = 0
+SEGMENT_THRESHOLD_DEFAULT = 100
+SEGMENT_MAP_EXT = 'segments'
+SEGMENT_MAP_SAVE_INTERVAL = 1.0
+WRITE_BUFFER_DEFAULT = 8
+WRITER_WORKERS_DEFAULT = 2
+BANDWIDTH_DEFAULT = 0
+BANDWIDTH_QUANTUM = 64 * 1024
+BANDWIDTH_BURST_SECONDS = 0.5
+BANDWIDTH_FILE_CHECK_INTERVAL = 5
+SMALL_FILE_SIZE = 10
+JOURNAL_SYNC_SIZE = 4 * 1024 * 1024
+MANIFEST_FILE_NAME = f'{PREFIX}!hashes.txt'
+LINK_REFRESHES_MAX = 3
+# media link response statuses meaning the link has expired and has to be refreshed, not a host failure
+MEDIA_LINK_EXPIRED_STATUSES = (403, 410)
+SMALL_LANE_SLOTS = 2
+SIZE_PROBE_LOOKAHEAD = 16
+MIN_FREE_SPACE_DEFAULT = 0
+DISK_SPACE_CHECK_INTERVAL = 10
 SLASH = '/'
 UTF8 = 'utf-8'
 TAGS_CONCAT_CHAR = ','
@@ -87,6 +171,16 @@ DOWNLOAD_MODES = (DOWNLOAD_MODE_FULL, DOWNLOAD_MODE_TOUCH, DOWNLOAD_MODE_SKIP)
 DOWNLOAD_MODE_DEFAULT = DOWNLOAD_MODE_FULL
 """'full'"""
 
+# download queue policy
+QUEUE_POLICY_ID = 'id'
+QUEUE_POLICY_SMALLEST = 'smallest'
+QUEUE_POLICY_LARGEST = 'largest'
+QUEUE_POLICY_MIXED = 'mixed'
+QUEUE_POLICIES = (QUEUE_POLICY_ID, QUEUE_POLICY_SMALLEST, QUEUE_POLICY_LARGEST, QUEUE_POLICY_MIXED)
+"""('id','smallest','largest','mixed')"""
+QUEUE_POLICY_DEFAULT = QUEUE_POLICY_ID
+"""'id'"""
+
 # search args combination logic rules
 SEARCH_RULE_ALL = 'all'
 SEARCH_RULE_ANY = 'any'
@@ -159,10 +253,36 @@ LOGGING_FLAGS_DEFAULT = LoggingFlags.INFO
 """0x004"""
 
 ACTION_STORE_TRUE = 'store_true'
+ACTION_APPEND = 'append'
 
 HELP_ARG_VERSION = 'Show program\'s version number and exit'
 HELP_ARG_GET_MAXID = 'Print maximum id and exit'
-HELP_ARG_BEGIN_STOP_ID = 'Video id lower / upper bounds filter to only download videos where \'begin_id >= video_id >= stop_id\''
+HELP_ARG_BEGIN_STOP_ID = (
+    'Video id lower / upper bounds filter to only download videos where \'begin_id >= video_id >= stop_id\'.'
+    ' Search pages preceding \'begin_id\' are skipped using binary search, scan stops once a page is entirely below \'stop_id\''
+)
+HELP_ARG_PAGE_PREFETCH = (
+    f'Number of next pages to fetch in background while current page is processed. Never goes past last page once it is known.'
+    f' Default is \'{PAGE_PREFETCH_DEFAULT:d}\', \'0\' to disable'
+)
+HELP_ARG_PAGE_WORKERS = (
+    f'Fetch all the remaining pages concurrently once max page is known, using this many simultaneous requests at most.'
+    f' Pages are still processed in order. Overrides page prefetch. Default is \'{PAGE_WORKERS_DEFAULT:d}\' - disabled'
+)
+HELP_ARG_STREAM = (
+    f'Start downloading right away instead of scanning all the pages first. Found videos are passed to download page by page,'
+    f' scanning is paused while more than {STREAM_BUFFER_SIZE:d} videos are awaiting their turn'
+)
+HELP_ARG_SOURCE = (
+    'Additional pages source: \'search:#string\', \'tag:#tag[,tag...]\', \'art:#artist[,artist...]\', \'cat:#category[,category...]\','
+    ' \'playlist:#id_or_name\', \'uploader:#user_id\' or \'model:#name\'. Can be used multiple times. All the sources'
+    ' (including the one set by regular search / playlist / uploader / model args, if any) are scanned concurrently,'
+    ' videos found by multiple sources are only downloaded once. Ex. \'--source art:artist_name --source playlist:stuff\''
+)
+HELP_ARG_SEEN_IDS = (
+    'File to remember ids of found videos in. Videos remembered by previous runs are skipped, ids found by this run are added'
+    ' once page scan is completed'
+)
 HELP_ARG_LOOKAHEAD = (
     'Continue scanning indefinitely after reaching end id until number of non-existing videos encountered in a row'
     ' reaches this number'
@@ -189,7 +309,11 @@ HELP_ARG_SEARCH_ACT = (
 HELP_ARG_PLAYLIST = 'Playlist to download (filters still apply)'
 HELP_ARG_SEARCH_STR = 'Native search using string query (matching any word). Spaces must be replced with \'-\'. Ex. \'after-hours\''
 HELP_ARG_QUALITY = f'Video quality. Default is \'{DEFAULT_QUALITY}\'. If not found, best quality found is used (up to 4K)'
-HELP_ARG_PROXY = 'Proxy to use. Example: http://127.0.0.1:222'
+HELP_ARG_PROXY = (
+    'Proxy to use. Can be used multiple times to form a proxy pool: requests are then balanced between proxies by their load'
+    ' and health. Example: http://127.0.0.1:222'
+)
+HELP_ARG_PROXY_FILE = 'Text file containing proxies to add to proxy pool, one per line. Lines starting with \'#\' are ignored'
 HELP_ARG_UTPOLICY = (
     f'Untagged videos download policy. By default these videos are ignored if you use extra \'tags\' / \'-tags\'. Use'
     f' \'{DOWNLOAD_POLICY_ALWAYS}\' to override'
@@ -240,8 +364,123 @@ HELP_ARG_SKIP_EMPTY_LISTS = 'Do not store tags / descriptions / comments list if
 HELP_ARG_CONTINUE = 'Try to continue unfinished files, may be slower if most files already exist'
 HELP_ARG_UNFINISH = 'Do not clean up unfinished files on interrupt'
 HELP_ARG_TIMEOUT = 'Connection timeout (in seconds)'
+HELP_ARG_REQUEST_RATE = (
+    f'Maximum requests per second sent to a single host. Default is \'{CONNECT_REQUEST_RATE_DEFAULT:.2f}\''
+    f' (one request per {CONNECT_REQUEST_DELAY:.1f} seconds)'
+)
+HELP_ARG_REQUEST_BURST = (
+    f'Number of requests to a single host allowed to go through back-to-back after an idle period.'
+    f' Default is \'{CONNECT_REQUEST_BURST_DEFAULT:d}\''
+)
+HELP_ARG_CONN_LIMIT = (
+    f'Maximum number of simultaneously open connections. Default is \'{CONNECTOR_LIMIT_DEFAULT:d}\' - calculate from request'
+    f' class limits and enabled features'
+)
+HELP_ARG_CONN_LIMIT_PER_HOST = (
+    f'Maximum number of simultaneously open connections to a single host. Default is \'{CONNECTOR_LIMIT_PER_HOST_DEFAULT:d}\' - no limit'
+)
+HELP_ARG_DNS_TTL = f'DNS lookup results cache lifetime (in seconds). Default is \'{CONNECTOR_DNS_TTL_DEFAULT:d}\''
+HELP_ARG_KEEPALIVE = f'Idle connection keep-alive time (in seconds). Default is \'{CONNECTOR_KEEPALIVE_DEFAULT:d}\''
+HELP_ARG_SOCKET_BUFFERS = (
+    f'Socket receive / send buffer sizes (in KB) \'RCVBUF[:SNDBUF]\'. Not applied when using proxy.'
+    f' Default is \'{SOCKET_BUFFER_DEFAULT:d}:{SOCKET_BUFFER_DEFAULT:d}\' - system default'
+)
+HELP_ARG_PACING = (
+    f'Request class pacing overrides: \'CLASS:RATE:BURST:LIMIT[,CLASS:RATE:BURST:LIMIT...]\', CLASS is one of'
+    f' {{{",".join(REQUEST_CLASSES.keys())}}}. RATE is requests per second to a single host, LIMIT is the maximum number'
+    f' of simultaneously open requests of that class, zero RATE or LIMIT means no limit.'
+    f' \'api\' class is page / video info requests and defaults to \'-rate\' / \'-burst\' with no LIMIT.'
+    f' Defaults for other classes are \'media:{":".join(f"{v:g}" for v in MEDIA_PACING_DEFAULT)}\','
+    f' \'thumbnail:{":".join(f"{v:g}" for v in THUMBNAIL_PACING_DEFAULT)}\', \'probe:{":".join(f"{v:g}" for v in PROBE_PACING_DEFAULT)}\','
+    f' default media LIMIT is multiplied by \'--segments\'.'
+    f' Example: \'media:0:1:4,thumbnail:5:2:2\''
+)
+HELP_ARG_CACHE = (
+    f'Store fetched pages and video info in \'{CACHE_DIR_NAME}\' folder inside download destination and reuse them in later runs'
+    f' while they are fresh. Stale entries are revalidated with the server if possible'
+)
+HELP_ARG_CACHE_TTL_PAGES = (
+    f'Cached search / playlist / uploader / artist pages lifetime (in minutes). Default is \'{CACHE_TTL_PAGES_DEFAULT:d}\''
+)
+HELP_ARG_CACHE_TTL_VIDEOS = (
+    f'Cached video info lifetime (in minutes). Video info contains signed media links which expire, keep it short.'
+    f' Expired links are always refreshed from the server. Default is \'{CACHE_TTL_VIDEOS_DEFAULT:d}\''
+)
+HELP_ARG_CACHE_SIZE = (
+    f'Cache size limit (in MB). Least recently used entries are removed once it is exceeded. Default is \'{CACHE_SIZE_DEFAULT:d}\''
+)
+HELP_ARG_PARSER_MODE = (
+    f'Where html pages are parsed: \'{PARSER_MODE_INLINE}\' - on the main event loop, \'{PARSER_MODE_THREAD}\' - in a thread pool,'
+    f' \'{PARSER_MODE_PROCESS}\' - in a process pool (only extracted data is sent back). Default is \'{PARSER_MODE_DEFAULT}\''
+)
+HELP_ARG_PARSER_WORKERS = f'Html parser pool size. Ignored in \'{PARSER_MODE_INLINE}\' mode. Default is \'{PARSER_WORKERS_DEFAULT:d}\''
+HELP_ARG_RECORD = '[Debug] Record every received response into this folder, to be replayed later using \'--replay\''
+HELP_ARG_REPLAY = (
+    '[Debug] Do not connect to anything, serve responses recorded using \'--record\' from this folder instead.'
+    ' Responses which were not recorded are served as 404'
+)
+HELP_ARG_REPLAY_LATENCY = f'[Debug] Replayed response delay (in milliseconds). Default is \'{REPLAY_LATENCY_DEFAULT:d}\' - no delay'
+HELP_ARG_REPLAY_BANDWIDTH = (
+    f'[Debug] Replayed response body transfer speed (in KB/s). Default is \'{REPLAY_BANDWIDTH_DEFAULT:d}\' - unlimited'
+)
 HELP_ARG_THROTTLE = 'Download speed threshold (in KB/s) to assume throttling, drop connection and retry'
 HELP_ARG_THROTTLE_AUTO = 'Enable automatic throttle threshold adjustment when crossed too many times in a row'
+HELP_ARG_SEGMENTS = (
+    'Download files larger than segment threshold using this many simultaneous connections, each one fetching its own part of the file.'
+    ' Parts are written directly into preallocated file and retried independently, download progress is kept in'
+    f' \'.{SEGMENT_MAP_EXT}\' file next to it until download is completed. Default is \'{SEGMENTS_DEFAULT:d}\' - disabled'
+)
+HELP_ARG_WRITE_BUFFER = (
+    'Per file write buffer size (in MB). Downloaded data is written to disk in background, writes are merged together'
+    f' while the disk is busy. Download is paused while its buffer is full. Default is \'{WRITE_BUFFER_DEFAULT:d}\''
+)
+HELP_ARG_WRITER_WORKERS = f'Number of threads writing downloaded data to disk. Default is \'{WRITER_WORKERS_DEFAULT:d}\''
+HELP_ARG_PREALLOCATE = (
+    'Reserve disk space for the whole file once its size is known to avoid fragmentation (requires posix_fallocate support).'
+    f' Unfinished preallocated file is marked by \'.{SEGMENT_MAP_EXT}\' file next to it'
+)
+HELP_ARG_DROP_CACHE = 'Drop written data from OS page cache (posix_fadvise DONTNEED) so downloads do not evict useful cache'
+HELP_ARG_FSYNC = 'Flush every completed file (or file segment) to disk before it is considered complete'
+HELP_ARG_BANDWIDTH = (
+    'Total download bandwidth limit (in KB/s) shared fairly by all active downloads. Screenshots and files smaller than'
+    f' {SMALL_FILE_SIZE:d} MB are served first. Default is \'{BANDWIDTH_DEFAULT:d}\' - no limit'
+)
+HELP_ARG_BANDWIDTH_SCHEDULE = (
+    'Time of day bandwidth limits: \'HH:MM-HH:MM=RATE[,HH:MM-HH:MM=RATE...]\', RATE is in KB/s (0 - no limit).'
+    ' Interval may wrap over midnight, first matching interval is used, bandwidth limit applies outside of them'
+)
+HELP_ARG_BANDWIDTH_FILE = (
+    'File containing bandwidth limit (in KB/s, 0 - no limit), checked for changes every'
+    f' {BANDWIDTH_FILE_CHECK_INTERVAL:d} seconds during download. Overrides other bandwidth limits while it exists'
+)
+HELP_ARG_JOURNAL = (
+    'File to keep downloads metadata in (link, size, ETag / Last-Modified, written size, quality). Resumed downloads are'
+    ' validated with \'If-Range\' and restarted if remote file has changed, completed files are skipped without any requests'
+)
+HELP_ARG_MANIFEST = (
+    f'Hash downloaded files (BLAKE2b) while they are being written and store hashes in \'{MANIFEST_FILE_NAME}\' file of their folder.'
+    ' Use verify.py to check downloaded files against it later'
+)
+HELP_ARG_QUEUE_POLICY = (
+    f'Order of starting downloads: \'{QUEUE_POLICY_ID}\' - by id, \'{QUEUE_POLICY_SMALLEST}\' - smallest files first,'
+    f' \'{QUEUE_POLICY_LARGEST}\' - largest files first, \'{QUEUE_POLICY_MIXED}\' - by id but {SMALL_LANE_SLOTS:d} download slots'
+    f' are reserved for files smaller than {SMALL_FILE_SIZE:d} MB. Size aware policies enable size probe.'
+    f' Default is \'{QUEUE_POLICY_DEFAULT}\''
+)
+HELP_ARG_SIZE_PROBE = (
+    'Request size of every file (single byte range request) while it is waiting for its turn, this allows'
+    f' queue policies to order downloads and download status to project completion time. Up to {SIZE_PROBE_LOOKAHEAD:d}'
+    ' next files are probed at a time, files not yet probed are started in default order'
+)
+HELP_ARG_MIN_FREE_SPACE = (
+    'Minimum free disk space (in MB) to keep. Disk space is reserved for every file before its download starts,'
+    ' new downloads are held while free space minus reserved space would drop below this value and are resumed'
+    f' once there is enough space again (checked every {DISK_SPACE_CHECK_INTERVAL:d} seconds).'
+    f' Each destination mount is accounted separately. Default is \'{MIN_FREE_SPACE_DEFAULT:d}\''
+)
+HELP_ARG_VERIFY_PATH = 'Folder to verify, its subfolders are verified as well. Default is current folder'
+HELP_ARG_VERIFY_WORKERS = 'Number of processes hashing files. Default is number of CPUs'
+HELP_ARG_SEGMENT_THRESHOLD = f'Minimum file size (in MB) to download in segments. Default is \'{SEGMENT_THRESHOLD_DEFAULT:d}\''
 HELP_ARG_UPLOADER = 'Uploader user id (integer, filters still apply)'
 HELP_ARG_MODEL = 'Artist name (download directly from artist\'s page)'
 
@@ -252,6 +491,7 @@ class DownloadResult(IntEnum):
     FAIL_RETRIES = 2
     FAIL_ALREADY_EXISTS = 3
     FAIL_SKIPPED = 4
+    FAIL_DEFERRED = 5
 
     def __str__(self) -> str:
         return f'{self.name} (0x{self.value:d})'
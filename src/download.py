@@ -6,28 +6,35 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 #
 #
 
-from asyncio import Task, sleep, get_running_loop, as_completed
+from asyncio import Task, get_running_loop, as_completed, gather
 from os import path, stat, remove, makedirs
-from random import uniform as frand
-from typing import Optional, List, Dict
+from typing import AsyncIterable, Optional, List, Dict, Tuple
 
 from aiofile import async_open
-from aiohttp import ClientSession, ClientPayloadError
+from aiohttp import ClientSession, ClientResponse, ClientPayloadError
+from yarl import URL
 
+from bwshaper import BandwidthShaper
 from config import Config
 from defs import (
-    Mem, NamingFlags, DownloadResult, CONNECT_RETRIES_BASE, SITE_AJAX_REQUEST_VIDEO, DOWNLOAD_POLICY_ALWAYS, DOWNLOAD_MODE_TOUCH, PREFIX,
-    DOWNLOAD_MODE_SKIP, TAGS_CONCAT_CHAR, SITE, SCREENSHOTS_COUNT,
-    FULLPATH_MAX_BASE_LEN, CONNECT_REQUEST_DELAY,
+    Mem, NamingFlags, DownloadResult, RequestClass, SITE_AJAX_REQUEST_VIDEO, DOWNLOAD_POLICY_ALWAYS,
+    DOWNLOAD_MODE_TOUCH, DOWNLOAD_MODE_FULL, PREFIX, DOWNLOAD_MODE_SKIP, TAGS_CONCAT_CHAR, SITE, SCREENSHOTS_COUNT, FULLPATH_MAX_BASE_LEN,
+    SMALL_FILE_SIZE, LINK_REFRESHES_MAX, MEDIA_LINK_EXPIRED_STATUSES,
 )
 from downloader import VideoDownloadWorker
 from dscanner import VideoScanWorker
 from dthrottler import ThrottleChecker
+from dwriter import FileWriter, WriterPool
 from fetch_html import fetch_html, wrap_request, make_session
+from hparser import ParserPool, parse_popup
+from journal import TransferJournal, RemoteFileChanged
 from logger import Log
+from manifest import StreamHasher, HashManifest, hash_file
 from path_util import file_already_exists, try_rename
 from rex import re_media_filename
+from rpolicy import RetryPolicy
 from scenario import DownloadScenario
+from segments import Segment, SegmentMap
 from tagger import filtered_tags, is_filtered_out_by_extra_tags
 from util import has_naming_flag, format_time, get_elapsed_time_i, extract_ext
 from vinfo import VideoInfo, export_video_info, get_min_max_ids
@@ -35,21 +42,45 @@ from vinfo import VideoInfo, export_video_info, get_min_max_ids
 __all__ = ('download', 'at_interrupt')
 
 
-async def download(sequence: List[VideoInfo], by_id: bool, filtered_count: int, session: ClientSession = None) -> None:
-    minid, maxid = get_min_max_ids(sequence)
-    eta_min = int(2.0 + (CONNECT_REQUEST_DELAY + 0.2 + 0.02) * len(sequence))
-    Log.info(f'\nOk! {len(sequence):d} ids (+{filtered_count:d} filtered out), bound {minid:d} to {maxid:d}. Working...\n'
-             f'\nThis will take at least {eta_min:d} seconds{f" ({format_time(eta_min)})" if eta_min >= 60 else ""}!\n')
+class MediaLinkExpired(IOError):
+    """Signed media link is no longer accepted by the server"""
+
+
+async def download(sequence: List[VideoInfo], by_id: bool, filtered_count: int, session: ClientSession = None,
+                   feed: AsyncIterable[Tuple[List[VideoInfo], int]] = None) -> None:
+    """
+    Processes **sequence**. If **feed** is provided processing starts right away and items (with their filtered out count)
+    keep coming from it until it is exhausted. **sequence** must be updated by the feed with all the items it yields
+    """
+    if feed is None:
+        minid, maxid = get_min_max_ids(sequence)
+        api_rate = Config.pacing[RequestClass.API][0]
+        eta_min = int(2.0 + ((1.0 / api_rate if api_rate > 0.0 else 0.0) + 0.02) * len(sequence))
+        Log.info(f'\nOk! {len(sequence):d} ids (+{filtered_count:d} filtered out), bound {minid:d} to {maxid:d}. Working...\n'
+                 f'\nThis will take at least {eta_min:d} seconds{f" ({format_time(eta_min)})" if eta_min >= 60 else ""}!\n')
+    else:
+        Log.info('\nOk! Processing ids as they are found. Working...\n')
+    streaming = feed is not None
     async with session or make_session() as session:
         if by_id:
-            for cv in as_completed([
-                VideoScanWorker(sequence, scan_video).run(),
-                VideoDownloadWorker(sequence, process_video, filtered_count, session).run()
-            ]):
-                await cv
+            scn = VideoScanWorker(sequence, scan_video, streaming)
+            dwn = VideoDownloadWorker(sequence, process_video, filtered_count, session, streaming, probe_size)
+            workers = [scn.run(), dwn.run()]
         else:
-            await VideoDownloadWorker(sequence, download_video, filtered_count, session).run()
+            dwn = VideoDownloadWorker(sequence, download_video, filtered_count, session, streaming, probe_size)
+            workers = [dwn.run()]
+        for cv in as_completed([*workers, *((feed_worker(dwn, feed),) if streaming else ())]):
+            await cv
     export_video_info(sequence)
+    TransferJournal.close()
+
+
+async def feed_worker(dwn: VideoDownloadWorker, feed: AsyncIterable[Tuple[List[VideoInfo], int]]) -> None:
+    try:
+        async for items, filtered_count in feed:
+            await dwn.feed(items, filtered_count)
+    finally:
+        dwn.finish_feed()
 
 
 async def scan_video(vi: VideoInfo) -> DownloadResult:
@@ -62,40 +93,45 @@ async def scan_video(vi: VideoInfo) -> DownloadResult:
     rating = vi.rating
     score = ''
 
+    if not (scenario or Config.save_tags or Config.save_descriptions or Config.save_comments or Config.save_screenshots):
+        if TransferJournal.find_verified(vi.id, vi.quality):
+            Log.info(f'{sname} ({vi.quality}) is already completed according to journal. Skipped.')
+            vi.set_state(VideoInfo.State.DONE)
+            return DownloadResult.FAIL_ALREADY_EXISTS
+
     vi.set_state(VideoInfo.State.SCANNING)
-    a_html = await fetch_html(f'{SITE_AJAX_REQUEST_VIDEO % vi.id}?popup_id={2 + vi.id % 10:d}', session=dwn.session)
+    a_html = await fetch_html(f'{SITE_AJAX_REQUEST_VIDEO % vi.id}?popup_id={2 + vi.id % 10:d}', session=dwn.session, parse=parse_popup)
     if a_html is None:
         Log.error(f'Error: unable to retreive html for {sname}! Aborted!')
         return DownloadResult.FAIL_RETRIES
 
-    if a_html.find('title', string='404 Not Found'):
+    if a_html.not_found:
         Log.error(f'Got error 404 for {sname}, skipping...')
         return DownloadResult.FAIL_NOT_FOUND
 
     if not vi.title:
-        titleh1 = a_html.find('h1', class_='title_video')
-        vi.title = titleh1.text if titleh1 else ''
+        vi.title = a_html.title or ''
     try:
         dislikes_int = 0
-        likes_int = int(a_html.find('span', class_='voters count').text.replace(' likes', '').replace(' like', ''))
+        likes_int = int(a_html.likes.replace(' likes', '').replace(' like', ''))
         rating = f'{(likes_int * 100) // (dislikes_int + likes_int):d}' if (dislikes_int + likes_int) > 999999 else rating
         score = f'{likes_int - dislikes_int:d}'
     except Exception:
         Log.warn(f'Warning: cannot extract score for {sname}.')
-    try:
-        my_authors = [str(a.string).lower() for a in a_html.find('div', string='Artist:').parent.find_all('span')]
-    except Exception:
+    if a_html.artists is not None:
+        my_authors = [author.lower() for author in a_html.artists]
+    else:
         Log.warn(f'Warning: cannot extract authors for {sname}.')
         my_authors = list()
-    try:
-        my_categories = [str(c.string).lower() for c in a_html.find('div', string='Categories:').parent.find_all('span')]
-    except Exception:
+    if a_html.categories is not None:
+        my_categories = [category.lower() for category in a_html.categories]
+    else:
         Log.warn(f'Warning: cannot extract categories for {sname}.')
         my_categories = list()
-    tdiv = a_html.find('div', string='Tags:')
-    if tdiv is None:
+    untagged = a_html.tags is None
+    if untagged:
         Log.info(f'Warning: video {sname} has no tags!')
-    tags = [str(elem.string) for elem in tdiv.parent.find_all('a', class_='tag_item')] if tdiv else ['']
+    tags = a_html.tags if not untagged else ['']
     tags_raw = [tag.replace(' ', '_').lower() for tag in tags if len(tag) > 0]
     for add_tag in [ca.replace(' ', '_') for ca in my_categories + my_authors if len(ca) > 0]:
         if add_tag not in tags_raw:
@@ -113,7 +149,7 @@ async def scan_video(vi: VideoInfo) -> DownloadResult:
                 pass
     if scenario is not None:
         matching_sq = scenario.get_matching_subquery(vi, tags_raw, score, rating)
-        utpalways_sq = scenario.get_utp_always_subquery() if tdiv is None else None
+        utpalways_sq = scenario.get_utp_always_subquery() if untagged else None
         if matching_sq:
             vi.subfolder = matching_sq.subfolder
             vi.quality = matching_sq.quality
@@ -123,60 +159,52 @@ async def scan_video(vi: VideoInfo) -> DownloadResult:
         else:
             Log.info(f'Info: unable to find matching or utp scenario subquery for {sname}, skipping...')
             return DownloadResult.FAIL_SKIPPED
-    elif tdiv is None and len(Config.extra_tags) > 0 and Config.utp != DOWNLOAD_POLICY_ALWAYS:
+    elif untagged and len(Config.extra_tags) > 0 and Config.utp != DOWNLOAD_POLICY_ALWAYS:
         Log.warn(f'Warning: could not extract tags from {sname}, skipping due to untagged videos download policy...')
         return DownloadResult.FAIL_SKIPPED
     if Config.save_tags:
         vi.tags = ' '.join(sorted(tags_raw))
     if Config.save_descriptions or Config.save_comments:
-        cidivs = a_html.find_all('div', class_='comment-info')
-        cudivs = [cidiv.find('a') for cidiv in cidivs]
-        ctdivs = [cidiv.find('div', class_='coment-text') for cidiv in cidivs]
-        desc_em = a_html.find('em')  # exactly one
-        uploader_div = a_html.find('div', string=' Uploaded By: ')
-        my_uploader = uploader_div.parent.find('a', class_='name').text.lower().strip() if uploader_div else 'unknown'
-        has_description = (cudivs[-1].text.lower() == my_uploader) if (cudivs and ctdivs) else False  # first comment by uploader
-        if cudivs and ctdivs:
-            assert len(ctdivs) == len(cudivs)
+        comments = a_html.comments
+        my_uploader = a_html.uploader.lower().strip() if a_html.uploader is not None else 'unknown'
+        has_description = (comments[-1][0].lower() == my_uploader) if comments else False  # first comment by uploader
         if Config.save_descriptions:
-            desc_comment = (f'{cudivs[-1].text}:\n' + ctdivs[-1].get_text('\n').strip()) if has_description else ''
-            desc_base = (f'\n{my_uploader}:\n' + desc_em.get_text('\n') + '\n') if desc_em else ''
+            desc_comment = (f'{comments[-1][0]}:\n' + comments[-1][1].strip()) if has_description else ''
+            desc_base = (f'\n{my_uploader}:\n' + a_html.description + '\n') if a_html.description is not None else ''
             vi.description = desc_base or (f'\n{desc_comment}\n' if desc_comment else '')
         if Config.save_comments:
-            comments_list = [f'{cudivs[i].text}:\n' + ctdivs[i].get_text('\n').strip() for i in range(len(ctdivs) - int(has_description))]
+            comments_list = [f'{comments[i][0]}:\n' + comments[i][1].strip() for i in range(len(comments) - int(has_description))]
             vi.comments = ('\n' + '\n\n'.join(comments_list) + '\n') if comments_list else ''
     my_tags = filtered_tags(sorted(tags_raw)) or my_tags
 
     tries = 0
     while True:
-        ddiv = a_html.find('div', string='Download:')
-        if ddiv is not None and ddiv.parent is not None:
+        if a_html is None:
+            Log.error(f'Error: unable to retreive html for {sname}! Aborted!')
+            return DownloadResult.FAIL_RETRIES
+        if a_html.links is not None:
             break
-        message_span = a_html.find('span', class_='message')
-        if message_span:
-            Log.warn(f'Cannot find download section for {sname}, reason: \'{message_span.text}\', skipping...')
+        if a_html.message is not None:
+            Log.warn(f'Cannot find download section for {sname}, reason: \'{a_html.message}\', skipping...')
             return DownloadResult.FAIL_SKIPPED
         elif tries >= 5:
             Log.error(f'Cannot find download section for {sname} after {tries:d} tries, failed!')
             return DownloadResult.FAIL_RETRIES
         tries += 1
         Log.debug(f'No download section for {sname}, retry #{tries:d}...')
-        a_html = await fetch_html(f'{SITE_AJAX_REQUEST_VIDEO % vi.id}?popup_id={2 + tries + vi.id % 10:d}', session=dwn.session)
-    links = ddiv.parent.find_all('a', class_='tag_item')
-    qualities = list()
-    for lin in links:
-        try:
-            qualities.append(lin.text.replace('MP4 ', ''))
-        except Exception:
-            pass
+        a_html = await fetch_html(f'{SITE_AJAX_REQUEST_VIDEO % vi.id}?popup_id={2 + tries + vi.id % 10:d}', session=dwn.session,
+                                  parse=parse_popup)
+    links = a_html.links
+    qualities = [ltext.replace('MP4 ', '') for ltext, _ in links]
     if vi.quality not in qualities:
         q_idx = 0
         Log.warn(f'Warning: cannot find quality \'{vi.quality}\' for {sname}, selecting \'{qualities[q_idx]}\'')
+        vi.requested_quality = vi.quality
         vi.quality = qualities[q_idx]
         link_idx = q_idx
     else:
         link_idx = qualities.index(vi.quality)
-    vi.link = links[link_idx].get('href')
+    vi.link = links[link_idx][1]
 
     rv_ = PREFIX if has_naming_flag(NamingFlags.PREFIX) else ''
     fname_part2 = extract_ext(vi.link)
@@ -206,10 +234,48 @@ async def scan_video(vi: VideoInfo) -> DownloadResult:
     return DownloadResult.SUCCESS
 
 
+async def probe_size(vi: VideoInfo) -> None:
+    """Fills expected size of **vi** file using single byte range request, nothing is changed if it fails"""
+    if not Config.size_probe or Config.dm != DOWNLOAD_MODE_FULL or vi.expected_size or not vi.link:
+        return
+    dwn = VideoDownloadWorker.get()
+    try:
+        # probes are paced on their own and don't take media download or thumbnail slots
+        async with await wrap_request(dwn.session, 'GET', vi.link, rclass=RequestClass.PROBE, headers={'Range': 'bytes=0-0'}) as r:
+            total_s = r.headers.get('Content-Range', '/').split('/', 1)[-1]
+            if r.status == 206 and total_s.isnumeric():
+                vi.expected_size = int(total_s)
+            elif r.status == 200 and not (r.content_type and 'text' in r.content_type):
+                vi.expected_size = r.content_length or 0
+            r.close()
+        Log.trace(f'{vi.sname}: size probe: {vi.expected_size / Mem.MB:.2f} Mb')
+    except Exception as e:
+        Log.debug(f'{vi.sname}: size probe failed: {str(e)}')
+
+
+def is_link_expired(r: ClientResponse, link: str) -> bool:
+    # expired link is either refused or redirected to an html page
+    return r.status in MEDIA_LINK_EXPIRED_STATUSES or (r.url != URL(link) and bool(r.content_type) and 'text' in r.content_type)
+
+
+async def refresh_link(vi: VideoInfo) -> bool:
+    """Fetches new media link of **vi** in the same quality, returns False if it can't be found"""
+    dwn = VideoDownloadWorker.get()
+    Log.info(f'{vi.sffilename}: media link has expired, refreshing...')
+    a_html = await fetch_html(f'{SITE_AJAX_REQUEST_VIDEO % vi.id}?popup_id={2 + vi.id % 10:d}', session=dwn.session, parse=parse_popup,
+                              cache=False)
+    links = {ltext.replace('MP4 ', ''): link for ltext, link in a_html.links} if a_html and a_html.links else {}
+    if vi.quality not in links:
+        Log.error(f'{vi.sffilename}: unable to refresh media link!')
+        return False
+    vi.link = links[vi.quality]
+    return True
+
+
 async def process_video(vi: VideoInfo) -> DownloadResult:
     vi.set_state(VideoInfo.State.ACTIVE)
     res = await download_video(vi)
-    if res not in (DownloadResult.SUCCESS, DownloadResult.FAIL_SKIPPED, DownloadResult.FAIL_ALREADY_EXISTS):
+    if res not in (DownloadResult.SUCCESS, DownloadResult.FAIL_SKIPPED, DownloadResult.FAIL_ALREADY_EXISTS, DownloadResult.FAIL_DEFERRED):
         vi.set_state(VideoInfo.State.FAILED)
     return res
 
@@ -230,7 +296,7 @@ async def download_sceenshot(vi: VideoInfo, scr_num: int) -> DownloadResult:
             raise IOError(f'ERROR: Unable to create subfolder \'{my_folder}\'!')
 
     try:
-        async with await wrap_request(dwn.session, 'GET', my_link) as r:
+        async with await wrap_request(dwn.session, 'GET', my_link, rclass=RequestClass.THUMBNAIL) as r:
             if r.status == 404:
                 Log.error(f'Got 404 for {sname}...!')
                 ret = DownloadResult.FAIL_NOT_FOUND
@@ -241,6 +307,7 @@ async def download_sceenshot(vi: VideoInfo, scr_num: int) -> DownloadResult:
             expected_size = r.content_length
             async with async_open(fullpath, 'wb') as outf:
                 async for chunk in r.content.iter_chunked(4 * Mem.MB):
+                    await BandwidthShaper.consume(len(chunk), True)
                     await outf.write(chunk)
 
             file_size = stat(fullpath).st_size
@@ -263,12 +330,138 @@ async def download_sceenshots(vi: VideoInfo) -> DownloadResult:
     return ret
 
 
+async def write_segment(vi: VideoInfo, segment: Segment, r: ClientResponse, status_checker: ThrottleChecker) -> None:
+    """Writes **segment** of **vi** received in **r** at its offset, segment map is updated as data gets written to disk"""
+    def on_write(size: int) -> None:
+        segment.pos += size
+        if segment.done:
+            vi.segment_map.save()
+        else:
+            vi.segment_map.checkpoint()
+        TransferJournal.progress(vi, size)
+        dwn.account_written(vi, size)
+
+    dwn = VideoDownloadWorker.get()
+
+    status_checker.prepare(r, segment.pos)
+    status_checker.run()
+    read_pos = segment.pos
+    priority = vi.expected_size < SMALL_FILE_SIZE * Mem.MB
+    async with FileWriter(vi.my_fullpath, segment.pos, on_write) as outf:
+        async for chunk in r.content.iter_chunked(1 * Mem.MB):
+            chunk = chunk[:segment.end + 1 - read_pos]
+            await BandwidthShaper.consume(len(chunk), priority)
+            await outf.write(chunk)
+            read_pos += len(chunk)
+            if read_pos > segment.end:
+                break
+    status_checker.reset()
+    if not segment.done:
+        raise IOError(vi.link)
+
+
+async def download_segment(vi: VideoInfo, segment: Segment) -> None:
+    dwn = VideoDownloadWorker.get()
+    policy = RetryPolicy()
+    status_checker = ThrottleChecker(vi, segment)
+    record = TransferJournal.get(vi)
+    while not segment.done:
+        r = None
+        headers = {'Range': segment.range_header}
+        if record and record.validator:
+            headers['If-Range'] = record.validator
+        try:
+            async with await wrap_request(dwn.session, 'GET', vi.link, rclass=RequestClass.MEDIA, headers=headers) as r:
+                if is_link_expired(r, vi.link):
+                    raise MediaLinkExpired(vi.link)
+                if r.status == 200 and 'If-Range' in headers:
+                    raise RemoteFileChanged(vi.link)
+                if r.status != 206:
+                    Log.error(f'{vi.sffilename}: got {r.status:d} for segment {str(segment)}...')
+                    raise IOError(vi.link)
+                await write_segment(vi, segment, r, status_checker)
+        except (RemoteFileChanged, MediaLinkExpired):
+            raise
+        except Exception as e:
+            policy.failed(r, isinstance(e, ClientPayloadError) is False)
+            if r is not None and r.closed is False:
+                r.close()
+            status_checker.reset()
+            if policy.exhausted:
+                raise
+            Log.debug(f'{vi.sffilename}: segment {str(segment)} error #{policy.retries:d}, retrying at {segment.pos:d}...')
+            await policy.backoff(r)
+
+
+async def start_segments(vi: VideoInfo) -> List[Segment]:
+    """Allocates file for segmented download of **vi** and returns its unfinished segments"""
+    segment_map = vi.segment_map  # type: SegmentMap
+    if not path.isfile(vi.my_fullpath) or stat(vi.my_fullpath).st_size != segment_map.total_size:
+        await FileWriter.allocate(vi.my_fullpath, segment_map.total_size)
+    if Config.preallocate:
+        VideoDownloadWorker.get().account_allocated(vi)
+    segment_map.save()
+    vi.set_flag(VideoInfo.Flags.FILE_WAS_CREATED)
+    vi.expected_size = segment_map.total_size
+    vi.last_check_size = vi.start_size = segment_map.done_size
+    vi.last_check_time = vi.start_time = get_elapsed_time_i()
+    segments = [segment for segment in segment_map.segments if not segment.done]
+    starting_str = f' <continuing at {vi.start_size:d}>' if vi.start_size else ''
+    segments_str = f' in {len(segments):d} segment(s)' if len(segment_map.segments) > 1 else ''
+    Log.info(f'Saving{starting_str} {vi.sname} {vi.expected_size / Mem.MB:.2f} Mb to {vi.sffilename}{segments_str}')
+    return segments
+
+
+def finish_segments(vi: VideoInfo) -> None:
+    vi.segment_map.remove()
+    vi.segment_map = None
+    TransferJournal.complete(vi)
+
+
+def restart_download(vi: VideoInfo, reason: str) -> None:
+    """Discards partially downloaded file of **vi** so it can be downloaded from the beginning"""
+    Log.warn(f'{vi.sffilename}: {reason}, restarting download...')
+    if vi.segment_map:
+        vi.segment_map.remove()
+        vi.segment_map = None
+    with open(vi.my_fullpath, 'wb'):
+        pass
+    TransferJournal.forget(vi)
+
+
+async def download_segments(vi: VideoInfo) -> None:
+    """Downloads all the unfinished segments of **vi** simultaneously"""
+    dwn = VideoDownloadWorker.get()
+    segments = await start_segments(vi)
+    dwn.add_to_writes(vi)
+    vi.set_state(VideoInfo.State.WRITING)
+    try:
+        results = await gather(*(download_segment(vi, segment) for segment in segments), return_exceptions=True)
+    finally:
+        dwn.remove_from_writes(vi)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    finish_segments(vi)
+    await store_hash(vi)
+
+
+async def store_hash(vi: VideoInfo, hasher: StreamHasher = None) -> None:
+    """Adds hash of completed **vi** file to its folder manifest. File is hashed from disk if it wasn't hashed while being written"""
+    if not Config.manifest:
+        return
+    digest = hasher.hexdigest() if hasher else await get_running_loop().run_in_executor(WriterPool.get_executor(), hash_file,
+                                                                                        vi.my_fullpath)
+    HashManifest.add(vi.my_folder, vi.filename, digest)
+
+
 async def download_video(vi: VideoInfo) -> DownloadResult:
     dwn = VideoDownloadWorker.get()
-    retries = 0
+    policy = RetryPolicy()
     ret = DownloadResult.SUCCESS
     skip = Config.dm == DOWNLOAD_MODE_SKIP
     status_checker = ThrottleChecker(vi)
+    link_refreshes = 0
 
     if skip is True:
         vi.set_state(VideoInfo.State.DONE)
@@ -298,10 +491,10 @@ async def download_video(vi: VideoInfo) -> DownloadResult:
                     vi.set_state(VideoInfo.State.DONE)
                     return DownloadResult.FAIL_ALREADY_EXISTS
 
-    while (not skip) and retries < CONNECT_RETRIES_BASE:
+    while (not skip) and not policy.exhausted:
         try:
             file_exists = path.isfile(vi.my_fullpath)
-            if file_exists and retries == 0:
+            if file_exists and policy.retries == 0:
                 vi.set_flag(VideoInfo.Flags.ALREADY_EXISTED_EXACT)
             file_size = stat(vi.my_fullpath).st_size if file_exists else 0
 
@@ -317,71 +510,171 @@ async def download_video(vi: VideoInfo) -> DownloadResult:
                         vi.set_state(VideoInfo.State.DONE)
                 break
 
-            hkwargs = {'headers': {'Range': f'bytes={file_size:d}-'}} if file_size > 0 else {}  # type: Dict[str, Dict[str, str]]
-            r = None
-            async with await wrap_request(dwn.session, 'GET', vi.link, **hkwargs) as r:
-                content_len = r.content_length or 0
-                content_range_s = r.headers.get('Content-Range', '/').split('/', 1)
-                content_range = int(content_range_s[1]) if len(content_range_s) > 1 and content_range_s[1].isnumeric() else 1
-                if (content_len == 0 or r.status == 416) and file_size >= content_range:
-                    Log.warn(f'{vi.sfsname} ({vi.quality}) is already completed, size: {file_size:d} ({file_size / Mem.MB:.2f} Mb)')
+            if file_exists and vi.segment_map is None:
+                vi.segment_map = SegmentMap.load(vi.my_fullpath)
+                if vi.segment_map is None and path.isfile(SegmentMap.sidecar_path(vi.my_fullpath)):
+                    # file content can't be trusted without its segment map
+                    SegmentMap.remove_sidecar(vi.my_fullpath)
+                    restart_download(vi, 'segment map is damaged')
+                    file_size = 0
+            if vi.segment_map is None:
+                record = TransferJournal.get(vi) if file_size > 0 else None
+                if record and record.done and file_size == record.size:
+                    Log.info(f'{vi.sfsname} ({vi.quality}) is already completed according to journal, size: {file_size:d}'
+                             f' ({file_size / Mem.MB:.2f} Mb)')
+                    if vi.requested_quality and vi.requested_quality != record.requested:
+                        # file is saved in a fallback quality, remember it so the next run can skip it without scanning
+                        TransferJournal.complete(vi)
                     vi.set_state(VideoInfo.State.DONE)
                     ret = DownloadResult.FAIL_ALREADY_EXISTS
                     break
-                if r.status == 404:
-                    Log.error(f'Got 404 for {vi.sfsname}...!')
-                    retries = CONNECT_RETRIES_BASE - 1
-                    ret = DownloadResult.FAIL_NOT_FOUND
-                if r.content_type and 'text' in r.content_type:
-                    Log.error(f'File not found at {vi.link}!')
-                    raise FileNotFoundError(vi.link)
-
-                status_checker.prepare(r, file_size)
-                vi.expected_size = file_size + content_len
-                vi.last_check_size = vi.start_size = file_size
-                vi.last_check_time = vi.start_time = get_elapsed_time_i()
-                starting_str = f' <continuing at {file_size:d}>' if file_size else ''
-                total_str = f' / {vi.expected_size / Mem.MB:.2f}' if file_size else ''
-                Log.info(f'Saving{starting_str} {vi.sname} {content_len / Mem.MB:.2f}{total_str} Mb to {vi.sffilename}')
-
-                dwn.add_to_writes(vi)
-                vi.set_state(VideoInfo.State.WRITING)
-                status_checker.run()
-                async with async_open(vi.my_fullpath, 'ab') as outf:
-                    vi.set_flag(VideoInfo.Flags.FILE_WAS_CREATED)
-                    async for chunk in r.content.iter_chunked(1 * Mem.MB):
-                        await outf.write(chunk)
-                status_checker.reset()
-                dwn.remove_from_writes(vi)
-
-                file_size = stat(vi.my_fullpath).st_size
-                if vi.expected_size and file_size != vi.expected_size:
-                    Log.error(f'Error: file size mismatch for {vi.sfsname}: {file_size:d} / {vi.expected_size:d}')
-                    raise IOError(vi.link)
+                if record and record.size and file_size > record.size:
+                    restart_download(vi, f'file is larger than expected ({file_size:d} / {record.size:d})')
+                    file_size, record = 0, None
+                hkwargs = {'headers': {'Range': f'bytes={file_size:d}-'}} if file_size > 0 else {}  # type: Dict[str, Dict[str, str]]
+                if record and record.validator:
+                    hkwargs['headers']['If-Range'] = record.validator
+                r = None
+                if vi.expected_size and not dwn.try_reserve_space(vi, vi.expected_size):
+                    return DownloadResult.FAIL_DEFERRED
+                async with await wrap_request(dwn.session, 'GET', vi.link, rclass=RequestClass.MEDIA, **hkwargs) as r:
+                    if is_link_expired(r, vi.link):
+                        raise MediaLinkExpired(vi.link)
+                    content_len = r.content_length or 0
+                    content_range_s = r.headers.get('Content-Range', '/').split('/', 1)
+                    content_range = int(content_range_s[1]) if len(content_range_s) > 1 and content_range_s[1].isnumeric() else 1
+                    if (content_len == 0 or r.status == 416) and file_size >= content_range:
+                        if record and not record.done:
+                            # size matches but journal says the file was never completed
+                            r.close()
+                            restart_download(vi, 'file is not complete according to journal')
+                            continue
+                        Log.warn(f'{vi.sfsname} ({vi.quality}) is already completed, size: {file_size:d} ({file_size / Mem.MB:.2f} Mb)')
+                        TransferJournal.begin(vi, r, file_size, file_size)
+                        TransferJournal.complete(vi)
+                        vi.set_state(VideoInfo.State.DONE)
+                        ret = DownloadResult.FAIL_ALREADY_EXISTS
+                        break
+                    if r.status == 404:
+                        Log.error(f'Got 404 for {vi.sfsname}...!')
+                        policy.give_up()
+                        ret = DownloadResult.FAIL_NOT_FOUND
+                    if r.content_type and 'text' in r.content_type:
+                        Log.error(f'File not found at {vi.link}!')
+                        raise FileNotFoundError(vi.link)
+                    if file_size > 0 and r.status == 200:
+                        # full file is sent instead of requested range
+                        restart_download(vi, 'remote file has changed' if record and record.validator else 'range request was ignored')
+                        file_size = 0
+                    if not dwn.try_reserve_space(vi, file_size + content_len):
+                        # not a failure, connection and download slot are freed, file is requested again once there is enough space
+                        vi.expected_size = file_size + content_len
+                        return DownloadResult.FAIL_DEFERRED
+
+                    if (Config.segments > 1 and file_size == 0 and r.status == 200 and r.headers.get('Accept-Ranges') == 'bytes'
+                            and content_len >= Config.segment_threshold * Mem.MB):
+                        # drop this connection, file is going to be requested in parts
+                        vi.segment_map = SegmentMap.create(vi.my_fullpath, content_len, Config.segments)
+                        TransferJournal.begin(vi, r, content_len, 0)
+                        r.close()
+                    elif Config.preallocate and file_size == 0 and r.status == 200 and content_len > 0:
+                        # written as a single segment so preallocated but unfinished file can be told apart from a complete one
+                        vi.segment_map = SegmentMap.create(vi.my_fullpath, content_len, 1)
+                        TransferJournal.begin(vi, r, content_len, 0)
+                        await start_segments(vi)
+                        dwn.add_to_writes(vi)
+                        vi.set_state(VideoInfo.State.WRITING)
+                        await write_segment(vi, vi.segment_map.segments[0], r, status_checker)
+                        dwn.remove_from_writes(vi)
+                        finish_segments(vi)
+                        await store_hash(vi)
+                        vi.set_state(VideoInfo.State.DONE)
+                        break
+                    else:
+                        status_checker.prepare(r, file_size)
+                        vi.expected_size = file_size + content_len
+                        vi.last_check_size = vi.start_size = file_size
+                        vi.last_check_time = vi.start_time = get_elapsed_time_i()
+                        starting_str = f' <continuing at {file_size:d}>' if file_size else ''
+                        total_str = f' / {vi.expected_size / Mem.MB:.2f}' if file_size else ''
+                        Log.info(f'Saving{starting_str} {vi.sname} {content_len / Mem.MB:.2f}{total_str} Mb to {vi.sffilename}')
+
+                        dwn.add_to_writes(vi)
+                        vi.set_state(VideoInfo.State.WRITING)
+                        status_checker.run()
+                        priority = vi.expected_size < SMALL_FILE_SIZE * Mem.MB
+                        TransferJournal.begin(vi, r, vi.expected_size, file_size)
+                        hasher = StreamHasher() if Config.manifest else None
+                        if hasher and file_size:
+                            await get_running_loop().run_in_executor(WriterPool.get_executor(), hasher.update_from_file,
+                                                                     vi.my_fullpath, file_size)
+
+                        def on_write(size: int) -> None:
+                            TransferJournal.progress(vi, size)
+                            dwn.account_written(vi, size)
+
+                        async with FileWriter(vi.my_fullpath, on_write=on_write, hasher=hasher) as outf:
+                            vi.set_flag(VideoInfo.Flags.FILE_WAS_CREATED)
+                            async for chunk in r.content.iter_chunked(1 * Mem.MB):
+                                await BandwidthShaper.consume(len(chunk), priority)
+                                await outf.write(chunk)
+                        status_checker.reset()
+                        dwn.remove_from_writes(vi)
+
+                        file_size = stat(vi.my_fullpath).st_size
+                        if vi.expected_size and file_size != vi.expected_size:
+                            Log.error(f'Error: file size mismatch for {vi.sfsname}: {file_size:d} / {vi.expected_size:d}')
+                            raise IOError(vi.link)
+
+                        TransferJournal.complete(vi)
+                        await store_hash(vi, hasher)
+                        vi.set_state(VideoInfo.State.DONE)
+                        break
 
-                vi.set_state(VideoInfo.State.DONE)
-                break
+            r = None
+            if not dwn.try_reserve_space(vi, vi.segment_map.total_size):
+                vi.segment_map = None
+                return DownloadResult.FAIL_DEFERRED
+            try:
+                await download_segments(vi)
+            except (RemoteFileChanged, MediaLinkExpired):
+                raise
+            except Exception:
+                policy.give_up()  # segments have their own retries
+                raise
+            vi.set_state(VideoInfo.State.DONE)
+            break
         except Exception as e:
             import sys
             print(sys.exc_info()[0], sys.exc_info()[1])
+            if isinstance(e, MediaLinkExpired) and link_refreshes < LINK_REFRESHES_MAX:
+                # does not count as a failure, download is resumed from the current offset using the new link
+                link_refreshes += 1
+                if await refresh_link(vi):
+                    continue
+            policy.failed(r, isinstance(e, ClientPayloadError) is False)
+            if isinstance(e, RemoteFileChanged):
+                restart_download(vi, 'remote file has changed')
             if (r is None or r.status != 403) and isinstance(e, ClientPayloadError) is False:
-                retries += 1
-                Log.error(f'{vi.sffilename}: error #{retries:d}...')
+                Log.error(f'{vi.sffilename}: error #{policy.retries:d}...')
             if r is not None and r.closed is False:
                 r.close()
             # Network error may be thrown before item is added to active downloads
             if dwn.is_writing(vi):
                 dwn.remove_from_writes(vi)
             status_checker.reset()
-            if retries < CONNECT_RETRIES_BASE:
+            if not policy.exhausted:
                 vi.set_state(VideoInfo.State.DOWNLOADING)
-                await sleep(frand(1.0, 7.0))
+                await policy.backoff(r)
             elif Config.keep_unfinished is False and path.isfile(vi.my_fullpath) and vi.has_flag(VideoInfo.Flags.FILE_WAS_CREATED):
                 Log.error(f'Failed to download {vi.sffilename}. Removing unfinished file...')
                 remove(vi.my_fullpath)
+                if vi.segment_map:
+                    vi.segment_map.remove()
+                TransferJournal.forget(vi)
 
     ret = (ret if ret in (DownloadResult.FAIL_NOT_FOUND, DownloadResult.FAIL_SKIPPED, DownloadResult.FAIL_ALREADY_EXISTS) else
-           DownloadResult.SUCCESS if retries < CONNECT_RETRIES_BASE else
+           DownloadResult.SUCCESS if not policy.exhausted else
            DownloadResult.FAIL_RETRIES)
 
     if Config.save_screenshots:
@@ -393,6 +686,8 @@ async def download_video(vi: VideoInfo) -> DownloadResult:
 
 
 def at_interrupt() -> None:
+    ParserPool.shutdown(False)
+    WriterPool.shutdown(False)
     dwn = VideoDownloadWorker.get()
     if dwn is not None:
         return dwn.at_interrupt()
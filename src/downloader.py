@@ -9,9 +9,9 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 from __future__ import annotations
 from asyncio import Lock as AsyncLock
 from asyncio.queues import Queue as AsyncQueue
-from asyncio.tasks import sleep, as_completed
+from asyncio.tasks import sleep, as_completed, gather
 from os import path, remove, makedirs, stat
-from typing import List, Coroutine, Any, Callable, Optional, Iterable, Union
+from typing import List, Set, Coroutine, Any, Callable, Optional, Iterable, Sequence, Union
 
 from aiohttp import ClientSession
 
@@ -19,10 +19,22 @@ from config import Config
 from defs import (
     DownloadResult, Mem, MAX_VIDEOS_QUEUE_SIZE, DOWNLOAD_QUEUE_STALL_CHECK_TIMER, DOWNLOAD_CONTINUE_FILE_CHECK_TIMER, PREFIX,
     START_TIME, UTF8, LOGGING_FLAGS, CONNECT_TIMEOUT_BASE, DOWNLOAD_POLICY_DEFAULT, NAMING_FLAGS_DEFAULT, DEFAULT_QUALITY,
-    DOWNLOAD_MODE_DEFAULT,
+    DOWNLOAD_MODE_DEFAULT, CONNECT_REQUEST_RATE_DEFAULT, CONNECT_REQUEST_BURST_DEFAULT, REQUEST_CLASSES, CACHE_TTL_PAGES_DEFAULT,
+    CACHE_TTL_VIDEOS_DEFAULT, CACHE_SIZE_DEFAULT, PARSER_MODE_DEFAULT, PARSER_WORKERS_DEFAULT, CONNECTOR_LIMIT_DEFAULT,
+    CONNECTOR_LIMIT_PER_HOST_DEFAULT, CONNECTOR_DNS_TTL_DEFAULT, CONNECTOR_KEEPALIVE_DEFAULT, SOCKET_BUFFER_DEFAULT,
+    REPLAY_LATENCY_DEFAULT, REPLAY_BANDWIDTH_DEFAULT, STREAM_BUFFER_SIZE, SEGMENTS_DEFAULT, SEGMENT_THRESHOLD_DEFAULT,
+    WRITE_BUFFER_DEFAULT, WRITER_WORKERS_DEFAULT, BANDWIDTH_DEFAULT, QUEUE_POLICY_DEFAULT, QUEUE_POLICY_ID,
+    MIN_FREE_SPACE_DEFAULT, SIZE_PROBE_LOOKAHEAD,
 )
+from bwshaper import BandwidthShaper
 from dscanner import VideoScanWorker
+from dspace import DiskSpaceAdmission
+from dwriter import WriteStats
+from journal import TransferJournal
 from logger import Log
+from proxypool import ProxyPool
+from qpolicy import make_queue_policy, project_completion
+from rpolicy import RetryStats
 from util import format_time, get_elapsed_time_i, get_elapsed_time_s, calc_sleep_time
 from vinfo import VideoInfo, get_min_max_ids
 
@@ -41,7 +53,8 @@ class VideoDownloadWorker:
         return VideoDownloadWorker._instance
 
     def __init__(self, sequence: Iterable[VideoInfo], func: Callable[[VideoInfo], Coroutine[Any, Any, DownloadResult]],
-                 filtered_count: int, session: ClientSession) -> None:
+                 filtered_count: int, session: ClientSession, streaming=False,
+                 probe: Callable[[VideoInfo], Coroutine[Any, Any, None]] = None) -> None:
         assert VideoDownloadWorker._instance is None
         VideoDownloadWorker._instance = self
 
@@ -57,11 +70,17 @@ class VideoDownloadWorker:
         self._filtered_count_after = 0
         self._skipped_count = 0
         self._404_count = 0
-        self._minmax_id = get_min_max_ids(self._seq)
+        self._minmax_id = get_min_max_ids(self._seq) if self._seq else (0, 0)
+        self._streaming = streaming
+        self._policy = make_queue_policy(Config.queue_policy)
+        self._space = DiskSpaceAdmission()
+        self._probe = probe
+        self._probed = set()  # type: Set[int]
 
         self._downloads_active = list()  # type: List[VideoInfo]
         self._writes_active = list()  # type: List[str]
         self._failed_items = list()  # type: List[int]
+        self._completed_ids = set()  # type: Set[int]
 
         self._total_queue_size_last = 0
         self._download_queue_size_last = 0
@@ -76,7 +95,16 @@ class VideoDownloadWorker:
         self._downloads_active.append(vi)
         Log.trace(f'[queue] {vi.sname} added to active')
 
+    async def _at_task_defer(self, vi: VideoInfo) -> None:
+        """Download was held for disk space, item waits for its turn again without taking an active slot"""
+        if vi in self._downloads_active:
+            self._downloads_active.remove(vi)
+            Log.trace(f'[queue] {vi.sname} removed from active (deferred)')
+        vi.set_state(VideoInfo.State.QUEUED)
+        self._seq.insert(0, vi)
+
     async def _at_task_finish(self, vi: VideoInfo, result: DownloadResult) -> None:
+        self._space.release(vi)
         if vi in self._downloads_active:
             self._downloads_active.remove(vi)
             Log.trace(f'[queue] {vi.sname} removed from active')
@@ -90,15 +118,23 @@ class VideoDownloadWorker:
             self._failed_items.append(vi.id)
         elif result == DownloadResult.SUCCESS:
             self._downloaded_count += 1
+        if result in (DownloadResult.SUCCESS, DownloadResult.FAIL_ALREADY_EXISTS):
+            self._completed_ids.add(vi.id)
 
     async def _prod(self) -> None:
-        while self.can_fetch_next():
-            if self._queue.full() is False:
+        # queued or active download may be deferred and return to waiting items
+        while self.can_fetch_next() or self.get_workload_size() > 0:
+            # size aware policies pick items right before they start, otherwise queued items would be started in id order
+            slot_free = self._queue.empty() and len(self._downloads_active) < MAX_VIDEOS_QUEUE_SIZE
+            can_queue = self._policy.name == QUEUE_POLICY_ID or slot_free
+            if self._queue.full() is False and can_queue:
                 async with self._lock:
                     vi = await self.try_fetch_next()
                     if vi:
                         vi.set_state(VideoInfo.State.QUEUED)
                         await self._queue.put(vi)
+                if vi is None:
+                    await sleep(0.2)
             else:
                 await sleep(0.2)
 
@@ -113,16 +149,30 @@ class VideoDownloadWorker:
                 vi = await self._queue.get()
                 await self._at_task_start(vi)
                 result = await self._func(vi)
-                await self._at_task_finish(vi, result)
+                if result == DownloadResult.FAIL_DEFERRED:
+                    await self._at_task_defer(vi)
+                else:
+                    await self._at_task_finish(vi, result)
                 self._queue.task_done()
             else:
                 await sleep(0.35)
 
+    async def _size_prober(self) -> None:
+        """Probes sizes of the next SIZE_PROBE_LOOKAHEAD waiting (or already scanned) items while downloads are running"""
+        while self.can_fetch_next():
+            waiting = self._seq + (self._scn.get_scanned() if self._scn else [])
+            window = [vi for vi in waiting[:SIZE_PROBE_LOOKAHEAD] if not vi.expected_size and vi.id not in self._probed]
+            if window:
+                self._probed.update(vi.id for vi in window)
+                await gather(*(self._probe(vi) for vi in window))
+            else:
+                await sleep(0.2)
+
     async def _state_reporter(self) -> None:
         base_sleep_time = calc_sleep_time(3.0)
         force_check_seconds = DOWNLOAD_QUEUE_STALL_CHECK_TIMER
         last_check_seconds = 0
-        while self.get_workload_size() > 0 or self.waiting_for_scanner():
+        while self.get_workload_size() > 0 or self.waiting_for_scanner() or self._streaming:
             await sleep(base_sleep_time if len(self._seq) + self._queue.qsize() > 0 else 1.0)
             queue_size = len(self._seq) + self._queue.qsize() + self.get_scanner_workload_size()
             download_count = len(self._downloads_active)
@@ -142,8 +192,10 @@ class VideoDownloadWorker:
                 wc_threshold = MAX_VIDEOS_QUEUE_SIZE // (2 - int(force_check))
                 if force_check or (queue_size == 0 and download_count == write_count <= wc_threshold):
                     item_states = list()
+                    rate_kb = 0.0
                     for vi in self._downloads_active:
-                        cursize = stat(vi.my_fullpath).st_size if path.isfile(vi.my_fullpath) else 0
+                        cursize = (vi.segment_map.done_size if vi.segment_map else
+                                   stat(vi.my_fullpath).st_size if path.isfile(vi.my_fullpath) else 0)
                         remsize = vi.expected_size - cursize if cursize else 0
                         cursize_str = f'{cursize / Mem.MB:.2f}' if cursize else '???'
                         totalsize_str = f'{vi.expected_size / Mem.MB:.2f}' if vi.expected_size else '???'
@@ -165,14 +217,25 @@ class VideoDownloadWorker:
                                            f' {speed_str} Kb/s, ETA: {eta_str} ({dfull_str})')
                         vi.last_check_size = cursize
                         vi.last_check_time = elapsed_seconds
+                        rate_kb += d_speed_kb
+                    if RetryStats.any():
+                        item_states.append(f' [retry] {RetryStats.report()}')
+                    if WriteStats.any():
+                        item_states.append(f' [write] {WriteStats.report()}')
+                    if BandwidthShaper.enabled():
+                        item_states.append(f' [bandwidth] {BandwidthShaper.report()}')
+                    if Config.size_probe:
+                        item_states.append(f' [queue] {self._report_projection(rate_kb)}')
+                    if self._space.any_held():
+                        item_states.append(f' [disk] {self._space.report()}')
+                    if isinstance(self._session, ProxyPool):
+                        item_states.append(self._session.report())
                     Log.debug('\n'.join(item_states))
 
     async def _continue_file_checker(self) -> None:
         if not Config.store_continue_cmdfile:
             return
-        minmax_id = self._minmax_id
-        continue_file_name = f'{PREFIX}{START_TIME.strftime("%Y-%m-%d_%H_%M_%S")}_{minmax_id[0]:d}-{minmax_id[1]:d}.continue.conf'
-        continue_file_fullpath = f'{Config.dest_base}{continue_file_name}'
+        continue_file_name = continue_file_fullpath = ''
         arglist_base = [
             '-path', Config.dest_base, '-continue', '--store-continue-cmdfile',
             '-log', next(filter(lambda x: int(LOGGING_FLAGS[x], 16) == Config.logging_flags, LOGGING_FLAGS.keys())),
@@ -182,8 +245,46 @@ class VideoDownloadWorker:
             *(('-minscore', Config.min_score) if Config.min_score else ()),
             *(('-naming', Config.naming_flags) if Config.naming_flags != NAMING_FLAGS_DEFAULT else ()),
             *(('-dmode', Config.download_mode) if Config.download_mode != DOWNLOAD_MODE_DEFAULT else ()),
-            *(('-proxy', Config.proxy) if Config.proxy else ()),
+            *(arg for proxy in Config.proxies for arg in ('-proxy', proxy)),
             *(('-throttle', Config.throttle) if Config.throttle else ()),
+            *(('--segments', Config.segments) if Config.segments != SEGMENTS_DEFAULT else ()),
+            *(('--segment-threshold', Config.segment_threshold) if Config.segment_threshold != SEGMENT_THRESHOLD_DEFAULT else ()),
+            *(('--write-buffer', Config.write_buffer) if Config.write_buffer != WRITE_BUFFER_DEFAULT else ()),
+            *(('--writer-workers', Config.writer_workers) if Config.writer_workers != WRITER_WORKERS_DEFAULT else ()),
+            *(('--preallocate',) if Config.preallocate else ()),
+            *(('--drop-cache',) if Config.drop_cache else ()),
+            *(('--fsync',) if Config.fsync else ()),
+            *(('--bandwidth', Config.bandwidth) if Config.bandwidth != BANDWIDTH_DEFAULT else ()),
+            *(('--bandwidth-schedule', ','.join(f'{b // 60:02d}:{b % 60:02d}-{e // 60:02d}:{e % 60:02d}={r:d}'
+                                                for b, e, r in Config.bandwidth_schedule))
+              if Config.bandwidth_schedule else ()),
+            *(('--bandwidth-file', Config.bandwidth_file) if Config.bandwidth_file else ()),
+            *(('--journal', Config.journal) if Config.journal else ()),
+            *(('--manifest',) if Config.manifest else ()),
+            *(('--queue-policy', Config.queue_policy) if Config.queue_policy != QUEUE_POLICY_DEFAULT else ()),
+            *(('--size-probe',) if Config.size_probe else ()),
+            *(('--min-free-space', Config.min_free_space) if Config.min_free_space != MIN_FREE_SPACE_DEFAULT else ()),
+            *(('-rate', Config.request_rate) if Config.request_rate != CONNECT_REQUEST_RATE_DEFAULT else ()),
+            *(('-burst', Config.request_burst) if Config.request_burst != CONNECT_REQUEST_BURST_DEFAULT else ()),
+            *(('--pacing', ','.join(f'{cname}:{":".join(f"{v:g}" for v in Config.pacing[rc])}' for cname, rc in REQUEST_CLASSES.items()))
+              if Config.pacing != Config.default_pacing(Config.request_rate, Config.request_burst, Config.segments) else ()),
+            *(('--conn-limit', Config.conn_limit) if Config.conn_limit != CONNECTOR_LIMIT_DEFAULT else ()),
+            *(('--conn-limit-per-host', Config.conn_limit_per_host)
+              if Config.conn_limit_per_host != CONNECTOR_LIMIT_PER_HOST_DEFAULT else ()),
+            *(('--dns-ttl', Config.dns_ttl) if Config.dns_ttl != CONNECTOR_DNS_TTL_DEFAULT else ()),
+            *(('--keepalive', Config.keepalive) if Config.keepalive != CONNECTOR_KEEPALIVE_DEFAULT else ()),
+            *(('--socket-buffers', ':'.join(str(size) for size in Config.socket_buffers))
+              if Config.socket_buffers != (SOCKET_BUFFER_DEFAULT, SOCKET_BUFFER_DEFAULT) else ()),
+            *(('--record', Config.record) if Config.record else ()),
+            *(('--replay', Config.replay) if Config.replay else ()),
+            *(('--replay-latency', Config.replay_latency) if Config.replay_latency != REPLAY_LATENCY_DEFAULT else ()),
+            *(('--replay-bandwidth', Config.replay_bandwidth) if Config.replay_bandwidth != REPLAY_BANDWIDTH_DEFAULT else ()),
+            *(('-cache',) if Config.cache else ()),
+            *(('--cache-ttl-pages', Config.cache_ttl_pages) if Config.cache_ttl_pages != CACHE_TTL_PAGES_DEFAULT else ()),
+            *(('--cache-ttl-videos', Config.cache_ttl_videos) if Config.cache_ttl_videos != CACHE_TTL_VIDEOS_DEFAULT else ()),
+            *(('--cache-size', Config.cache_size) if Config.cache_size != CACHE_SIZE_DEFAULT else ()),
+            *(('--parser-mode', Config.parser_mode) if Config.parser_mode != PARSER_MODE_DEFAULT else ()),
+            *(('--parser-workers', Config.parser_workers) if Config.parser_workers != PARSER_WORKERS_DEFAULT else ()),
             *(('-timeout', int(Config.timeout.connect)) if int(Config.timeout.connect) != CONNECT_TIMEOUT_BASE else ()),
             *(('-unfinish',) if Config.keep_unfinished else ()),
             *(('-tdump',) if Config.save_tags else ()),
@@ -197,12 +298,19 @@ class VideoDownloadWorker:
         base_sleep_time = calc_sleep_time(3.0)
         write_delay = DOWNLOAD_CONTINUE_FILE_CHECK_TIMER
         last_check_seconds = 0
-        while self.get_workload_size() + self.get_scanner_workload_size() > 0:
+        while self.get_workload_size() + self.get_scanner_workload_size() > 0 or self._streaming:
             elapsed_seconds = get_elapsed_time_i()
+            v_ids = list()  # type: List[int]
             if elapsed_seconds >= write_delay and elapsed_seconds - last_check_seconds >= write_delay:
                 last_check_seconds = elapsed_seconds
                 v_ids = sorted(vi.id for vi in self._seq + [qvi for qvi in getattr(self._queue, '_queue')] + self._downloads_active
                                + self.get_scanner_workload())
+            if v_ids:
+                if not continue_file_name:
+                    # when streaming, ids bounds are unknown until something is fed. File keeps its first name
+                    minid, maxid = self._minmax_id
+                    continue_file_name = f'{PREFIX}{START_TIME.strftime("%Y-%m-%d_%H_%M_%S")}_{minid:d}-{maxid:d}.continue.conf'
+                    continue_file_fullpath = f'{Config.dest_base}{continue_file_name}'
                 arglist = ['-seq', f'({"~".join(f"id={idi:d}" for idi in v_ids)})'] if len(v_ids) > 1 else ['-start', str(v_ids[0])]
                 arglist.extend(arglist_base)
                 try:
@@ -214,7 +322,7 @@ class VideoDownloadWorker:
                 except (OSError, IOError):
                     Log.error(f'Unable to save continue file to \'{continue_file_name}\'!')
             await sleep(base_sleep_time)
-        if path.isfile(continue_file_fullpath):
+        if continue_file_fullpath and path.isfile(continue_file_fullpath):
             Log.trace(f'All files downloaded. Removing continue file \'{continue_file_name}\'...')
             remove(continue_file_fullpath)
 
@@ -224,6 +332,8 @@ class VideoDownloadWorker:
                  f'{f"+{self._scn.get_extra_count():d}" if Config.lookahead else ""} file(s) downloaded, '
                  f'{self._filtered_count_after:d}+{self._filtered_count_pre:d} already existed, '
                  f'{self._skipped_count:d} skipped, {self._404_count:d} not found')
+        if RetryStats.any():
+            Log.info(f'Network: {RetryStats.report()}')
         workload_size = len(self._seq) + self.get_scanner_workload_size()
         if workload_size > 0:
             Log.fatal(f'total queue is still at {workload_size:d} != 0!')
@@ -232,8 +342,32 @@ class VideoDownloadWorker:
         if len(self._failed_items) > 0:
             Log.fatal(f'Failed items:\n{newline.join(str(fi) for fi in sorted(self._failed_items))}')
 
+    async def feed(self, sequence: List[VideoInfo], filtered_count: int) -> None:
+        """
+        Streaming mode: adds more items to process (passing them to the scanner if there is one).
+        Waits while too many items are awaiting their turn already
+        """
+        assert self._streaming
+        while self.get_workload_size() + self.get_scanner_workload_size() - len(self._downloads_active) >= STREAM_BUFFER_SIZE:
+            await sleep(0.2)
+        if sequence:
+            minmax_id = get_min_max_ids(sequence)
+            self._minmax_id = (min(minmax_id[0], self._minmax_id[0] or minmax_id[0]), max(minmax_id[1], self._minmax_id[1]))
+        self._orig_count += len(sequence)
+        self._filtered_count_pre += filtered_count
+        if self._scn:
+            self._scn.feed(sequence)
+        else:
+            self._seq.extend(sequence)
+
+    def finish_feed(self) -> None:
+        self._streaming = False
+        if self._scn:
+            self._scn.finish_feed()
+
     async def run(self) -> None:
-        for cv in as_completed([self._prod(), self._state_reporter(), self._continue_file_checker(),
+        prober = (self._size_prober(),) if self._probe and Config.size_probe else ()
+        for cv in as_completed([self._prod(), self._state_reporter(), self._continue_file_checker(), *prober,
                                *(self._cons() for _ in range(MAX_VIDEOS_QUEUE_SIZE))]):
             await cv
         await self._after_download()
@@ -249,11 +383,23 @@ class VideoDownloadWorker:
             for vi in active_items:
                 Log.debug(f'at_interrupt: trying to remove \'{vi.my_fullpath}\'...')
                 remove(vi.my_fullpath)
+                if vi.segment_map:
+                    vi.segment_map.remove()
+                TransferJournal.forget(vi)
 
     @property
     def session(self) -> ClientSession:
         return self._session
 
+    def try_reserve_space(self, vi: VideoInfo, size: int) -> bool:
+        return self._space.try_reserve(vi, size)
+
+    def account_written(self, vi: VideoInfo, size: int) -> None:
+        self._space.written(vi, size)
+
+    def account_allocated(self, vi: VideoInfo) -> None:
+        self._space.allocated(vi)
+
     def is_writing(self, videst: Union[VideoInfo, str]) -> bool:
         return (videst.my_fullpath if isinstance(videst, VideoInfo) else videst) in self._writes_active
 
@@ -263,6 +409,18 @@ class VideoDownloadWorker:
     def remove_from_writes(self, vi: VideoInfo) -> None:
         self._writes_active.remove(vi.my_fullpath)
 
+    def _report_projection(self, rate_kb: float) -> str:
+        waiting = [vi.expected_size for vi in self._seq + [qvi for qvi in getattr(self._queue, '_queue')] + self.get_scanner_workload()]
+        active = [(vi.expected_size, vi.expected_size - (vi.segment_map.done_size if vi.segment_map else vi.last_check_size))
+                  for vi in self._downloads_active]
+        projection = project_completion(self._policy, waiting, active, rate_kb * Mem.KB)
+        all_str, avg_str = (format_time(int(seconds)) for seconds in projection) if projection else ('??:??:??', '??:??:??')
+        return f'policy: {self._policy.name}, projected completion in {all_str} (average file in {avg_str})'
+
+    def get_completed_ids(self) -> Set[int]:
+        """Returns ids of items downloaded or found already existing"""
+        return self._completed_ids
+
     def waiting_for_scanner(self) -> bool:
         return self._scn and not self._scn.done()
 
@@ -273,18 +431,37 @@ class VideoDownloadWorker:
         return self._scn.get_workload() if self.waiting_for_scanner() else []
 
     def can_fetch_next(self) -> bool:
-        return self.waiting_for_scanner() or not not self._seq
+        return self.waiting_for_scanner() or not not self._seq or self._streaming
 
     def get_workload_size(self) -> int:
         return len(self._seq) + self._queue.qsize() + len(self._downloads_active)
 
+    def _pick(self, items: Sequence[VideoInfo]) -> Optional[int]:
+        """
+        Returns index of the next item in **items** chosen by queue policy. Items of known size are admitted for disk space first,
+        held ones are skipped so items targeting other mounts can start in the meantime
+        """
+        active = [vi.expected_size for vi in self._downloads_active]
+        candidates = [i for i, vi in enumerate(items) if not self._space.is_held(vi)]
+        while candidates:
+            idx = self._policy.pick([items[i].expected_size for i in candidates], active)
+            if idx is None:
+                break
+            vi = items[candidates[idx]]
+            if not vi.expected_size or self._space.try_reserve(vi, vi.expected_size):
+                return candidates[idx]
+            del candidates[idx]
+        return None
+
     async def try_fetch_next(self) -> Optional[VideoInfo]:
-        if self._seq:
-            vi = self._seq[0]
-            del self._seq[0]
+        idx = self._pick(self._seq) if self._seq else None
+        if idx is not None:
+            vi = self._seq[idx]
+            del self._seq[idx]
+        elif self._scn:
+            vi = await self._scn.try_fetch_next(self._pick)
         else:
-            assert self._scn
-            vi = await self._scn.try_fetch_next()
+            vi = None
         return vi
 
 #
@@ -9,7 +9,7 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 from __future__ import annotations
 from asyncio.tasks import sleep
 from collections import deque
-from typing import List, Deque, Coroutine, Any, Callable, Optional, Iterable
+from typing import List, Deque, Coroutine, Any, Callable, Optional, Iterable, Sequence
 
 from config import Config
 from defs import DownloadResult
@@ -31,12 +31,14 @@ class VideoScanWorker:
     def get() -> Optional[VideoScanWorker]:
         return VideoScanWorker._instance
 
-    def __init__(self, sequence: Iterable[VideoInfo], func: Callable[[VideoInfo], Coroutine[Any, Any, DownloadResult]]) -> None:
+    def __init__(self, sequence: Iterable[VideoInfo], func: Callable[[VideoInfo], Coroutine[Any, Any, DownloadResult]],
+                 streaming=False) -> None:
         assert VideoScanWorker._instance is None
         VideoScanWorker._instance = self
 
         self._func = func
         self._seq = deque(sequence)
+        self._streaming = streaming
 
         self._orig_count = len(self._seq)
         self._404_counter = 0
@@ -66,15 +68,28 @@ class VideoScanWorker:
         if len(self._seq) == 1 and not not Config.lookahead:
             self._extend_with_extra()
 
+    def feed(self, sequence: Iterable[VideoInfo]) -> None:
+        """Streaming mode: appends more items to scan queue"""
+        assert self._streaming
+        count = len(self._seq)
+        self._seq.extend(sequence)
+        self._orig_count += len(self._seq) - count
+
+    def finish_feed(self) -> None:
+        self._streaming = False
+
     async def run(self) -> None:
-        while self._seq:
+        while self._seq or self._streaming:
+            if not self._seq:
+                await sleep(0.1)
+                continue
             # Log.trace(f'[queue] {self._seq[0].sname} scan started...')
             result = await self._func(self._seq[0])
             await self._at_scan_finish(self._seq[0], result)
             self._seq.popleft()
 
     def done(self) -> bool:
-        return self.get_workload_size() == 0
+        return self.get_workload_size() == 0 and not self._streaming
 
     def get_workload_size(self) -> int:
         return len(self._seq) + len(self._scanned_items)
@@ -82,6 +97,10 @@ class VideoScanWorker:
     def get_workload(self) -> List[VideoInfo]:
         return list(self._seq) + list(self._scanned_items)
 
+    def get_scanned(self) -> List[VideoInfo]:
+        """Returns scanned items waiting for download"""
+        return list(self._scanned_items)
+
     def get_prescanned_count(self) -> int:
         return len(self._scanned_items)
 
@@ -94,10 +113,16 @@ class VideoScanWorker:
     def register_task_finish_callback(self, callack: Callable[[VideoInfo, DownloadResult], Coroutine[Any, Any, None]]) -> None:
         self._task_finish_callback = callack
 
-    async def try_fetch_next(self) -> Optional[VideoInfo]:
+    async def try_fetch_next(self, pick: Callable[[Sequence[VideoInfo]], Optional[int]] = None) -> Optional[VideoInfo]:
+        """Returns next scanned item chosen by **pick** (first one if not provided), None if nothing can be started"""
         while not self._scanned_items and not self.done():
             await sleep(0.1)
-        return self._scanned_items.popleft() if self._scanned_items else None
+        idx = pick(self._scanned_items) if pick else 0 if self._scanned_items else None
+        if idx is None:
+            return None
+        vi = self._scanned_items[idx]
+        del self._scanned_items[idx]
+        return vi
 
 #
 #
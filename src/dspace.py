@@ -0,0 +1,96 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from os import path, stat
+from shutil import disk_usage
+from time import monotonic
+from typing import Dict, List, Tuple
+
+from config import Config
+from defs import Mem, DISK_SPACE_CHECK_INTERVAL
+from logger import Log
+from vinfo import VideoInfo
+
+__all__ = ('DiskSpaceAdmission',)
+
+
+def allocated_size(filepath: str) -> int:
+    """Returns disk space already taken by **filepath** (preallocated and sparse files are accounted properly where possible)"""
+    if not path.isfile(filepath):
+        return 0
+    st = stat(filepath)
+    return st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+
+
+class DiskSpaceAdmission:
+    """
+    Disk space admission control for downloads. Every download reserves its file size on the mount of its destination folder
+    before it starts and is held while free space minus space reserved by other downloads on that mount would drop below
+    the minimum. Held download is checked again no sooner than DISK_SPACE_CHECK_INTERVAL later.
+    Reserved space shrinks as file data gets written (see **written()**)
+    """
+    def __init__(self) -> None:
+        self._reserved = dict()  # type: Dict[int, List[int]]  # id: [device, bytes yet to be written]
+        self._held = dict()  # type: Dict[int, Tuple[int, float]]  # id: (device, last check time)
+
+    def _outstanding(self, device: int, exclude_id: int) -> int:
+        """Returns amount of bytes yet to be written by downloads reserved on **device**"""
+        return sum(remaining for idi, (dev, remaining) in self._reserved.items() if dev == device and idi != exclude_id)
+
+    def try_reserve(self, vi: VideoInfo, size: int) -> bool:
+        """Reserves space for **vi** file of **size** bytes, returns False if download has to be held"""
+        try:
+            device = stat(vi.my_folder).st_dev
+            free = disk_usage(vi.my_folder).free
+        except OSError as e:
+            Log.debug(f'{vi.sffilename}: unable to check disk space ({str(e)}), ignored')
+            return True
+        need = max(0, size - allocated_size(vi.my_fullpath))
+        reserved = self._outstanding(device, vi.id)
+        if free - reserved - need < Config.min_free_space * Mem.MB:
+            if vi.id not in self._held:
+                Log.warn(f'{vi.sffilename}: not enough disk space in \'{vi.my_folder}\' (need {need / Mem.MB:.2f} Mb,'
+                         f' free {free / Mem.MB:.2f} Mb, reserved {reserved / Mem.MB:.2f} Mb), waiting...')
+            self._reserved.pop(vi.id, None)
+            self._held[vi.id] = (device, monotonic())
+            return False
+        if self._held.pop(vi.id, None) is not None:
+            Log.info(f'{vi.sffilename}: disk space is available, resuming...')
+        self._reserved[vi.id] = [device, need]
+        return True
+
+    def is_held(self, vi: VideoInfo) -> bool:
+        """Returns True if **vi** is held and it's not yet time to check it again"""
+        return vi.id in self._held and monotonic() - self._held[vi.id][1] < DISK_SPACE_CHECK_INTERVAL
+
+    def written(self, vi: VideoInfo, size: int) -> None:
+        """Accounts **size** bytes written to **vi** file, called from file writer"""
+        reservation = self._reserved.get(vi.id)
+        if reservation is not None:
+            reservation[1] = max(0, reservation[1] - size)
+
+    def allocated(self, vi: VideoInfo) -> None:
+        """Accounts **vi** file preallocated to its full size, nothing is left to reserve"""
+        reservation = self._reserved.get(vi.id)
+        if reservation is not None:
+            reservation[1] = 0
+
+    def release(self, vi: VideoInfo) -> None:
+        self._reserved.pop(vi.id, None)
+        self._held.pop(vi.id, None)
+
+    def any_held(self) -> bool:
+        return not not self._held
+
+    def report(self) -> str:
+        return (f'held: {len(self._held):d} on {len({dev for dev, _ in self._held.values()}):d} mount(s),'
+                f' reserved: {len(self._reserved):d} file(s) on {len({dev for dev, _ in self._reserved.values()}):d} mount(s)')
+
+#
+#
+#########################################
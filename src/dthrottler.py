@@ -13,16 +13,20 @@ from typing import Optional, Deque, Union
 
 from aiohttp import ClientResponse
 
+from bwshaper import BandwidthShaper
 from config import Config
 from defs import Mem, DOWNLOAD_STATUS_CHECK_TIMER
 from downloader import VideoDownloadWorker
 from logger import Log
+from segments import Segment
 from vinfo import VideoInfo
 
 
 class ThrottleChecker:
-    def __init__(self, vi: VideoInfo) -> None:
+    def __init__(self, vi: VideoInfo, segment: Segment = None) -> None:
         self._vi = vi
+        self._segment = segment
+        self._name = f'{vi.sfsname}{f" [{str(segment)}]" if segment else ""}'
         self._init_size = 0
         self._slow_download_amount_threshold = ThrottleChecker._orig_threshold()
         self._interrupted_speeds = deque(maxlen=3)  # type: Deque[float]
@@ -72,16 +76,19 @@ class ThrottleChecker:
             while True:
                 await sleep(float(DOWNLOAD_STATUS_CHECK_TIMER))
                 if not dwn.is_writing(dest):  # finished already
-                    Log.error(f'ThrottleChecker: {self._vi.sfsname} checker is still running for finished download!')
+                    Log.error(f'ThrottleChecker: {self._name} checker is still running for finished download!')
                     break
                 if self._response is None:
-                    Log.debug(f'ThrottleChecker: {self._vi.sfsname} self._response is None...')
+                    Log.debug(f'ThrottleChecker: {self._name} self._response is None...')
                     continue
-                file_size = stat(dest).st_size if path.isfile(dest) else 0
+                file_size = self._segment.pos if self._segment else stat(dest).st_size if path.isfile(dest) else 0
                 last_speed = (file_size - last_size) / Mem.KB / DOWNLOAD_STATUS_CHECK_TIMER
                 self._speeds.append(f'{last_speed:.2f} KB/s')
-                if file_size < last_size + self._slow_download_amount_threshold:
-                    Log.warn(f'ThrottleChecker: {self._vi.sfsname} check failed at {file_size:d} ({last_speed:.2f} KB/s)! '
+                if BandwidthShaper.limiting():
+                    # slowed down on purpose
+                    Log.trace(f'ThrottleChecker: {self._name} is shaped at {last_speed:.2f} KB/s, check skipped')
+                elif file_size < last_size + self._slow_download_amount_threshold:
+                    Log.warn(f'ThrottleChecker: {self._name} check failed at {file_size:d} ({last_speed:.2f} KB/s)! '
                              f'Interrupting current try...')
                     self._response.connection.transport.abort()  # abort download task (forcefully - close connection)
                     # calculate normalized threshold if needed
@@ -98,7 +105,7 @@ class ThrottleChecker:
             pass
 
     def __str__(self) -> str:
-        return f'{self._vi.sfsname} (orig size {self._init_size / Mem.MB:.2f} MB): {", ".join(self._speeds)}'
+        return f'{self._name} (orig size {self._init_size / Mem.MB:.2f} MB): {", ".join(self._speeds)}'
 
     __repr__ = __str__
 
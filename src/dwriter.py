@@ -0,0 +1,225 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from asyncio import Event, Task, CancelledError, get_running_loop, wrap_future
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import path, fsync
+from time import monotonic
+from typing import BinaryIO, Callable, Deque, Optional
+
+from config import Config
+from defs import Mem
+from manifest import StreamHasher
+from util import fallocate, fadvise_dontneed
+
+__all__ = ('FileWriter', 'WriterPool', 'WriteStats')
+
+
+class WriteStats:
+    """
+    Disk writes counters for monitoring, accumulated for the whole run\n
+    **Static**
+    """
+    writes = 0
+    bytes_written = 0
+    total_latency = 0.0
+    max_latency = 0.0
+    queued_bytes = 0
+    max_queued_bytes = 0
+    backpressure_waits = 0
+
+    @staticmethod
+    def any() -> bool:
+        return WriteStats.writes > 0
+
+    @staticmethod
+    def report() -> str:
+        writes = max(1, WriteStats.writes)
+        return (f'writes: {WriteStats.writes:d}, avg {WriteStats.bytes_written / writes / Mem.KB:.0f} Kb,'
+                f' latency avg {WriteStats.total_latency * 1000 / writes:.1f}ms, max {WriteStats.max_latency * 1000:.1f}ms,'
+                f' queued: {WriteStats.queued_bytes / Mem.MB:.2f} Mb (max {WriteStats.max_queued_bytes / Mem.MB:.2f} Mb),'
+                f' reader waits: {WriteStats.backpressure_waits:d}')
+
+    @staticmethod
+    def reset() -> None:
+        WriteStats.writes = WriteStats.bytes_written = WriteStats.queued_bytes = WriteStats.max_queued_bytes = 0
+        WriteStats.backpressure_waits = 0
+        WriteStats.total_latency = WriteStats.max_latency = 0.0
+
+
+class WriterPool:
+    """
+    Threads performing blocking disk writes for all the file writers\n
+    **Static**
+    """
+    _executor = None  # type: Optional[ThreadPoolExecutor]
+
+    @staticmethod
+    def get_executor() -> ThreadPoolExecutor:
+        if WriterPool._executor is None:
+            WriterPool._executor = ThreadPoolExecutor(Config.writer_workers, 'FileWriter')
+        return WriterPool._executor
+
+    @staticmethod
+    def shutdown(wait=True) -> None:
+        if WriterPool._executor is not None:
+            WriterPool._executor.shutdown(wait)
+            WriterPool._executor = None
+
+
+class FileWriter:
+    """
+    Write-behind file writer: chunks are queued by the network reader and written by the writer pool in the background,
+    everything queued by the time previous write is completed is coalesced into a single sequential write.
+    Reader has to wait once write buffer is full. Writes go to the end of file or, if **offset** is provided, start at it.
+    **on_write** is called with the size of each completed write. If **hasher** is provided written data is hashed by writer thread\n
+    Usage: 'async with FileWriter(...) as outf:' - remaining data is flushed at exit, unless cancelled
+    """
+    def __init__(self, filepath: str, offset: int = None, on_write: Callable[[int], None] = None, hasher: StreamHasher = None) -> None:
+        self._filepath = filepath
+        self._offset = offset
+        self._on_write = on_write
+        self._hasher = hasher
+        self._chunks = deque()  # type: Deque[bytes]
+        self._queued = 0
+        self._has_data = Event()
+        self._has_space = Event()
+        self._closing = False
+        self._error = None  # type: Optional[BaseException]
+        self._writer = None  # type: Optional[Task]
+        self._start = 0
+        self._written = 0
+
+    async def __aenter__(self) -> FileWriter:
+        self._writer = get_running_loop().create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        # data received before a network error is still valid
+        if exc_type is None or issubclass(exc_type, Exception):
+            await self.flush()
+        else:
+            await self._abort()
+
+    @staticmethod
+    async def allocate(filepath: str, size: int) -> None:
+        """Creates or resizes file to **size**, disk space is reserved for it if preallocation is enabled"""
+        def allocate_sync() -> None:
+            with open(filepath, 'r+b' if path.isfile(filepath) else 'wb') as outf:
+                outf.truncate(size)
+                if Config.preallocate:
+                    fallocate(outf.fileno(), size)
+        await get_running_loop().run_in_executor(WriterPool.get_executor(), allocate_sync)
+
+    def _open(self) -> BinaryIO:
+        if self._offset is None:
+            outf = open(self._filepath, 'ab', buffering=0)
+        else:
+            outf = open(self._filepath, 'r+b', buffering=0)
+            outf.seek(self._offset)
+        self._start = outf.tell()
+        return outf
+
+    def _write(self, outf: BinaryIO, data: bytes) -> None:
+        outf.write(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+        if Config.drop_cache and self._written:
+            # previous write has most likely reached the disk by now
+            fadvise_dontneed(outf.fileno(), self._start, self._written)
+        self._written += len(data)
+
+    def _close(self, outf: BinaryIO) -> None:
+        try:
+            if Config.fsync:
+                fsync(outf.fileno())
+            if Config.drop_cache:
+                fadvise_dontneed(outf.fileno(), self._start, self._written)
+        finally:
+            outf.close()
+
+    def _dequeue(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        WriteStats.queued_bytes -= self._queued
+        self._queued = 0
+        self._has_space.set()
+        return data
+
+    async def _run(self) -> None:
+        loop = get_running_loop()
+        executor = WriterPool.get_executor()
+        outf = None  # type: Optional[BinaryIO]
+        write_future = None  # type: Optional[Future]
+        try:
+            outf = await loop.run_in_executor(executor, self._open)
+            while True:
+                await self._has_data.wait()
+                self._has_data.clear()
+                while self._chunks:
+                    data = self._dequeue()
+                    start = monotonic()
+                    write_future = executor.submit(self._write, outf, data)
+                    await wrap_future(write_future)
+                    latency = monotonic() - start
+                    WriteStats.writes += 1
+                    WriteStats.bytes_written += len(data)
+                    WriteStats.total_latency += latency
+                    WriteStats.max_latency = max(WriteStats.max_latency, latency)
+                    if self._on_write:
+                        self._on_write(len(data))
+                if self._closing:
+                    break
+            outf, closing_outf = None, outf
+            await loop.run_in_executor(executor, self._close, closing_outf)
+        except CancelledError:
+            raise
+        except Exception as e:
+            self._error = e
+        finally:
+            self._dequeue()
+            if outf is not None:
+                if write_future is not None and not write_future.done():
+                    # cancelled while writing, file can only be closed once the write is completed
+                    write_future.add_done_callback(lambda _: outf.close())
+                else:
+                    outf.close()
+
+    async def write(self, chunk: bytes) -> None:
+        while self._queued >= Config.write_buffer * Mem.MB and self._error is None:
+            WriteStats.backpressure_waits += 1
+            self._has_space.clear()
+            await self._has_space.wait()
+        if self._error is not None:
+            raise self._error
+        self._chunks.append(chunk)
+        self._queued += len(chunk)
+        WriteStats.queued_bytes += len(chunk)
+        WriteStats.max_queued_bytes = max(WriteStats.max_queued_bytes, WriteStats.queued_bytes)
+        self._has_data.set()
+
+    async def flush(self) -> None:
+        """Waits for all the queued data to be written and closes the file"""
+        self._closing = True
+        self._has_data.set()
+        await self._writer
+        if self._error is not None:
+            raise self._error
+
+    async def _abort(self) -> None:
+        self._writer.cancel()
+        try:
+            await self._writer
+        except CancelledError:
+            pass
+
+#
+#
+#########################################
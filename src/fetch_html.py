@@ -6,106 +6,213 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 #
 #
 
-from asyncio import Lock as AsyncLock, sleep, get_running_loop
-from random import uniform as frand
-from typing import Optional, List
+from asyncio import TimeoutError as AsyncTimeoutError
+from inspect import signature
+from socket import socket, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+from typing import Optional, Callable, Tuple, Union
 from urllib.parse import urlparse
 
-from aiohttp import ClientSession, ClientResponse, TCPConnector
+from aiohttp import ClientSession, ClientResponse, ClientError, TCPConnector
 from aiohttp_socks import ProxyConnector
-from bs4 import BeautifulSoup
 from python_socks import ProxyType
 
 from config import Config
-from defs import Mem, UTF8, CONNECT_RETRIES_BASE, DEFAULT_HEADERS, CONNECT_REQUEST_DELAY, MAX_VIDEOS_QUEUE_SIZE, MAX_SCAN_QUEUE_SIZE
+from defs import (
+    RequestClass, Mem, CONNECT_RETRIES_BASE, DEFAULT_HEADERS, MAX_VIDEOS_QUEUE_SIZE, MAX_SCAN_QUEUE_SIZE, SCREENSHOTS_COUNT,
+    MEDIA_LINK_EXPIRED_STATUSES, SIZE_PROBE_LOOKAHEAD,
+)
+from hcache import ResponseCache
+from hparser import HtmlT, ParserPool, make_soup
 from logger import Log
-
-__all__ = ('make_session', 'wrap_request', 'fetch_html')
+from proxypool import ProxyPool
+from rlimiter import RequestLimiter
+from rpolicy import RetryPolicy, CircuitBreaker, is_failure_status
+from sflight import SingleFlight
+from transport import ResponseArchive, ReplaySession, make_recorder
+
+__all__ = ('make_session', 'wrap_request', 'fetch_html', 'calc_connection_limit', 'ResponseContext', 'html_flights')
+
+html_flights = SingleFlight()
+
+
+def calc_connection_limit() -> int:
+    """Connections needed for all request classes to reach their limits simultaneously, unless limited explicitly"""
+    if Config.conn_limit:
+        return Config.conn_limit
+    api_limit = Config.pacing[RequestClass.API][2] or MAX_SCAN_QUEUE_SIZE + 1
+    media_limit = Config.pacing[RequestClass.MEDIA][2] or MAX_VIDEOS_QUEUE_SIZE * max(1, Config.segments)
+    thumbnail_limit = (Config.pacing[RequestClass.THUMBNAIL][2] or SCREENSHOTS_COUNT) if Config.save_screenshots else 0
+    probe_limit = (Config.pacing[RequestClass.PROBE][2] or SIZE_PROBE_LOOKAHEAD) if Config.size_probe else 0
+    return api_limit + media_limit + thumbnail_limit + probe_limit
+
+
+def make_socket_factory(buffers: Tuple[int, int]) -> Callable[[tuple], socket]:
+    rcvbuf, sndbuf = buffers
+
+    def socket_factory(addr_info: tuple) -> socket:
+        family, stype, proto, _, _ = addr_info
+        sock = socket(family=family, type=stype, proto=proto)
+        if rcvbuf:
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, rcvbuf * Mem.KB)
+        if sndbuf:
+            sock.setsockopt(SOL_SOCKET, SO_SNDBUF, sndbuf * Mem.KB)
+        return sock
+    return socket_factory
+
+
+def make_connector(proxy: Optional[str]) -> TCPConnector:
+    conn_kwargs = dict(limit=calc_connection_limit(), limit_per_host=Config.conn_limit_per_host, ttl_dns_cache=Config.dns_ttl,
+                       keepalive_timeout=Config.keepalive)
+    if proxy:
+        pp = urlparse(proxy)
+        ptype = ProxyType.SOCKS5 if pp.scheme in ('socks5', 'socks5h') else ProxyType.HTTP
+        return ProxyConnector(proxy_type=ptype, host=pp.hostname, port=pp.port, **conn_kwargs)
+    if any(Config.socket_buffers):
+        if 'socket_factory' in signature(TCPConnector.__init__).parameters:
+            conn_kwargs.update(socket_factory=make_socket_factory(Config.socket_buffers))
+        else:
+            Log.warn('Warning: installed aiohttp version does not support socket options, socket buffer sizes are ignored')
+    return TCPConnector(**conn_kwargs)
 
 
-class RequestQueue:
+def make_session() -> Union[ClientSession, ProxyPool, ReplaySession]:
     """
-    Request delayed queue wrapper
+    Creates a session, or a proxy pool if more than one proxy is configured.
+    In replay mode no connections are made, responses are served from the recorded archive
     """
-    _queue = list()  # type: List[str]
-    _ready = True
-    _lock = AsyncLock()
-
-    @staticmethod
-    async def _reset() -> None:
-        await sleep(frand(CONNECT_REQUEST_DELAY, CONNECT_REQUEST_DELAY + 0.75))
-        RequestQueue._ready = True
-
-    @staticmethod
-    async def until_ready(url: str) -> None:
-        """Pauses request until base delay passes (since last request)"""
-        RequestQueue._queue.append(url)
-        while RequestQueue._ready is False or RequestQueue._queue[0] != url:
-            await sleep(0.2)
-        async with RequestQueue._lock:
-            del RequestQueue._queue[0]
-            RequestQueue._ready = False
-            get_running_loop().create_task(RequestQueue._reset())
-
-
-def make_session() -> ClientSession:
-    if Config.proxy:
-        pp = urlparse(Config.proxy)
-        ptype = ProxyType.SOCKS5 if pp.scheme in ('socks5', 'socks5h') else ProxyType.HTTP
-        connector = ProxyConnector(limit=MAX_VIDEOS_QUEUE_SIZE + MAX_SCAN_QUEUE_SIZE, proxy_type=ptype, host=pp.hostname, port=pp.port)
+    if Config.replay:
+        Log.info(f'Replaying recorded responses from \'{Config.replay}\'...')
+        s = ReplaySession(ResponseArchive(Config.replay))
     else:
-        connector = TCPConnector(limit=MAX_VIDEOS_QUEUE_SIZE + MAX_SCAN_QUEUE_SIZE)
-    s = ClientSession(connector=connector, read_bufsize=Mem.MB)
+        Log.trace(f'Connection pool: limit {calc_connection_limit():d}, per host {Config.conn_limit_per_host:d}'
+                  f'{f", {len(Config.proxies):d} proxies" if len(Config.proxies) > 1 else ""}')
+        trace_configs = [make_recorder(ResponseArchive(Config.record))] if Config.record else None
+        if len(Config.proxies) > 1:
+            s = ProxyPool(Config.proxies, lambda proxy, cookie_jar: ClientSession(
+                connector=make_connector(proxy), cookie_jar=cookie_jar, read_bufsize=Mem.MB, trace_configs=trace_configs))
+        else:
+            s = ClientSession(connector=make_connector(Config.proxy), read_bufsize=Mem.MB, trace_configs=trace_configs)
     s.cookie_jar.update_cookies({'kt_rt_popAccess': '1', 'kt_tcookie': '1', 'kt_is_visited': '1'})
     if Config.session_id:
         s.cookie_jar.update_cookies({'PHPSESSID': Config.session_id, 'kt_member': '1'})
     return s
 
 
-async def wrap_request(s: ClientSession, method: str, url: str, **kwargs) -> ClientResponse:
-    """Queues request, updating headers/proxies beforehand, and returns the response"""
-    if Config.nodelay is False:
-        await RequestQueue.until_ready(url)
-    s.headers.update(DEFAULT_HEADERS.copy())
-    if 'timeout' not in kwargs:
-        kwargs.update(timeout=Config.timeout)
-    r = await s.request(method, url, **kwargs)
-    return r
+class ResponseContext:
+    """
+    Wraps response returned by **wrap_request()**, keeps its request class slot taken until response is closed.
+    Reports request completion to proxy pool if request was made through one\n
+    Usage: 'async with await wrap_request(...) as r:'
+    """
+    def __init__(self, response: ClientResponse, rclass: RequestClass, generation: int, s: Union[ClientSession, ProxyPool]) -> None:
+        self._response = response
+        self._rclass = rclass
+        self._generation = generation
+        self._session = s
+
+    async def __aenter__(self) -> ClientResponse:
+        return self._response
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        try:
+            await self._response.__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            RequestLimiter.release(self._rclass, self._generation)
+            if isinstance(self._session, ProxyPool):
+                failed = exc_type is not None and issubclass(exc_type, (ClientError, AsyncTimeoutError))
+                self._session.response_closed(self._response, failed)
 
 
-async def fetch_html(url: str, *, tries=0, session: ClientSession) -> Optional[BeautifulSoup]:
+async def wrap_request(s: Union[ClientSession, ProxyPool], method: str, url: str, *, rclass=RequestClass.API, **kwargs) -> ResponseContext:
+    """
+    Queues request within its request class, updating headers/proxies beforehand, and returns the response context.
+    Request is paused while its host's circuit breaker is open, request outcome is reported to it (expired media link is not a failure)
+    """
+    breaker = CircuitBreaker.get(url)
+    probe = await breaker.until_closed()
+    try:
+        generation = await RequestLimiter.until_ready(url, rclass)
+    except BaseException:
+        breaker.abandon(probe)
+        raise
+    try:
+        s.headers.update(DEFAULT_HEADERS.copy())
+        if 'timeout' not in kwargs:
+            kwargs.update(timeout=Config.timeout)
+        r = await s.request(method, url, **kwargs)
+    except Exception:
+        breaker.record(False, probe)
+        RequestLimiter.release(rclass, generation)
+        raise
+    except BaseException:
+        breaker.abandon(probe)
+        RequestLimiter.release(rclass, generation)
+        raise
+    if rclass == RequestClass.MEDIA and r.status in MEDIA_LINK_EXPIRED_STATUSES:
+        # expired media link is refreshed by downloader, it says nothing about the host
+        breaker.abandon(probe)
+    else:
+        breaker.record(not is_failure_status(r.status), probe)
+    return ResponseContext(r, rclass, generation, s)
+
+
+async def fetch_html(url: str, *, tries=0, session: ClientSession, parse: Callable[[bytes], HtmlT] = make_soup,
+                     cache=True) -> Optional[HtmlT]:
+    """
+    Fetches html page and returns it processed by **parse** (full document tree by default).
+    Parsing is done according to configured parser mode, see **ParserPool**.
+    Concurrent calls for the same url and **parse** share a single request and result.
+    If **cache** is False cached response is not used (but still updated)
+    """
+    if html_flights.in_flight((url, parse, cache)):
+        Log.trace(f'[single-flight] joining in-flight request: {url}')
+    return await html_flights.run((url, parse, cache), lambda: _fetch_html(url, tries, session, parse, cache))
+
+
+async def _fetch_html(url: str, tries: int, session: ClientSession, parse: Callable[[bytes], HtmlT], cache: bool) -> Optional[HtmlT]:
     # very basic, minimum validation
     tries = tries or CONNECT_RETRIES_BASE
 
+    cached = ResponseCache.get(url) if ResponseCache.enabled() and cache else None
+    if cached is not None and cached.fresh:
+        Log.trace(f'[cache] hit: {url}')
+        return await ParserPool.run(parse, cached.content)
+
+    headers = {'Connection': 'keep-alive', 'X-fancyBox': 'true', 'X-Requested-With': 'XMLHttpRequest'}
+    if cached is not None:
+        headers.update(cached.revalidation_headers)
+
     r = None
-    retries = 0
-    retries_403_local = 0
-    while retries < tries:
+    policy = RetryPolicy(tries)
+    while not policy.exhausted:
         try:
-            async with await wrap_request(
-                    session, 'GET', url,
-                    headers={'Connection': 'keep-alive', 'X-fancyBox': 'true', 'X-Requested-With': 'XMLHttpRequest'}) as r:
+            async with await wrap_request(session, 'GET', url, headers=headers) as r:
                 if r.status != 404:
                     r.raise_for_status()
-                content = await r.read()
-                if retries_403_local > 0:
-                    Log.trace(f'fetch_html success: took {retries_403_local:d} tries...')
-                return BeautifulSoup(content, 'html.parser', from_encoding=UTF8)
+                if r.status == 304 and cached is not None:
+                    Log.trace(f'[cache] not modified: {url}')
+                    ResponseCache.revalidated(cached)
+                    content = cached.content
+                else:
+                    content = await r.read()
+                    if r.status == 200 and ResponseCache.enabled():
+                        ResponseCache.store(url, content, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+                if policy.retries_403 > 0:
+                    Log.trace(f'fetch_html success: took {policy.retries_403:d} tries...')
+            # response is released before parsing
+            return await ParserPool.run(parse, content)
         except Exception:
             if r is not None and '404.' in str(r.url):
                 Log.error('ERROR: 404')
                 assert False
             elif r is not None:
                 Log.error(f'fetch_html exception: status {r.status:d}')
-            if r is None or r.status != 403:
-                retries += 1
-            elif r is not None and r.status == 403:
-                retries_403_local += 1
-            if retries < tries:
-                await sleep(frand(1.0, 7.0))
+            policy.failed(r)
+            if not policy.exhausted:
+                await policy.backoff(r)
             continue
 
-    if retries >= tries:
+    if policy.exhausted:
         errmsg = f'Unable to connect. Aborting {url}'
         Log.error(errmsg)
     elif r is None:
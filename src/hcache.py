@@ -0,0 +1,177 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from collections import OrderedDict
+from hashlib import sha1
+from json import loads, dumps
+from os import path, listdir, makedirs, remove, stat, utime
+from time import time
+from typing import Dict, Optional, Tuple
+
+from config import Config
+from defs import Mem, UTF8, CACHE_DIR_NAME, SITE_AJAX_REQUEST_VIDEO
+from logger import Log
+
+__all__ = ('CacheEntry', 'ResponseCache')
+
+BODY_EXT = 'html'
+META_EXT = 'json'
+POPUP_URL_BASE = SITE_AJAX_REQUEST_VIDEO[:SITE_AJAX_REQUEST_VIDEO.find('%')]
+
+
+class CacheEntry:
+    def __init__(self, url: str, content: bytes, fetch_time: float, etag: str, last_modified: str) -> None:
+        self.url = url
+        self.content = content
+        self.fetch_time = fetch_time
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def is_video_info(self) -> bool:
+        return self.url.startswith(POPUP_URL_BASE)
+
+    @property
+    def ttl(self) -> int:
+        return 60 * (Config.cache_ttl_videos if self.is_video_info else Config.cache_ttl_pages)
+
+    @property
+    def fresh(self) -> bool:
+        return time() - self.fetch_time < self.ttl
+
+    @property
+    def revalidation_headers(self) -> Dict[str, str]:
+        headers = dict()  # type: Dict[str, str]
+        if self.is_video_info:
+            # 'not modified' video info would still hold expired media links, always fetch it anew
+            return headers
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Persistent html response cache stored in base destination folder. Keyed by url, evicts least recently used entries
+    once total size exceeds configured limit. Last access time is kept as body file modification time\n
+    **Static**
+    """
+    _folder = ''
+    _entries = OrderedDict()  # type: OrderedDict[str, int]
+    _total_size = 0
+
+    @staticmethod
+    def enabled() -> bool:
+        return not not Config.cache
+
+    @staticmethod
+    def _init() -> None:
+        folder = f'{Config.dest_base}{CACHE_DIR_NAME}/'
+        if ResponseCache._folder == folder:
+            return
+        ResponseCache._folder = folder
+        ResponseCache._entries.clear()
+        ResponseCache._total_size = 0
+        if not path.isdir(folder):
+            return
+        bodies = list()
+        for fname in listdir(folder):
+            if fname.endswith(f'.{BODY_EXT}'):
+                st = stat(f'{folder}{fname}')
+                bodies.append((st.st_mtime, fname[:-len(BODY_EXT) - 1], st.st_size))
+        for _, key, size in sorted(bodies):
+            ResponseCache._entries[key] = size
+            ResponseCache._total_size += size
+        Log.debug(f'[cache] {len(ResponseCache._entries):d} entries, {ResponseCache._total_size / Mem.MB:.2f} MB')
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return sha1(url.encode(UTF8)).hexdigest()
+
+    @staticmethod
+    def _paths(key: str) -> Tuple[str, str]:
+        return f'{ResponseCache._folder}{key}.{BODY_EXT}', f'{ResponseCache._folder}{key}.{META_EXT}'
+
+    @staticmethod
+    def _drop(key: str) -> None:
+        ResponseCache._total_size -= ResponseCache._entries.pop(key, 0)
+        for fullpath in ResponseCache._paths(key):
+            try:
+                remove(fullpath)
+            except OSError:
+                pass
+
+    @staticmethod
+    def get(url: str) -> Optional[CacheEntry]:
+        """Returns cached entry for url, fresh or not, or None if url is not cached"""
+        ResponseCache._init()
+        key = ResponseCache._key(url)
+        if key not in ResponseCache._entries:
+            return None
+        body_path, meta_path = ResponseCache._paths(key)
+        try:
+            with open(meta_path, 'rt', encoding=UTF8) as mfile:
+                meta = loads(mfile.read())
+            with open(body_path, 'rb') as bfile:
+                content = bfile.read()
+        except (OSError, ValueError):
+            ResponseCache._drop(key)
+            return None
+        if meta.get('url') != url:
+            return None
+        ResponseCache._touch(key)
+        return CacheEntry(url, content, meta.get('time', 0.0), meta.get('etag', ''), meta.get('last_modified', ''))
+
+    @staticmethod
+    def _touch(key: str) -> None:
+        ResponseCache._entries.move_to_end(key)
+        try:
+            utime(ResponseCache._paths(key)[0])
+        except OSError:
+            pass
+
+    @staticmethod
+    def _write_meta(key: str, url: str, etag: str, last_modified: str) -> None:
+        with open(ResponseCache._paths(key)[1], 'wt', encoding=UTF8) as mfile:
+            mfile.write(dumps({'url': url, 'time': time(), 'etag': etag, 'last_modified': last_modified}))
+
+    @staticmethod
+    def store(url: str, content: bytes, etag: Optional[str], last_modified: Optional[str]) -> None:
+        ResponseCache._init()
+        key = ResponseCache._key(url)
+        body_path = ResponseCache._paths(key)[0]
+        try:
+            if not path.isdir(ResponseCache._folder):
+                makedirs(ResponseCache._folder)
+            with open(body_path, 'wb') as bfile:
+                bfile.write(content)
+            ResponseCache._write_meta(key, url, etag or '', last_modified or '')
+        except OSError:
+            Log.error(f'[cache] unable to store response for {url}!')
+            ResponseCache._drop(key)
+            return
+        ResponseCache._total_size += len(content) - ResponseCache._entries.get(key, 0)
+        ResponseCache._entries[key] = len(content)
+        ResponseCache._entries.move_to_end(key)
+        while ResponseCache._total_size > Config.cache_size * Mem.MB and len(ResponseCache._entries) > 1:
+            ResponseCache._drop(next(iter(ResponseCache._entries)))
+
+    @staticmethod
+    def revalidated(entry: CacheEntry) -> None:
+        """Marks stale entry as fresh again after server confirmed it is not modified"""
+        try:
+            ResponseCache._write_meta(ResponseCache._key(entry.url), entry.url, entry.etag, entry.last_modified)
+        except OSError:
+            pass
+
+#
+#
+#########################################
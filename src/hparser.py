@@ -0,0 +1,397 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from asyncio import get_running_loop
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+from bs4 import BeautifulSoup
+
+from config import Config
+from defs import UTF8, PARSER_MODE_INLINE, PARSER_MODE_PROCESS
+from logger import Log
+from rex import re_paginator
+
+__all__ = (
+    'PopupData', 'PageData', 'ParserPool', 'make_soup', 'parse_popup', 'extract_popup_data', 'extract_popup_data_bs4', 'extract_page_data',
+)
+
+LABEL_ARTISTS = 'Artist:'
+LABEL_CATEGORIES = 'Categories:'
+LABEL_TAGS = 'Tags:'
+LABEL_UPLOADER = ' Uploaded By: '
+LABEL_DOWNLOAD = 'Download:'
+LABELS = (LABEL_ARTISTS, LABEL_CATEGORIES, LABEL_TAGS, LABEL_UPLOADER, LABEL_DOWNLOAD)
+TITLE_NOT_FOUND = '404 Not Found'
+HtmlT = TypeVar('HtmlT')
+# bs4 collapses whitespace-only strings outside of these
+PRESERVE_WHITESPACE_ELEMENTS = ('pre', 'textarea')
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+
+class PopupData:
+    """Video popup page contents required to scan a video. None means corresponding section was not found"""
+    def __init__(self) -> None:
+        self.not_found = False
+        self.title = None  # type: Optional[str]
+        self.likes = None  # type: Optional[str]
+        self.artists = None  # type: Optional[List[str]]
+        self.categories = None  # type: Optional[List[str]]
+        self.tags = None  # type: Optional[List[str]]
+        self.uploader = None  # type: Optional[str]
+        self.description = None  # type: Optional[str]
+        self.comments = list()  # type: List[Tuple[str, str]]
+        self.links = None  # type: Optional[List[Tuple[str, str]]]
+        self.message = None  # type: Optional[str]
+
+    @property
+    def complete(self) -> bool:
+        """Page is either a 404, has download section or explains why it doesn't"""
+        return self.not_found or self.links is not None or self.message is not None
+
+    def __repr__(self) -> str:
+        return f'PopupData({", ".join(f"{k}={v!r}" for k, v in vars(self).items())})'
+
+
+class PageData:
+    """Search / playlist / uploader / artist page contents required to collect videos"""
+    def __init__(self) -> None:
+        self.maxpage = 0
+        self.refs = list()  # type: List[Tuple[str, str]]
+        self.previews = None  # type: Optional[List[Tuple[str, str]]]
+
+    def __repr__(self) -> str:
+        return f'PageData(maxpage={self.maxpage:d}, refs={len(self.refs):d}, previews={len(self.previews or ()):d})'
+
+
+def make_soup(content: bytes) -> BeautifulSoup:
+    return BeautifulSoup(content, 'html.parser', from_encoding=UTF8)
+
+
+def has_class(classes: str, class_name: str) -> bool:
+    return classes == class_name or class_name in classes.split()
+
+
+class _Frame:
+    """Open element. Tracks bs4 '.string' semantics and, if captured, all descendant strings"""
+    __slots__ = ('tag', 'classes', 'href', 'nchildren', 'string', 'texts', 'on_close', 'sections')
+
+    def __init__(self, tag: str, classes: str, href: Optional[str]) -> None:
+        self.tag = tag
+        self.classes = classes
+        self.href = href
+        self.nchildren = 0
+        self.string = None  # type: Optional[str]
+        self.texts = None  # type: Optional[List[str]]
+        self.on_close = None  # type: Optional[List[Callable[[_Frame], None]]]
+        self.sections = None  # type: Optional[List[str]]
+
+    def capture(self, callback: Callable[[_Frame], None]) -> None:
+        if self.texts is None:
+            self.texts = list()
+            self.on_close = list()
+        self.on_close.append(callback)
+
+    @property
+    def own_string(self) -> Optional[str]:
+        return self.string if self.nchildren == 1 else None
+
+
+class PopupParser(HTMLParser):
+    """
+    Single pass popup page extractor. Only elements matching the lookups **scan_video()** needs are captured,
+    no document tree is built
+    """
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.data = PopupData()
+        self._stack = [_Frame('', '', None)]  # type: List[_Frame]
+        self._collectors = list()  # type: List[_Frame]
+        self._sections = list()  # type: List[_Frame]
+        self._comment = None  # type: Optional[_Frame]
+        self._comment_parts = None  # type: Optional[List[Optional[str]]]
+        self._last_was_text = False
+        self._em_seen = False
+        self._found_labels = set()
+        self._preserve_whitespace = 0
+
+    def _slot(self, dest: List, make_value: Callable[[_Frame], object]) -> Callable[[_Frame], None]:
+        # reserve result position by element start to preserve document order of nested matches
+        idx = len(dest)
+        dest.append(None)
+
+        def fill(frame: _Frame) -> None:
+            dest[idx] = make_value(frame)
+        return fill
+
+    def _setter(self, attr_name: str, make_value: Callable[[_Frame], object]) -> Callable[[_Frame], None]:
+        def setter(frame: _Frame) -> None:
+            setattr(self.data, attr_name, make_value(frame))
+        return setter
+
+    def _open(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> _Frame:
+        self._last_was_text = False
+        classes, href = '', None
+        for aname, aval in attrs:
+            if aname == 'class':
+                classes = aval or ''
+            elif aname == 'href':
+                href = aval
+        frame = _Frame(tag, classes, href)
+        if tag in PRESERVE_WHITESPACE_ELEMENTS:
+            self._preserve_whitespace += 1
+        data = self.data
+        if tag == 'title':
+            frame.capture(self._setter('not_found', lambda f: data.not_found or f.own_string == TITLE_NOT_FOUND))
+        elif tag == 'h1':
+            if data.title is None and has_class(classes, 'title_video'):
+                data.title = ''
+                frame.capture(self._setter('title', lambda f: ''.join(f.texts)))
+        elif tag == 'span':
+            if data.likes is None and has_class(classes, 'voters count'):
+                data.likes = ''
+                frame.capture(self._setter('likes', lambda f: ''.join(f.texts)))
+            if data.message is None and has_class(classes, 'message'):
+                data.message = ''
+                frame.capture(self._setter('message', lambda f: ''.join(f.texts)))
+        elif tag == 'em':
+            if self._em_seen is False:
+                self._em_seen = True
+                frame.capture(self._setter('description', lambda f: '\n'.join(f.texts)))
+        elif tag == 'div':
+            if self._comment is None and has_class(classes, 'comment-info'):
+                self._comment = frame
+                self._comment_parts = [None, None]
+                frame.capture(self._finish_comment)
+            elif self._comment is not None and self._comment_parts[1] is None and has_class(classes, 'coment-text'):
+                self._comment_parts[1] = ''
+                parts = self._comment_parts
+                frame.capture(lambda f: parts.__setitem__(1, '\n'.join(f.texts)))
+        if tag == 'a' and self._comment is not None and self._comment_parts[0] is None:
+            self._comment_parts[0] = ''
+            parts = self._comment_parts
+            frame.capture(lambda f: parts.__setitem__(0, ''.join(f.texts)))
+        for section_frame in self._sections:
+            for label in section_frame.sections:
+                self._capture_section_item(frame, label)
+        if frame.texts is not None:
+            self._collectors.append(frame)
+        self._stack.append(frame)
+        return frame
+
+    def _capture_section_item(self, frame: _Frame, label: str) -> None:
+        data = self.data
+        if label in (LABEL_ARTISTS, LABEL_CATEGORIES):
+            if frame.tag == 'span':
+                frame.capture(self._slot(data.artists if label == LABEL_ARTISTS else data.categories, lambda f: str(f.own_string)))
+        elif frame.tag == 'a':
+            if label == LABEL_TAGS and has_class(frame.classes, 'tag_item'):
+                frame.capture(self._slot(data.tags, lambda f: str(f.own_string)))
+            elif label == LABEL_DOWNLOAD and has_class(frame.classes, 'tag_item'):
+                frame.capture(self._slot(data.links, lambda f: (''.join(f.texts), f.href)))
+            elif label == LABEL_UPLOADER and data.uploader is None and has_class(frame.classes, 'name'):
+                data.uploader = ''
+                frame.capture(self._setter('uploader', lambda f: ''.join(f.texts)))
+
+    def _finish_comment(self, _: _Frame) -> None:
+        author, text = self._comment_parts
+        self.data.comments.append((author or '', text or ''))
+        self._comment = None
+        self._comment_parts = None
+
+    def _close(self) -> None:
+        self._last_was_text = False
+        frame = self._stack.pop()
+        if frame.tag in PRESERVE_WHITESPACE_ELEMENTS:
+            self._preserve_whitespace -= 1
+        parent = self._stack[-1]
+        parent.nchildren += 1
+        parent.string = frame.own_string
+        if frame.sections is not None:
+            self._sections.remove(frame)
+        if frame.texts is not None:
+            self._collectors.remove(frame)
+            for callback in frame.on_close:
+                callback(frame)
+        if frame.tag == 'div' and parent.tag:
+            label = frame.own_string
+            if label in LABELS:
+                if label not in self._found_labels:
+                    self._found_labels.add(label)
+                    self._open_section(parent, label)
+                elif frame.sections is not None and label in frame.sections:
+                    # label wrapped into a single child div, section is actually an outer element
+                    raise ValueError(f'Ambiguous section \'{label}\'')
+
+    def _open_section(self, frame: _Frame, label: str) -> None:
+        data = self.data
+        if label == LABEL_ARTISTS:
+            data.artists = list()
+        elif label == LABEL_CATEGORIES:
+            data.categories = list()
+        elif label == LABEL_TAGS:
+            data.tags = list()
+        elif label == LABEL_DOWNLOAD:
+            data.links = list()
+        if frame.sections is None:
+            frame.sections = list()
+            self._sections.append(frame)
+        frame.sections.append(label)
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        self._open(tag, attrs)
+        if tag in VOID_ELEMENTS:
+            self._close()
+
+    def handle_startendtag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        self._open(tag, attrs)
+        self._close()
+
+    def handle_endtag(self, tag: str) -> None:
+        for i in reversed(range(1, len(self._stack))):
+            if self._stack[i].tag == tag:
+                while len(self._stack) > i:
+                    self._close()
+                break
+
+    def handle_data(self, data: str) -> None:
+        if not self._preserve_whitespace and not data.strip(ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        top = self._stack[-1]
+        if self._last_was_text:
+            if top.nchildren == 1:
+                top.string += data
+            for frame in self._collectors:
+                frame.texts[-1] += data
+        else:
+            self._last_was_text = True
+            top.nchildren += 1
+            top.string = data
+            for frame in self._collectors:
+                frame.texts.append(data)
+
+    def handle_comment(self, data: str) -> None:
+        self._last_was_text = False
+        top = self._stack[-1]
+        top.nchildren += 1
+        top.string = data
+
+    def close(self) -> None:
+        super().close()
+        while len(self._stack) > 1:
+            self._close()
+
+
+def extract_popup_data(content: bytes) -> PopupData:
+    """Fast single pass extraction"""
+    parser = PopupParser()
+    parser.feed(content.decode(UTF8, errors='replace'))
+    parser.close()
+    return parser.data
+
+
+def extract_popup_data_bs4(a_html: BeautifulSoup) -> PopupData:
+    """Full document tree extraction, slow but tolerant to unexpected markup"""
+    data = PopupData()
+    data.not_found = a_html.find('title', string=TITLE_NOT_FOUND) is not None
+    titleh1 = a_html.find('h1', class_='title_video')
+    data.title = titleh1.text if titleh1 else None
+    likes_span = a_html.find('span', class_='voters count')
+    data.likes = likes_span.text if likes_span else None
+    adiv, cdiv, tdiv, udiv, ddiv = tuple(a_html.find('div', string=label) for label in LABELS)
+    data.artists = [str(a.string) for a in adiv.parent.find_all('span')] if adiv and adiv.parent else None
+    data.categories = [str(c.string) for c in cdiv.parent.find_all('span')] if cdiv and cdiv.parent else None
+    data.tags = [str(elem.string) for elem in tdiv.parent.find_all('a', class_='tag_item')] if tdiv and tdiv.parent else None
+    uploader_a = udiv.parent.find('a', class_='name') if udiv and udiv.parent else None
+    data.uploader = uploader_a.text if uploader_a else None
+    desc_em = a_html.find('em')
+    data.description = desc_em.get_text('\n') if desc_em else None
+    for cidiv in a_html.find_all('div', class_='comment-info'):
+        cudiv = cidiv.find('a')
+        ctdiv = cidiv.find('div', class_='coment-text')
+        data.comments.append((cudiv.text if cudiv else '', ctdiv.get_text('\n') if ctdiv else ''))
+    data.links = [(lin.text, lin.get('href')) for lin in ddiv.parent.find_all('a', class_='tag_item')] if ddiv and ddiv.parent else None
+    message_span = a_html.find('span', class_='message')
+    data.message = message_span.text if message_span else None
+    return data
+
+
+def extract_page_data(content: bytes, video_ref_class: str) -> PageData:
+    """Extracts max page, video links (href, title) and previews (link, title) if page has content div"""
+    a_html = make_soup(content)
+    data = PageData()
+    for page_ajax in a_html.find_all('a', attrs={'data-action': 'ajax'}):
+        try:
+            data.maxpage = max(data.maxpage, int(re_paginator.search(str(page_ajax.get('data-parameters'))).group(1)))
+        except Exception:
+            pass
+    data.refs = [(str(aref.get('href')), str(aref.get('title', ''))) for aref in a_html.find_all('a', class_=video_ref_class)]
+    content_div = a_html.find('div', class_='thumbs clearfix')
+    if content_div is not None:
+        prev_all = content_div.find_all('div', class_='img wrap_image')
+        titl_all = content_div.find_all('div', class_='thumb_title')
+        data.previews = [(str(p.get('data-preview')), str(titl_all[i].text)) for i, p in enumerate(prev_all)]
+    return data
+
+
+def parse_popup(content: bytes) -> PopupData:
+    """Extracts popup data in a single pass, falls back to full document parsing if page looks unexpected"""
+    try:
+        data = extract_popup_data(content)
+        if data.complete:
+            return data
+    except Exception:
+        pass
+    return extract_popup_data_bs4(make_soup(content))
+
+
+class ParserPool:
+    """
+    Runs html parsing off the event loop according to configured parser mode. In process mode both parse callable
+    and its result are sent between processes and so must be picklable - only extract small data there\n
+    **Static**
+    """
+    _executor = None  # type: Optional[Executor]
+
+    @staticmethod
+    def _get_executor() -> Optional[Executor]:
+        if Config.parser_mode == PARSER_MODE_INLINE:
+            return None
+        if ParserPool._executor is None:
+            if Config.parser_mode == PARSER_MODE_PROCESS:
+                ParserPool._executor = ProcessPoolExecutor(Config.parser_workers)
+            else:
+                ParserPool._executor = ThreadPoolExecutor(Config.parser_workers, 'HtmlParser')
+        return ParserPool._executor
+
+    @staticmethod
+    async def run(parse: Callable[[bytes], HtmlT], content: bytes) -> HtmlT:
+        executor = ParserPool._get_executor()
+        if executor is None:
+            return parse(content)
+        try:
+            return await get_running_loop().run_in_executor(executor, parse, content)
+        except BrokenProcessPool:
+            Log.error('Error: html parser process pool is broken, parsing inline!')
+            ParserPool.shutdown(False)
+            Config.parser_mode = PARSER_MODE_INLINE
+            return parse(content)
+
+    @staticmethod
+    def shutdown(wait=True) -> None:
+        if ParserPool._executor is not None:
+            ParserPool._executor.shutdown(wait)
+            ParserPool._executor = None
+
+#
+#
+#########################################
@@ -0,0 +1,70 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from array import array
+from os import path, replace
+from sys import byteorder
+from typing import Iterable, Iterator, Set
+
+__all__ = ('IdSet',)
+
+
+class IdSet:
+    """
+    Compact ordered set of video ids: ids are kept in insertion order in a packed array, membership is checked using a hash set.
+    Can be stored to / loaded from a binary file (little-endian 32-bit ids)
+    """
+    def __init__(self, ids: Iterable[int] = ()) -> None:
+        self._order = array('I')
+        self._ids = set()  # type: Set[int]
+        for idi in ids:
+            self.add(idi)
+
+    def add(self, idi: int) -> bool:
+        """Returns False if id is already in the set"""
+        if idi in self._ids:
+            return False
+        self._ids.add(idi)
+        self._order.append(idi)
+        return True
+
+    def __contains__(self, idi: int) -> bool:
+        return idi in self._ids
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._order)
+
+    def __reversed__(self) -> Iterator[int]:
+        return reversed(self._order)
+
+    @staticmethod
+    def load(filepath: str) -> IdSet:
+        ids = array('I')
+        if path.isfile(filepath):
+            with open(filepath, 'rb') as idsfile:
+                ids.frombytes(idsfile.read())
+            if byteorder == 'big':
+                ids.byteswap()
+        return IdSet(ids)
+
+    def save(self, filepath: str) -> None:
+        """File is replaced atomically, interrupted save leaves previous file intact"""
+        ids = array('I', self._order)
+        if byteorder == 'big':
+            ids.byteswap()
+        with open(f'{filepath}.tmp', 'wb') as idsfile:
+            ids.tofile(idsfile)
+        replace(f'{filepath}.tmp', filepath)
+
+#
+#
+#########################################
@@ -0,0 +1,168 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from json import loads, dumps
+from os import path, stat, replace
+from typing import Dict, Optional, TextIO
+
+from aiohttp import ClientResponse
+
+from config import Config
+from defs import UTF8, JOURNAL_SYNC_SIZE
+from logger import Log
+from vinfo import VideoInfo
+
+__all__ = ('TransferJournal', 'TransferRecord', 'RemoteFileChanged')
+
+
+class RemoteFileChanged(IOError):
+    """Remote file no longer matches the partially downloaded one"""
+
+
+class TransferRecord:
+    """
+    Transfer metadata of a single downloaded file, **flushed** is the amount of bytes confirmed as written.
+    **requested** is the quality originally asked for if file was saved in another one
+    """
+    def __init__(self, id: int, path: str, link: str, quality: str, size=0, etag='', modified='', flushed=0, done=False,
+                 requested='') -> None:
+        self.id = id
+        self.path = path
+        self.link = link
+        self.quality = quality
+        self.size = size
+        self.etag = etag
+        self.modified = modified
+        self.flushed = flushed
+        self.done = done
+        self.requested = requested
+
+    @property
+    def validator(self) -> str:
+        """Value for 'If-Range' header, weak entity tags cannot be used for it"""
+        return self.etag if self.etag and not self.etag.startswith('W/') else self.modified
+
+    @property
+    def verified(self) -> bool:
+        """Returns True if transfer is complete and its file is still there"""
+        return self.done and path.isfile(self.path) and stat(self.path).st_size == self.size
+
+    def __str__(self) -> str:
+        return dumps(self.__dict__)
+
+
+class TransferJournal:
+    """
+    Run-level store of downloads metadata used to validate resumed downloads and to skip verified files without any requests.
+    Stored in append-only journal file: every change is written as a new line and the latest line of an id wins.
+    Journal is compacted when loaded, incomplete last line (interrupted write) is ignored\n
+    **Static**
+    """
+    _records = dict()  # type: Dict[int, TransferRecord]
+    _synced = dict()  # type: Dict[int, int]
+    _filepath = ''
+    _file = None  # type: Optional[TextIO]
+
+    @staticmethod
+    def _ensure_loaded() -> bool:
+        if not Config.journal:
+            return False
+        if TransferJournal._filepath != Config.journal:
+            TransferJournal.close()
+            TransferJournal._load(Config.journal)
+        return True
+
+    @staticmethod
+    def _load(filepath: str) -> None:
+        records = dict()  # type: Dict[int, TransferRecord]
+        if path.isfile(filepath):
+            with open(filepath, 'rt', encoding=UTF8) as jfile:
+                for line in jfile:
+                    try:
+                        record = TransferRecord(**loads(line))
+                        records[record.id] = record
+                    except Exception:
+                        Log.debug(f'TransferJournal: skipping invalid line \'{line.strip()}\'')
+            with open(f'{filepath}.tmp', 'wt', encoding=UTF8) as jfile:
+                jfile.writelines(f'{str(record)}\n' for record in records.values())
+            replace(f'{filepath}.tmp', filepath)
+        TransferJournal._records = records
+        TransferJournal._synced = {record.id: record.flushed for record in records.values()}
+        TransferJournal._filepath = filepath
+        TransferJournal._file = open(filepath, 'at', encoding=UTF8)
+
+    @staticmethod
+    def _store(record: TransferRecord) -> None:
+        TransferJournal._file.write(f'{str(record)}\n')
+        TransferJournal._file.flush()
+        TransferJournal._synced[record.id] = record.flushed
+
+    @staticmethod
+    def get(vi: VideoInfo) -> Optional[TransferRecord]:
+        """Returns transfer record of **vi** file if there is one"""
+        if not TransferJournal._ensure_loaded():
+            return None
+        record = TransferJournal._records.get(vi.id)
+        return record if record and record.path == vi.my_fullpath else None
+
+    @staticmethod
+    def find_verified(idi: int, quality: str) -> Optional[TransferRecord]:
+        """Returns record of completed transfer of video **idi** requested in **quality** if its file is intact"""
+        if not TransferJournal._ensure_loaded():
+            return None
+        record = TransferJournal._records.get(idi)
+        return record if record and quality in (record.quality, record.requested) and record.verified else None
+
+    @staticmethod
+    def begin(vi: VideoInfo, r: ClientResponse, size: int, flushed: int) -> None:
+        """Starts (or continues) transfer of **vi** file of **size** bytes using metadata from **r**"""
+        if not TransferJournal._ensure_loaded():
+            return
+        record = TransferRecord(vi.id, vi.my_fullpath, vi.link, vi.quality, size,
+                                r.headers.get('ETag', ''), r.headers.get('Last-Modified', ''), flushed, requested=vi.requested_quality)
+        TransferJournal._records[vi.id] = record
+        TransferJournal._store(record)
+
+    @staticmethod
+    def progress(vi: VideoInfo, size: int) -> None:
+        """Accounts **size** more bytes of **vi** file written, journal is updated once enough of them is accumulated"""
+        record = TransferJournal.get(vi)
+        if record is not None:
+            record.flushed += size
+            if record.flushed - TransferJournal._synced.get(vi.id, 0) >= JOURNAL_SYNC_SIZE:
+                TransferJournal._store(record)
+
+    @staticmethod
+    def complete(vi: VideoInfo) -> None:
+        record = TransferJournal.get(vi)
+        if record is not None:
+            record.flushed, record.done = record.size, True
+            record.requested = vi.requested_quality or record.requested
+            TransferJournal._store(record)
+
+    @staticmethod
+    def forget(vi: VideoInfo) -> None:
+        record = TransferJournal.get(vi)
+        if record is not None:
+            record.flushed, record.done = 0, False
+            record.etag = record.modified = ''
+            TransferJournal._store(record)
+
+    @staticmethod
+    def close() -> None:
+        if TransferJournal._file is not None:
+            TransferJournal._file.close()
+            TransferJournal._file = None
+        TransferJournal._filepath = ''
+        TransferJournal._records.clear()
+        TransferJournal._synced.clear()
+
+#
+#
+#########################################
@@ -0,0 +1,77 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from hashlib import blake2b
+from os import path
+from typing import Dict
+
+from defs import Mem, UTF8, MANIFEST_FILE_NAME
+
+__all__ = ('StreamHasher', 'HashManifest', 'hash_file')
+
+
+class StreamHasher:
+    """Incremental BLAKE2b hash of a file being downloaded, digest matches the one of 'b2sum' utility"""
+    def __init__(self) -> None:
+        self._hash = blake2b()
+
+    def update(self, data: bytes) -> None:
+        self._hash.update(data)
+
+    def update_from_file(self, filepath: str, size: int) -> None:
+        """Hashes first **size** bytes of **filepath** (already downloaded part)"""
+        with open(filepath, 'rb') as infile:
+            while size > 0:
+                block = infile.read(min(size, Mem.MB))
+                if not block:
+                    raise IOError(f'Unexpected end of file \'{filepath}\'')
+                self._hash.update(block)
+                size -= len(block)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def hash_file(filepath: str) -> str:
+    hasher = StreamHasher()
+    hasher.update_from_file(filepath, path.getsize(filepath))
+    return hasher.hexdigest()
+
+
+class HashManifest:
+    """
+    Per-folder list of downloaded files hashes in 'b2sum' format ('<digest> *<filename>').
+    Entries are appended as files get completed, latest entry of a file wins\n
+    **Static**
+    """
+    @staticmethod
+    def manifest_path(folder: str) -> str:
+        return f'{folder}{MANIFEST_FILE_NAME}'
+
+    @staticmethod
+    def add(folder: str, filename: str, digest: str) -> None:
+        with open(HashManifest.manifest_path(folder), 'at', encoding=UTF8) as mfile:
+            mfile.write(f'{digest} *{filename}\n')
+
+    @staticmethod
+    def load(folder: str) -> Dict[str, str]:
+        """Returns {filename: digest} for all the files listed in **folder** manifest"""
+        entries = dict()  # type: Dict[str, str]
+        manifest_path = HashManifest.manifest_path(folder)
+        if path.isfile(manifest_path):
+            with open(manifest_path, 'rt', encoding=UTF8) as mfile:
+                for line in mfile:
+                    digest, _, filename = line.rstrip('\n').partition(' ')
+                    if digest and filename:
+                        entries[filename[1:] if filename.startswith('*') else filename] = digest
+        return entries
+
+#
+#
+#########################################
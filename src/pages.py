@@ -7,20 +7,22 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 #
 
 import sys
-from asyncio import run as run_async, sleep
-from typing import Sequence
+from asyncio import Task, Queue, Semaphore, FIRST_COMPLETED, run as run_async, sleep, gather, get_running_loop, wait
+from functools import partial
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
 
 from cmdargs import HelpPrintExitException, prepare_arglist
 from config import Config
-from defs import (
-    PREFIX, SITE_AJAX_REQUEST_SEARCH_PAGE, SITE_AJAX_REQUEST_UPLOADER_PAGE, SITE_AJAX_REQUEST_PLAYLIST_PAGE, SITE_AJAX_REQUEST_MODEL_PAGE,
-    QUALITIES, NamingFlags,
-)
+from defs import PREFIX, QUALITIES, PAGE_RETRIES_MAX, NamingFlags
 from download import download, at_interrupt
+from downloader import VideoDownloadWorker
 from fetch_html import make_session, fetch_html
+from hparser import PageData, extract_page_data
+from idset import IdSet
 from logger import Log
-from path_util import prefilter_existing_items
-from rex import re_page_entry, re_paginator, re_preview_entry
+from path_util import prefilter_existing_items, filter_existing_items, scan_dest_folder
+from psource import PageSource
+from rex import re_page_entry, re_preview_entry
 from util import at_startup, has_naming_flag
 from validators import find_and_resolve_config_conflicts
 from vinfo import VideoInfo
@@ -37,7 +39,6 @@ async def main(args: Sequence[str]) -> None:
     Config.read(arglist, True)
 
     full_download = Config.quality != QUALITIES[-1]
-    video_ref_class = 'th' if Config.playlist_name else 'th js-open-popup'
 
     if find_and_resolve_config_conflicts(full_download) is True:
         await sleep(3.0)
@@ -51,100 +52,238 @@ async def main(args: Sequence[str]) -> None:
             return False
         return True
 
-    v_entries = list()
-    maxpage = Config.end if Config.start == Config.end else 0
+    def page_ids(page: PageData) -> List[int]:
+        if full_download:
+            return [int(re_page_entry.search(aref_href).group(1)) for aref_href, _ in page.refs]
+        return [int(re_preview_entry.search(link).group(1)) for link, _ in page.previews or ()]
+
+    async def scan_pages(source: PageSource) -> AsyncIterator[List[VideoInfo]]:
+        """Yields items found by **source** page by page"""
+        parse_page = partial(extract_page_data, video_ref_class=source.video_ref_class)
+        maxpage = Config.end if Config.start == Config.end else 0
+        prefetched = dict()  # type: Dict[int, Task]
+        bisected = dict()  # type: Dict[int, PageData]
+        src_str = f'[{str(source)}] ' if len(sources) > 1 else ''
+
+        async def fetch_page(page_num: int) -> Optional[PageData]:
+            if page_num in bisected:
+                return bisected.pop(page_num)
+            async with page_slots:
+                return await fetch_html(source.page_address(page_num), session=s, parse=parse_page)
+
+        async def find_begin_page(lo: int, hi: int) -> int:
+            """Binary search for the first page with ids not exceeding begin_id, requires pages to be ordered by id descending"""
+            while lo < hi:
+                mid = (lo + hi) // 2
+                mid_page = await fetch_page(mid)
+                if mid_page is None:
+                    break
+                bisected[mid] = mid_page
+                mid_ids = page_ids(mid_page)
+                if not mid_ids or min(mid_ids) <= Config.end_id:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return lo
+
+        def prefetch_pages(first: int) -> None:
+            # pages past the current one are only requested once max page is known so nothing is fetched beyond it
+            if maxpage > 0 and not Config.get_maxid:
+                # fan-out: queue all the remaining pages at once, page slots limit how many are fetched simultaneously
+                last = min(Config.end, maxpage, first + (maxpage if Config.page_workers else Config.page_prefetch))
+            else:
+                last = first
+            for page_num in range(first, last + 1):
+                if page_num not in prefetched:
+                    prefetched[page_num] = get_running_loop().create_task(fetch_page(page_num))
+
+        pi = Config.start
+        page_fails = 0
+        try:
+            while pi <= Config.end:
+                if pi > maxpage > 0:
+                    Log.info(f'{src_str}reached parsed max page, page scan completed')
+                    break
+
+                prefetch_pages(pi)
+                a_html = await prefetched.pop(pi)
+                if not a_html:
+                    page_fails += 1
+                    if page_fails < PAGE_RETRIES_MAX:
+                        Log.error(f'{src_str}Error: cannot get html for page {pi:d}, retrying...')
+                    else:
+                        Log.error(f'{src_str}Error: cannot get html for page {pi:d}, skipping it!')
+                        page_fails = 0
+                        pi += 1
+                    continue
 
-    pi = Config.start
-    async with make_session() as s:
-        while pi <= Config.end:
-            if pi > maxpage > 0:
-                Log.info('reached parsed max page, page scan completed')
-                break
+                page_fails = 0
+                pi += 1
 
-            page_addr = (
-                (SITE_AJAX_REQUEST_PLAYLIST_PAGE % (Config.playlist_id, Config.playlist_name, pi)) if Config.playlist_name else
-                (SITE_AJAX_REQUEST_UPLOADER_PAGE % (Config.uploader, pi)) if Config.uploader else
-                (SITE_AJAX_REQUEST_MODEL_PAGE % (Config.model, pi)) if Config.model else
-                (SITE_AJAX_REQUEST_SEARCH_PAGE % (Config.search_tags, Config.search_arts, Config.search_cats, Config.search, pi))
-            )
-            a_html = await fetch_html(page_addr, session=s)
-            if not a_html:
-                Log.error(f'Error: cannot get html for page {pi:d}')
-                continue
-
-            pi += 1
-
-            if maxpage == 0:
-                for page_ajax in a_html.find_all('a', attrs={'data-action': 'ajax'}):
-                    try:
-                        maxpage = max(maxpage, int(re_paginator.search(str(page_ajax.get('data-parameters'))).group(1)))
-                    except Exception:
-                        pass
                 if maxpage == 0:
-                    Log.info('Could not extract max page, assuming single page search')
-                    maxpage = 1
+                    maxpage = a_html.maxpage
+                    if maxpage == 0:
+                        Log.info(f'{src_str}Could not extract max page, assuming single page search')
+                        maxpage = 1
+                    else:
+                        Log.debug(f'{src_str}Extracted max page: {maxpage:d}')
+
+                if Config.get_maxid:
+                    miref_href = a_html.refs[0][0] if a_html.refs else ''
+                    max_id = re_page_entry.search(miref_href).group(1)
+                    Log.fatal(f'{PREFIX[:2].upper()}: {max_id}')
+                    return
+
+                cur_ids = page_ids(a_html) if source.ids_ordered else []
+                if cur_ids and min(cur_ids) > Config.end_id and pi == Config.start + 1 and pi <= min(Config.end, maxpage):
+                    begin_page = await find_begin_page(pi, min(Config.end, maxpage))
+                    Log.info(f'{src_str}page {pi - 1:d}: all ids are above {Config.end_id:d}, skipping to page {begin_page:d}...')
+                    pi = begin_page
+                    continue
+                if cur_ids and max(cur_ids) < Config.start_id:
+                    Log.info(f'{src_str}page {pi - 1:d}: all ids are below {Config.start_id:d}, page scan completed')
+                    break
+
+                Log.info(f'{src_str}page {pi - 1:d}...{" (this is the last page!)" if (0 < maxpage == pi - 1) else ""}')
+
+                page_entries = list()  # type: List[VideoInfo]
+                if full_download:
+                    for aref_href, my_title in a_html.refs:
+                        cur_id = int(re_page_entry.search(aref_href).group(1))
+                        if check_id_bounds(cur_id) is False:
+                            continue
+                        elif cur_id in seen_ids:
+                            Log.trace(f'skipping {cur_id:d}: found by a previous run')
+                            continue
+                        elif queued_ids.add(cur_id) is False:
+                            Log.warn(f'Warning: id {cur_id:d} already queued, skipping')
+                            continue
+                        page_entries.append(VideoInfo(cur_id, my_title))
                 else:
-                    Log.debug(f'Extracted max page: {maxpage:d}')
-
-            if Config.get_maxid:
-                miref = a_html.find('a', class_=video_ref_class)
-                max_id = re_page_entry.search(str(miref.get('href'))).group(1)
-                Log.fatal(f'{PREFIX[:2].upper()}: {max_id}')
-                return
-
-            Log.info(f'page {pi - 1:d}...{" (this is the last page!)" if (0 < maxpage == pi - 1) else ""}')
-
-            if full_download:
-                arefs = a_html.find_all('a', class_=video_ref_class)
-                for aref in arefs:
-                    cur_id = int(re_page_entry.search(str(aref.get('href'))).group(1))
-                    if check_id_bounds(cur_id) is False:
-                        continue
-                    elif cur_id in v_entries:
-                        Log.warn(f'Warning: id {cur_id:d} already queued, skipping')
+                    if a_html.previews is None:
+                        Log.error(f'{src_str}Error: cannot get content div for page {pi:d}')
                         continue
-                    my_title = str(aref.get('title', ''))
-                    v_entries.append(VideoInfo(cur_id, my_title))
-            else:
-                content_div = a_html.find('div', class_='thumbs clearfix')
 
-                if content_div is None:
-                    Log.error(f'Error: cannot get content div for page {pi:d}')
+                    for link, title in a_html.previews:
+                        v_id = re_preview_entry.search(link)
+                        cur_id, cur_ext = int(v_id.group(1)), str(v_id.group(2))
+                        if check_id_bounds(cur_id) is False:
+                            continue
+                        elif cur_id in seen_ids:
+                            Log.trace(f'skipping {cur_id:d}: found by a previous run')
+                            continue
+                        elif queued_ids.add(cur_id) is False:
+                            Log.warn(f'Warning: id {cur_id:d} already queued, skipping')
+                            continue
+                        page_entries.append(VideoInfo(
+                            cur_id, '', link, '', f'{PREFIX if has_naming_flag(NamingFlags.PREFIX) else ""}{cur_id:d}'
+                            f'{f"_{title}" if has_naming_flag(NamingFlags.TITLE) else ""}_preview.{cur_ext}',
+                        ))
+                yield page_entries
+        finally:
+            for task in prefetched.values():
+                task.cancel()
+            await gather(*prefetched.values(), return_exceptions=True)
+            prefetched.clear()
+
+    async def scan_sources() -> AsyncIterator[List[VideoInfo]]:
+        """Scans all the sources concurrently, yields found items page by page in order of arrival"""
+        async def scan_source(source: PageSource) -> None:
+            async for page_entries in scan_pages(source):
+                await found_pages.put(page_entries)
+
+        found_pages = Queue(len(sources))  # type: Queue[List[VideoInfo]]
+        scanners = [get_running_loop().create_task(scan_source(source)) for source in sources]
+        all_scanned = gather(*scanners)
+        next_page = None  # type: Optional[Task]
+        try:
+            while True:
+                next_page = get_running_loop().create_task(found_pages.get())
+                await wait((next_page, all_scanned), return_when=FIRST_COMPLETED)
+                if next_page.done():
+                    yield next_page.result()
                     continue
+                next_page.cancel()
+                all_scanned.result()
+                while not found_pages.empty():
+                    yield found_pages.get_nowait()
+                break
+        finally:
+            for task in scanners + ([next_page] if next_page else []):
+                task.cancel()
+            await gather(*scanners, return_exceptions=True)
+
+    async def stream_pages() -> AsyncIterator[Tuple[List[VideoInfo], int]]:
+        """Yields found items page by page, existing items filtered out"""
+        async for page_entries in scan_sources():
+            page_entries.reverse()
+            orig_page_count = len(page_entries)
+            found_ids = [vi.id for vi in page_entries]
+            filter_existing_items(page_entries)
+            existing_ids.extend(sorted(set(found_ids).difference(vi.id for vi in page_entries)))
+            v_entries.extend(page_entries)
+            yield page_entries, orig_page_count - len(page_entries)
+
+    def store_seen_ids() -> None:
+        """Remembers ids downloaded or found existing by this run, failed and interrupted ones are going to be retried next time"""
+        if not Config.seen_ids or Config.get_maxid:
+            return
+        dwn = VideoDownloadWorker.get()
+        completed_ids = dwn.get_completed_ids() if dwn else set()
+        for cur_id in existing_ids + [vi.id for vi in v_entries if vi.id in completed_ids]:
+            seen_ids.add(cur_id)
+        seen_ids.save(Config.seen_ids)
+
+    primary_source = PageSource(Config.search_tags, Config.search_arts, Config.search_cats, Config.search,
+                                (Config.playlist_id, Config.playlist_name), Config.uploader, Config.model)
+    # regular search args define the primary source, unless only extra sources are given
+    has_primary_source = not primary_source.is_search or any((Config.search_tags, Config.search_arts, Config.search_cats, Config.search))
+    sources = ([primary_source] if has_primary_source or not Config.page_sources else []) + Config.page_sources
+    v_entries = list()  # type: List[VideoInfo]
+    existing_ids = list()  # type: List[int]
+    queued_ids = IdSet()
+    seen_ids = IdSet.load(Config.seen_ids) if Config.seen_ids else IdSet()
+    # page slots are shared by all the sources so concurrent scan does not multiply the number of simultaneous requests
+    page_slots = Semaphore(Config.page_workers or (Config.page_prefetch + 1) * len(sources))
 
-                prev_all = content_div.find_all('div', class_='img wrap_image')
-                titl_all = content_div.find_all('div', class_='thumb_title')
-                for i, p in enumerate(prev_all):
-                    link = str(p.get('data-preview'))
-                    title = str(titl_all[i].text)
-                    v_id = re_preview_entry.search(link)
-                    cur_id, cur_ext = int(v_id.group(1)), str(v_id.group(2))
-                    if check_id_bounds(cur_id) is False:
-                        continue
-                    elif cur_id in v_entries:
-                        Log.warn(f'Warning: id {cur_id:d} already queued, skipping')
-                        continue
-                    v_entries.append(VideoInfo(
-                        cur_id, '', link, '', f'{PREFIX if has_naming_flag(NamingFlags.PREFIX) else ""}{cur_id:d}'
-                        f'{f"_{title}" if has_naming_flag(NamingFlags.TITLE) else ""}_preview.{cur_ext}',
-                    ))
+    async with make_session() as s:
+        if Config.stream and not Config.get_maxid:
+            # items go to download as soon as their page is processed
+            scan_dest_folder()
+            await download(v_entries, full_download, 0, s, stream_pages())
+            store_seen_ids()
+            return
+
+        async for page_entries in scan_sources():
+            v_entries.extend(page_entries)
+
+        if Config.get_maxid:
+            return
 
-        v_entries.reverse()
+        if len(sources) > 1:
+            # items of different sources are interleaved
+            v_entries.sort(key=lambda vi: vi.id)
+        else:
+            v_entries.reverse()
         orig_count = len(v_entries)
 
         if orig_count > 0:
+            orig_ids = [vi.id for vi in v_entries]
             prefilter_existing_items(v_entries)
+            existing_ids.extend(sorted(set(orig_ids).difference(vi.id for vi in v_entries)))
 
         removed_count = orig_count - len(v_entries)
 
         if orig_count == removed_count:
             if orig_count > 0:
+                store_seen_ids()
                 Log.fatal(f'\nAll {orig_count:d} videos already exist. Aborted.')
             else:
                 Log.fatal('\nNo videos found. Aborted.')
             return
 
         await download(v_entries, full_download, removed_count, s)
+        store_seen_ids()
 
 
 async def run_main(args: Sequence[str]) -> None:
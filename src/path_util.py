@@ -10,14 +10,14 @@ from os import path, listdir, rename
 from typing import List, Optional, Dict, MutableSequence
 
 from config import Config
-from defs import MAX_DEST_SCAN_SUB_DEPTH
+from defs import MAX_DEST_SCAN_SUB_DEPTH, CACHE_DIR_NAME, SEGMENT_MAP_EXT
 from logger import Log
 from rex import re_media_filename
 from scenario import DownloadScenario
 from util import normalize_path
 from vinfo import VideoInfo
 
-__all__ = ('file_already_exists', 'try_rename', 'prefilter_existing_items')
+__all__ = ('file_already_exists', 'try_rename', 'prefilter_existing_items', 'filter_existing_items', 'scan_dest_folder')
 
 found_filenames_dict = dict()  # type: Dict[str, List[str]]
 
@@ -42,6 +42,8 @@ def scan_dest_folder() -> None:
             for cname in listdir(base_folder):
                 fullpath = f'{base_folder}{cname}'
                 if path.isdir(fullpath):
+                    if cname == CACHE_DIR_NAME:
+                        continue
                     fullpath = normalize_path(fullpath)
                     if level < MAX_DEST_SCAN_SUB_DEPTH:
                         found_filenames_dict[fullpath] = list()
@@ -67,6 +69,9 @@ def file_exists_in_folder(base_folder: str, idi: int, quality: str) -> str:
                 f_id = f_match.group(1)
                 f_quality = f_match.group(2)
                 if str(idi) == f_id and (quality is None or quality == f_quality):
+                    if f'{fname}.{SEGMENT_MAP_EXT}' in orig_file_names:
+                        # unfinished segmented or preallocated download
+                        continue
                     return f'{normalize_path(base_folder)}{fname}'
             except Exception:
                 continue
@@ -95,6 +100,11 @@ def prefilter_existing_items(vi_list: MutableSequence[VideoInfo]) -> None:
     This function may only be called once!
     """
     scan_dest_folder()
+    filter_existing_items(vi_list)
+
+
+def filter_existing_items(vi_list: MutableSequence[VideoInfo]) -> None:
+    """Same as **prefilter_existing_items()** but uses results of a previous dest folder scan. Can be called any number of times"""
     if Config.continue_mode:
         return
 
@@ -0,0 +1,167 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import ClientSession, ClientResponse, CookieJar
+from multidict import CIMultiDict
+
+from defs import (
+    Mem, PROXY_HEALTH_EWMA_ALPHA, PROXY_QUARANTINE_FAILURES, PROXY_QUARANTINE_MIN_REQUESTS, PROXY_QUARANTINE_ERROR_RATE,
+    PROXY_QUARANTINE_BASE, PROXY_QUARANTINE_MAX, PROXY_THROUGHPUT_MIN_BYTES,
+)
+from logger import Log
+
+__all__ = ('ProxyHealth', 'ProxyPool')
+
+
+def ewma(old: Optional[float], value: float) -> float:
+    return value if old is None else old + PROXY_HEALTH_EWMA_ALPHA * (value - old)
+
+
+def clamp_ratio(value: float) -> float:
+    return min(4.0, max(0.25, value))
+
+
+class ProxyHealth:
+    """Single proxy with its own session (and connector) and its health stats"""
+    def __init__(self, proxy: str, session: ClientSession) -> None:
+        self.proxy = proxy
+        self.session = session
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency = None  # type: Optional[float]
+        self.throughput = None  # type: Optional[float]
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.quarantines = 0
+        self.quarantined_until = 0.0
+
+    def quarantined(self, now: float) -> bool:
+        return now < self.quarantined_until
+
+    def weight(self, avg_latency: Optional[float], avg_throughput: Optional[float]) -> float:
+        weight = 1.0 - self.error_rate
+        if self.latency is not None and avg_latency:
+            weight *= clamp_ratio(avg_latency / max(self.latency, 0.001))
+        if self.throughput is not None and avg_throughput:
+            weight *= clamp_ratio(self.throughput / avg_throughput)
+        return max(weight, 0.01)
+
+    def __str__(self) -> str:
+        latency_str = f'{self.latency * 1000:.0f}ms' if self.latency is not None else '???'
+        throughput_str = f'{self.throughput / Mem.KB:.1f} Kb/s' if self.throughput is not None else '???'
+        return (f'{self.proxy}: {self.requests:d} requests ({self.inflight:d} active), errors {self.error_rate * 100:.0f}%,'
+                f' latency {latency_str}, speed {throughput_str}{" [quarantined]" if self.quarantined(monotonic()) else ""}')
+
+
+class ProxyPool:
+    """
+    Session-like facade over a set of proxies, each with its own session and connector. Sessions share one cookie jar.\n
+    Every request goes to the proxy with the least load relative to its health weight (error rate, latency, throughput).
+    A failing proxy is quarantined: it gets no new requests, but requests already sent through it are left to finish
+    """
+    def __init__(self, proxies: Sequence[str], make_proxy_session: Callable[[str, CookieJar], ClientSession]) -> None:
+        assert len(proxies) > 0
+        self.cookie_jar = CookieJar()
+        self.headers = CIMultiDict()  # type: CIMultiDict[str]
+        self._proxies = [ProxyHealth(proxy, make_proxy_session(proxy, self.cookie_jar)) for proxy in proxies]  # type: List[ProxyHealth]
+        self._responses = dict()  # type: Dict[int, Tuple[ProxyHealth, float]]
+
+    async def __aenter__(self) -> ProxyPool:
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        for ph in self._proxies:
+            await ph.session.close()
+
+    @property
+    def closed(self) -> bool:
+        return all(ph.session.closed for ph in self._proxies)
+
+    @property
+    def proxies(self) -> List[ProxyHealth]:
+        return self._proxies
+
+    def pick(self) -> ProxyHealth:
+        now = monotonic()
+        candidates = [ph for ph in self._proxies if not ph.quarantined(now)]
+        if not candidates:
+            # everything is quarantined, use the one which is going to recover first
+            return min(self._proxies, key=lambda ph: ph.quarantined_until)
+        latencies = [ph.latency for ph in candidates if ph.latency is not None]
+        throughputs = [ph.throughput for ph in candidates if ph.throughput is not None]
+        avg_latency = sum(latencies) / len(latencies) if latencies else None
+        avg_throughput = sum(throughputs) / len(throughputs) if throughputs else None
+        return min(candidates, key=lambda ph: (ph.inflight + 1) / ph.weight(avg_latency, avg_throughput))
+
+    def _register(self, ph: ProxyHealth, success: bool) -> None:
+        ph.error_rate = ewma(ph.error_rate, 0.0 if success else 1.0)
+        if success:
+            ph.consecutive_failures = 0
+            return
+        ph.failures += 1
+        ph.consecutive_failures += 1
+        if ph.consecutive_failures >= PROXY_QUARANTINE_FAILURES or (
+                ph.requests >= PROXY_QUARANTINE_MIN_REQUESTS and ph.error_rate >= PROXY_QUARANTINE_ERROR_RATE):
+            if ph.quarantined(monotonic()):
+                return
+            ph.quarantines += 1
+            duration = min(PROXY_QUARANTINE_MAX, PROXY_QUARANTINE_BASE * 2 ** min(ph.quarantines - 1, 16))
+            ph.quarantined_until = monotonic() + duration
+            # start over on probation once quarantine is over
+            ph.consecutive_failures = 0
+            ph.error_rate = PROXY_QUARANTINE_ERROR_RATE / 2
+            Log.warn(f'Proxy {ph.proxy} is failing, quarantined for {duration:.0f} seconds'
+                     f' ({ph.inflight:d} active request(s) left to finish)')
+
+    async def request(self, method: str, url: str, **kwargs) -> ClientResponse:
+        ph = self.pick()
+        headers = CIMultiDict(self.headers)
+        headers.update(kwargs.pop('headers', None) or {})
+        ph.inflight += 1
+        ph.requests += 1
+        start = monotonic()
+        try:
+            r = await ph.session.request(method, url, headers=headers, **kwargs)
+        except Exception:
+            ph.inflight -= 1
+            self._register(ph, False)
+            raise
+        except BaseException:
+            ph.inflight -= 1
+            raise
+        ph.latency = ewma(ph.latency, monotonic() - start)
+        self._responses[id(r)] = (ph, start)
+        return r
+
+    def response_closed(self, r: ClientResponse, failed: bool) -> None:
+        """Must be called once request made through **request()** is completed"""
+        ph, start = self._responses.pop(id(r), (None, 0.0))
+        if ph is None:
+            return
+        ph.inflight -= 1
+        if not failed:
+            total_bytes = r.content.total_bytes if r.content is not None else 0
+            duration = monotonic() - start
+            if total_bytes >= PROXY_THROUGHPUT_MIN_BYTES and duration > 0.0:
+                ph.throughput = ewma(ph.throughput, total_bytes / duration)
+        self._register(ph, not failed)
+
+    def report(self) -> str:
+        return '\n'.join(f' [proxy] {str(ph)}' for ph in self._proxies)
+
+#
+#
+#########################################
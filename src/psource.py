@@ -0,0 +1,65 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from typing import Tuple
+
+from defs import (
+    SITE_AJAX_REQUEST_SEARCH_PAGE, SITE_AJAX_REQUEST_UPLOADER_PAGE, SITE_AJAX_REQUEST_PLAYLIST_PAGE, SITE_AJAX_REQUEST_MODEL_PAGE,
+)
+
+__all__ = ('PageSource',)
+
+
+class PageSource:
+    """Single source of pages to collect videos from: search, playlist, uploader or model (artist)"""
+    def __init__(self, search_tags='', search_arts='', search_cats='', search='', playlist: Tuple[int, str] = (0, ''),
+                 uploader=0, model='', label='') -> None:
+        self.search_tags = search_tags or ''
+        self.search_arts = search_arts or ''
+        self.search_cats = search_cats or ''
+        self.search = search or ''
+        self.playlist_id, self.playlist_name = playlist or (0, '')
+        self.uploader = uploader or 0
+        self.model = model or ''
+        self.label = label
+
+    def page_address(self, page_num: int) -> str:
+        return (
+            (SITE_AJAX_REQUEST_PLAYLIST_PAGE % (self.playlist_id, self.playlist_name, page_num)) if self.playlist_name else
+            (SITE_AJAX_REQUEST_UPLOADER_PAGE % (self.uploader, page_num)) if self.uploader else
+            (SITE_AJAX_REQUEST_MODEL_PAGE % (self.model, page_num)) if self.model else
+            (SITE_AJAX_REQUEST_SEARCH_PAGE % (self.search_tags, self.search_arts, self.search_cats, self.search, page_num))
+        )
+
+    @property
+    def is_search(self) -> bool:
+        return not (self.playlist_name or self.uploader or self.model)
+
+    @property
+    def ids_ordered(self) -> bool:
+        # search results are sorted by post date so ids on later pages are always lower
+        return self.is_search
+
+    @property
+    def video_ref_class(self) -> str:
+        return 'th' if self.playlist_name else 'th js-open-popup'
+
+    def __str__(self) -> str:
+        return self.label or (
+            f'playlist:{self.playlist_name}' if self.playlist_name else
+            f'uploader:{self.uploader:d}' if self.uploader else
+            f'model:{self.model}' if self.model else
+            ' '.join(f'{kind}:{value}' for kind, value in (
+                ('search', self.search), ('tag', self.search_tags), ('art', self.search_arts), ('cat', self.search_cats)) if value
+            ) or 'search:'
+        )
+
+#
+#
+#########################################
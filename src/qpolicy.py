@@ -0,0 +1,103 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from typing import List, Optional, Sequence, Tuple
+
+from defs import (
+    Mem, MAX_VIDEOS_QUEUE_SIZE, SMALL_FILE_SIZE, SMALL_LANE_SLOTS, QUEUE_POLICY_ID, QUEUE_POLICY_SMALLEST, QUEUE_POLICY_LARGEST,
+    QUEUE_POLICY_MIXED,
+)
+
+__all__ = ('QueuePolicy', 'make_queue_policy', 'project_completion')
+
+
+def is_small(size: int) -> bool:
+    """Unknown (zero) size is considered large"""
+    return 0 < size < SMALL_FILE_SIZE * Mem.MB
+
+
+class QueuePolicy:
+    """
+    Decides which of the waiting files is downloaded next. Works with expected file sizes, zero size means size is unknown.
+    Id order is kept between files of equal (or unknown) size
+    """
+    name = QUEUE_POLICY_ID
+
+    def pick(self, waiting: Sequence[int], active: Sequence[int]) -> Optional[int]:
+        """Returns index of the next item in **waiting** or None if nothing should be started while **active** ones are running"""
+        return 0 if waiting else None
+
+
+class SmallestFirstPolicy(QueuePolicy):
+    name = QUEUE_POLICY_SMALLEST
+
+    def pick(self, waiting: Sequence[int], active: Sequence[int]) -> Optional[int]:
+        return min(range(len(waiting)), key=lambda i: (waiting[i] == 0, waiting[i], i)) if waiting else None
+
+
+class LargestFirstPolicy(QueuePolicy):
+    name = QUEUE_POLICY_LARGEST
+
+    def pick(self, waiting: Sequence[int], active: Sequence[int]) -> Optional[int]:
+        return min(range(len(waiting)), key=lambda i: (waiting[i] == 0, -waiting[i], i)) if waiting else None
+
+
+class MixedPolicy(QueuePolicy):
+    """Id order, but SMALL_LANE_SLOTS download slots are never taken by large files so small ones don't wait behind them"""
+    name = QUEUE_POLICY_MIXED
+
+    def pick(self, waiting: Sequence[int], active: Sequence[int]) -> Optional[int]:
+        if not waiting:
+            return None
+        if sum(not is_small(size) for size in active) < MAX_VIDEOS_QUEUE_SIZE - SMALL_LANE_SLOTS:
+            return 0
+        return next((i for i, size in enumerate(waiting) if is_small(size)), None)
+
+
+def make_queue_policy(name: str) -> QueuePolicy:
+    policies = {policy.name: policy for policy in (QueuePolicy, SmallestFirstPolicy, LargestFirstPolicy, MixedPolicy)}
+    return policies[name]()
+
+
+def project_completion(policy: QueuePolicy, waiting: Sequence[int], active: Sequence[Tuple[int, int]],
+                       rate: float) -> Optional[Tuple[float, float]]:
+    """
+    Simulates downloading everything at **rate** (bytes/s) shared equally by up to MAX_VIDEOS_QUEUE_SIZE downloads started
+    in **policy** order. **waiting** - expected sizes of queued files, **active** - (expected size, remaining size) of running downloads.
+    Unknown sizes are assumed to be average.\n
+    Returns (seconds until all files are done, average seconds until a file is done) or None if projection is impossible
+    """
+    known = [size for size in waiting if size] + [size for size, _ in active if size]
+    if rate <= 0.0 or not known:
+        return None
+    average = sum(known) // len(known)
+    pending = [size or average for size in waiting]
+    running = [[size or average, remaining if size else average] for size, remaining in active]  # type: List[List[int]]
+    seconds = total_done = 0.0
+    while pending or running:
+        while pending and len(running) < MAX_VIDEOS_QUEUE_SIZE:
+            idx = policy.pick(pending, [size for size, _ in running])
+            if idx is None:
+                break
+            running.append([pending[idx], pending[idx]])
+            del pending[idx]
+        if not running:
+            return None
+        share = rate / len(running)
+        step = min(remaining for _, remaining in running)
+        seconds += step / share
+        for item in running:
+            item[1] -= step
+        total_done += seconds * sum(item[1] <= 0 for item in running)
+        running = [item for item in running if item[1] > 0]
+    return seconds, total_done / (len(waiting) + len(active))
+
+#
+#
+#########################################
@@ -0,0 +1,158 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from asyncio import AbstractEventLoop, CancelledError, Future, Semaphore, TimerHandle, get_running_loop
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from config import Config
+from defs import RequestClass
+
+__all__ = ('TokenBucket', 'RequestLimiter')
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket. Refills at **rate** tokens per second up to **burst** tokens.\n
+    Waiters are woken strictly in FIFO order by a single timer, nothing is polled while the bucket is idle.
+    Non-positive rate means no limit
+    """
+    def __init__(self, rate: float, burst: int) -> None:
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last_refill = 0.0
+        self._waiters = deque()  # type: Deque[Future]
+        self._timer = None  # type: Optional[TimerHandle]
+        self._loop = None  # type: Optional[AbstractEventLoop]
+
+    def _bind(self, loop: AbstractEventLoop) -> None:
+        # a new event loop invalidates everything scheduled by the old one
+        if self._loop is not loop:
+            self._loop = loop
+            self._waiters.clear()
+            self._timer = None
+            self._tokens = float(self._burst)
+            self._last_refill = loop.time()
+
+    def _refill(self) -> None:
+        now = self._loop.time()
+        self._tokens = min(float(self._burst), self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def _schedule(self) -> None:
+        if self._timer is not None or not self._waiters:
+            return
+        delay = max(0.0, (1.0 - self._tokens) / self._rate)
+        self._timer = self._loop.call_later(delay, self._wake)
+
+    def _wake(self) -> None:
+        self._timer = None
+        self._refill()
+        while self._waiters and self._tokens >= 1.0:
+            fut = self._waiters.popleft()
+            if fut.done():  # cancelled while waiting
+                continue
+            self._tokens -= 1.0
+            fut.set_result(None)
+        self._schedule()
+
+    async def acquire(self) -> None:
+        if self._rate <= 0.0:
+            return
+        self._bind(get_running_loop())
+        self._refill()
+        if not self._waiters and self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return
+        fut = self._loop.create_future()
+        self._waiters.append(fut)
+        self._schedule()
+        try:
+            await fut
+        except CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._tokens += 1.0  # token was granted but never used, give it back
+            self._schedule()
+            raise
+
+
+class RequestLimiter:
+    """
+    Per-class, per-host request rate limiter. Each request class also has its own cap on simultaneously open requests.
+    Slots are recreated for every new event loop, each set of slots is a new generation\n
+    **Static**
+    """
+    _buckets = dict()  # type: Dict[Tuple[RequestClass, str], TokenBucket]
+    _slots = dict()  # type: Dict[RequestClass, Semaphore]
+    _loop = None  # type: Optional[AbstractEventLoop]
+    _generation = 0
+
+    @staticmethod
+    def _get_bucket(rclass: RequestClass, host: str) -> TokenBucket:
+        bucket = RequestLimiter._buckets.get((rclass, host))
+        if bucket is None:
+            rate, burst, _ = Config.pacing[rclass]
+            bucket = TokenBucket(rate, burst)
+            RequestLimiter._buckets[(rclass, host)] = bucket
+        return bucket
+
+    @staticmethod
+    def _get_slots(rclass: RequestClass) -> Optional[Semaphore]:
+        loop = get_running_loop()
+        if RequestLimiter._loop is not loop:
+            RequestLimiter._loop = loop
+            RequestLimiter._slots.clear()
+            RequestLimiter._generation += 1
+        if rclass not in RequestLimiter._slots:
+            _, _, limit = Config.pacing[rclass]
+            RequestLimiter._slots[rclass] = Semaphore(limit) if limit > 0 else None
+        return RequestLimiter._slots[rclass]
+
+    @staticmethod
+    async def until_ready(url: str, rclass: RequestClass) -> int:
+        """
+        Pauses request until a free slot of its class is available and target host's bucket grants a token.
+        Returns slot generation to pass to **release()**
+        """
+        slots = RequestLimiter._get_slots(rclass)
+        generation = RequestLimiter._generation
+        if slots is not None:
+            await slots.acquire()
+        try:
+            if Config.nodelay is False:
+                await RequestLimiter._get_bucket(rclass, urlparse(url).hostname or '').acquire()
+        except BaseException:
+            RequestLimiter.release(rclass, generation)
+            raise
+        return generation
+
+    @staticmethod
+    def release(rclass: RequestClass, generation: int) -> None:
+        """
+        Frees request slot taken by **until_ready()**. Must be called once per request, when it is no longer in use.
+        Slot taken from a previous generation is gone already, releasing it does nothing
+        """
+        if generation != RequestLimiter._generation:
+            return
+        slots = RequestLimiter._slots.get(rclass)
+        if slots is not None:
+            slots.release()
+
+    @staticmethod
+    def reset() -> None:
+        RequestLimiter._buckets.clear()
+        RequestLimiter._slots.clear()
+        RequestLimiter._loop = None
+        RequestLimiter._generation += 1
+
+#
+#
+#########################################
@@ -0,0 +1,239 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from asyncio import AbstractEventLoop, Future, TimerHandle, sleep, get_running_loop
+from collections import deque
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from random import uniform as frand
+from time import time
+from typing import Deque, Dict, Optional
+from urllib.parse import urlparse
+
+from aiohttp import ClientResponse
+
+from defs import (
+    CONNECT_RETRIES_BASE, CONNECT_RETRIES_403_BASE, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, RETRY_AFTER_MAX, BREAKER_WINDOW,
+    BREAKER_MIN_REQUESTS, BREAKER_ERROR_RATIO, BREAKER_COOLDOWN_BASE, BREAKER_COOLDOWN_MAX,
+)
+from logger import Log
+
+__all__ = ('RetryStats', 'RetryPolicy', 'CircuitBreaker', 'is_failure_status')
+
+
+def is_failure_status(status: int) -> bool:
+    """Response status which indicates host is struggling (or refusing us) rather than a problem with the request itself"""
+    return status in (403, 429) or status >= 500
+
+
+def parse_retry_after(r: Optional[ClientResponse]) -> Optional[float]:
+    value = r.headers.get('Retry-After') if r is not None else None
+    if not value:
+        return None
+    if value.strip().isnumeric():
+        return float(value.strip())
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryStats:
+    """
+    Retry counters for monitoring, accumulated for the whole run\n
+    **Static**
+    """
+    failures = 0
+    retries = 0
+    retries_403 = 0
+    retries_uncounted = 0
+    retry_after_waits = 0
+    gave_up = 0
+    breaker_trips = 0
+    breaker_waits = 0
+
+    @staticmethod
+    def any() -> bool:
+        return RetryStats.failures > 0 or RetryStats.breaker_trips > 0
+
+    @staticmethod
+    def report() -> str:
+        return (f'failures: {RetryStats.failures:d}, retries: {RetryStats.retries:d} (403: {RetryStats.retries_403:d},'
+                f' uncounted: {RetryStats.retries_uncounted:d}, Retry-After: {RetryStats.retry_after_waits:d}),'
+                f' gave up: {RetryStats.gave_up:d}, circuit trips: {RetryStats.breaker_trips:d} (paused: {RetryStats.breaker_waits:d})')
+
+    @staticmethod
+    def reset() -> None:
+        RetryStats.failures = RetryStats.retries = RetryStats.retries_403 = RetryStats.retries_uncounted = 0
+        RetryStats.retry_after_waits = RetryStats.gave_up = RetryStats.breaker_trips = RetryStats.breaker_waits = 0
+
+
+class RetryPolicy:
+    """
+    Retry budget of a single operation. Failures are counted separately for 403 responses so neither kind can loop forever,
+    delays grow exponentially with jitter unless server asks for a specific one via 'Retry-After'
+    """
+    def __init__(self, tries=CONNECT_RETRIES_BASE, tries_403=CONNECT_RETRIES_403_BASE) -> None:
+        self.tries = tries
+        self.tries_403 = tries_403
+        self.retries = 0
+        self.retries_403 = 0
+
+    @property
+    def exhausted(self) -> bool:
+        return self.retries >= self.tries or self.retries_403 >= self.tries_403
+
+    def give_up(self) -> None:
+        self.retries = self.tries
+
+    def failed(self, r: Optional[ClientResponse], counted=True) -> None:
+        """Registers failed attempt. Uncounted failures (ex. a dropped connection which can be resumed) do not exhaust the budget"""
+        RetryStats.failures += 1
+        if r is not None and r.status == 403:
+            self.retries_403 += 1
+            RetryStats.retries_403 += 1
+        elif counted:
+            self.retries += 1
+        else:
+            RetryStats.retries_uncounted += 1
+        if self.exhausted:
+            RetryStats.gave_up += 1
+        else:
+            RetryStats.retries += 1
+
+    def next_delay(self, r: Optional[ClientResponse]) -> float:
+        retry_after = parse_retry_after(r)
+        if retry_after is not None:
+            RetryStats.retry_after_waits += 1
+            return min(retry_after, RETRY_AFTER_MAX)
+        attempt = max(0, self.retries + self.retries_403 - 1)
+        delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** min(attempt, 16))
+        return delay / 2 + frand(0.0, delay / 2)
+
+    async def backoff(self, r: Optional[ClientResponse]) -> None:
+        await sleep(self.next_delay(r))
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. Once error ratio within recent requests crosses the threshold all requests to the host are paused.
+    After the cooldown a single probe request is let through: success resumes the work, failure pauses it again for longer
+    """
+    class State(IntEnum):
+        CLOSED = 0
+        OPEN = 1
+        HALF_OPEN = 2
+
+    _breakers = dict()  # type: Dict[str, CircuitBreaker]
+
+    @staticmethod
+    def get(url: str) -> CircuitBreaker:
+        host = urlparse(url).hostname or ''
+        breaker = CircuitBreaker._breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host)
+            CircuitBreaker._breakers[host] = breaker
+        return breaker
+
+    @staticmethod
+    def reset_all() -> None:
+        CircuitBreaker._breakers.clear()
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.state = CircuitBreaker.State.CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)  # type: Deque[bool]
+        self._trips = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._waiters = deque()  # type: Deque[Future]
+        self._timer = None  # type: Optional[TimerHandle]
+        self._loop = None  # type: Optional[AbstractEventLoop]
+
+    def _bind(self, loop: AbstractEventLoop) -> None:
+        if self._loop is not loop:
+            self._loop = loop
+            self._waiters.clear()
+            self._timer = None
+            self._probing = False
+            if self.state == CircuitBreaker.State.OPEN:
+                self._open_until = loop.time()
+
+    def _wake_all(self) -> None:
+        self._timer = None
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+
+    def _trip(self) -> None:
+        self._trips += 1
+        cooldown = min(BREAKER_COOLDOWN_MAX, BREAKER_COOLDOWN_BASE * 2 ** min(self._trips - 1, 16))
+        self.state = CircuitBreaker.State.OPEN
+        self._open_until = self._loop.time() + cooldown
+        self._outcomes.clear()
+        RetryStats.breaker_trips += 1
+        Log.warn(f'[{self.host}] too many failed requests, pausing all requests to this host for {cooldown:.0f} seconds...')
+
+    async def until_closed(self) -> bool:
+        """
+        Waits while host is paused. If the pause is over and no probe is in flight yet this request becomes the probe.
+        Returns True if it did
+        """
+        if self.state == CircuitBreaker.State.CLOSED:
+            return False
+        self._bind(get_running_loop())
+        counted = False
+        while True:
+            if self.state == CircuitBreaker.State.CLOSED:
+                return False
+            if self.state == CircuitBreaker.State.OPEN and self._loop.time() >= self._open_until:
+                self.state = CircuitBreaker.State.HALF_OPEN
+            if self.state == CircuitBreaker.State.HALF_OPEN and self._probing is False:
+                self._probing = True
+                Log.debug(f'[{self.host}] probing...')
+                return True
+            if counted is False:
+                counted = True
+                RetryStats.breaker_waits += 1
+            fut = self._loop.create_future()
+            self._waiters.append(fut)
+            if self.state == CircuitBreaker.State.OPEN and self._timer is None:
+                self._timer = self._loop.call_at(self._open_until, self._wake_all)
+            await fut
+
+    def record(self, success: bool, probe: bool) -> None:
+        """Registers request outcome. While paused only the probe outcome matters"""
+        if self.state == CircuitBreaker.State.HALF_OPEN:
+            if probe is False:
+                return
+            self._probing = False
+            if success:
+                Log.info(f'[{self.host}] probe succeeded, resuming requests')
+                self.state = CircuitBreaker.State.CLOSED
+                self._trips = 0
+            else:
+                self._trip()
+            self._wake_all()
+        elif self.state == CircuitBreaker.State.CLOSED:
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= BREAKER_MIN_REQUESTS and failures >= len(self._outcomes) * BREAKER_ERROR_RATIO:
+                self._bind(get_running_loop())
+                self._trip()
+
+    def abandon(self, probe: bool) -> None:
+        """Request was cancelled or ended without a meaningful outcome, if it was the probe let someone else probe"""
+        if probe and self.state == CircuitBreaker.State.HALF_OPEN:
+            self._probing = False
+            self._wake_all()
+
+#
+#
+#########################################
@@ -0,0 +1,107 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from json import loads, dumps
+from os import path, remove, replace
+from time import monotonic
+from typing import List, Optional
+
+from defs import SEGMENT_MAP_EXT, SEGMENT_MAP_SAVE_INTERVAL, UTF8
+
+__all__ = ('Segment', 'SegmentMap')
+
+
+class Segment:
+    """Byte range [**start**, **end**] of a file, **pos** is the offset of the next byte to be written"""
+    def __init__(self, start: int, end: int, pos: int = None) -> None:
+        self.start = start
+        self.end = end
+        self.pos = start if pos is None else pos
+
+    @property
+    def done(self) -> bool:
+        return self.pos > self.end
+
+    @property
+    def range_header(self) -> str:
+        return f'bytes={self.pos:d}-{self.end:d}'
+
+    def __str__(self) -> str:
+        return f'{self.start:d}-{self.end:d}'
+
+    __repr__ = __str__
+
+
+class SegmentMap:
+    """
+    Segments of a file being downloaded in parts, each one written at its own offset of the preallocated file.
+    Progress is stored in a sidecar file next to the file it describes, file is only complete once its sidecar is gone
+    """
+    def __init__(self, filepath: str, total_size: int, segments: List[Segment]) -> None:
+        self.filepath = filepath
+        self.total_size = total_size
+        self.segments = segments
+        self._saved_at = 0.0
+
+    @staticmethod
+    def sidecar_path(filepath: str) -> str:
+        return f'{filepath}.{SEGMENT_MAP_EXT}'
+
+    @staticmethod
+    def create(filepath: str, total_size: int, count: int) -> SegmentMap:
+        count = max(1, min(count, total_size))
+        step = total_size // count
+        bounds = [i * step for i in range(count)] + [total_size]
+        return SegmentMap(filepath, total_size, [Segment(bounds[i], bounds[i + 1] - 1) for i in range(count)])
+
+    @staticmethod
+    def load(filepath: str) -> Optional[SegmentMap]:
+        sidecar_path = SegmentMap.sidecar_path(filepath)
+        if not path.isfile(sidecar_path):
+            return None
+        try:
+            with open(sidecar_path, 'rt', encoding=UTF8) as sfile:
+                smap = loads(sfile.read())
+            return SegmentMap(filepath, smap['size'], [Segment(*seg) for seg in smap['segments']])
+        except Exception:
+            return None
+
+    def save(self) -> None:
+        """Sidecar is replaced atomically so an interrupted save never leaves it damaged"""
+        sidecar_path = self.sidecar_path(self.filepath)
+        with open(f'{sidecar_path}.tmp', 'wt', encoding=UTF8) as sfile:
+            sfile.write(dumps({'size': self.total_size, 'segments': [(seg.start, seg.end, seg.pos) for seg in self.segments]}))
+        replace(f'{sidecar_path}.tmp', sidecar_path)
+        self._saved_at = monotonic()
+
+    def checkpoint(self) -> None:
+        """Saves progress at most once per SEGMENT_MAP_SAVE_INTERVAL, progress lost since the last save is downloaded again"""
+        if monotonic() - self._saved_at >= SEGMENT_MAP_SAVE_INTERVAL:
+            self.save()
+
+    def remove(self) -> None:
+        SegmentMap.remove_sidecar(self.filepath)
+
+    @staticmethod
+    def remove_sidecar(filepath: str) -> None:
+        sidecar_path = SegmentMap.sidecar_path(filepath)
+        if path.isfile(sidecar_path):
+            remove(sidecar_path)
+
+    @property
+    def done_size(self) -> int:
+        return sum(seg.pos - seg.start for seg in self.segments)
+
+    @property
+    def done(self) -> bool:
+        return all(seg.done for seg in self.segments)
+
+#
+#
+#########################################
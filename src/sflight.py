@@ -0,0 +1,67 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from asyncio import AbstractEventLoop, Task, CancelledError, get_running_loop, shield
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, TypeVar
+
+__all__ = ('SingleFlight',)
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts the call, everyone who comes while it is
+    in progress waits for it and receives the same result (or exception). Completed calls are not remembered.
+    The call is cancelled only if all of its callers are cancelled
+    """
+    def __init__(self) -> None:
+        self._flights = dict()  # type: Dict[Hashable, Task]
+        self._waiters = dict()  # type: Dict[Hashable, List[int]]
+        self._loop = None  # type: Optional[AbstractEventLoop]
+        self.started = 0
+        self.coalesced = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        loop = get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._flights.clear()
+            self._waiters.clear()
+        task = self._flights.get(key)
+        if task is None:
+            task = loop.create_task(func())
+            self._flights[key] = task
+            self._waiters[key] = [0]
+            task.add_done_callback(lambda t: self._done(key, t))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        waiters = self._waiters[key]
+        waiters[0] += 1
+        try:
+            return await shield(task)
+        except CancelledError:
+            if not task.done():
+                waiters[0] -= 1
+                if waiters[0] == 0:
+                    task.cancel()
+            raise
+
+    def _done(self, key: Hashable, task: Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+            del self._waiters[key]
+
+#
+#
+#########################################
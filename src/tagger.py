@@ -11,16 +11,18 @@ from typing import List, Optional, Collection, Iterable, MutableSequence, Tuple
 from bigstrings import TAG_ALIASES, TAG_NUMS_DECODED, ART_NUMS_DECODED, CAT_NUMS_DECODED, PLA_NUMS_DECODED
 from defs import LoggingFlags, TAGS_CONCAT_CHAR
 from logger import Log
+from psource import PageSource
 from rex import (
     re_replace_symbols, re_wtag, re_idval, re_uscore_mult, re_not_a_letter, re_numbered_or_counted_tag, re_or_group,
     re_neg_and_group, re_tags_to_process, re_bracketed_tag, re_tags_exclude_major1, re_tags_exclude_major2, re_tags_to_not_exclude,
     prepare_regex_fullmatch,
 )
+from validators import valid_search_string
 from vinfo import VideoInfo
 
 __all__ = (
     'filtered_tags', 'get_matching_tag', 'extract_id_or_group', 'valid_extra_tag', 'is_filtered_out_by_extra_tags',
-    'valid_playlist_name', 'valid_playlist_id', 'valid_tags', 'valid_artists', 'valid_categories',
+    'valid_playlist_name', 'valid_playlist_id', 'valid_tags', 'valid_artists', 'valid_categories', 'valid_page_source',
 )
 
 
@@ -45,6 +47,31 @@ def valid_playlist_id(plist: str) -> Tuple[int, str]:
         raise ValueError
 
 
+def valid_page_source(source: str) -> PageSource:
+    try:
+        kind, value = source.split(':', 1)
+        assert len(value) > 0
+        if kind == 'search':
+            return PageSource(search=valid_search_string(value), label=source)
+        elif kind == 'tag':
+            return PageSource(search_tags=valid_tags(value), label=source)
+        elif kind == 'art':
+            return PageSource(search_arts=valid_artists(value), label=source)
+        elif kind == 'cat':
+            return PageSource(search_cats=valid_categories(value), label=source)
+        elif kind == 'playlist':
+            return PageSource(playlist=valid_playlist_id(value) if value.isnumeric() else valid_playlist_name(value), label=source)
+        elif kind == 'uploader':
+            assert value.isnumeric() and int(value) > 0
+            return PageSource(uploader=int(value), label=source)
+        elif kind == 'model':
+            return PageSource(model=value, label=source)
+        assert False
+    except Exception:
+        Log.error(f'Error: invalid page source: \'{source}\'!')
+        raise ValueError
+
+
 def valid_extra_tag(tag: str, log=True) -> str:
     try:
         all_valid = True
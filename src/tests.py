@@ -6,31 +6,132 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 #
 #
 
-from asyncio import run as run_async
+from asyncio import run as run_async, gather, get_running_loop, sleep, wait_for, CancelledError, TimeoutError as AsyncTimeoutError
+from functools import partial
+from hashlib import blake2b
 from io import StringIO
-from os import path, remove as remove_file, stat
-from tempfile import gettempdir
+from json import loads, dumps
+from os import listdir, path, remove as remove_file, stat
+from tempfile import gettempdir, TemporaryDirectory
+from time import monotonic, time
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
 from unittest import TestCase
 from unittest.mock import patch
 
+from aiohttp import ClientConnectionError
+from multidict import CIMultiDict
+from yarl import URL
+
+from bwshaper import BandwidthShaper
 from cmdargs import prepare_arglist
 # noinspection PyProtectedMember
-from config import BaseConfig
+from config import BaseConfig, Config
 from defs import (
-    APP_NAME, APP_VERSION, DOWNLOAD_MODE_TOUCH, SEARCH_RULE_DEFAULT, QUALITIES,
+    APP_NAME, APP_VERSION, DOWNLOAD_MODE_TOUCH, SEARCH_RULE_DEFAULT, QUALITIES, CACHE_SIZE_DEFAULT, RequestClass, Mem, PARSER_MODES,
+    PARSER_MODE_DEFAULT, SITE, SITE_AJAX_REQUEST_VIDEO, SITE_AJAX_REQUEST_UPLOADER_PAGE,
+    SITE_AJAX_REQUEST_SEARCH_PAGE, SITE_AJAX_REQUEST_MODEL_PAGE,
+    PAGE_RETRIES_MAX, WRITE_BUFFER_DEFAULT, DownloadResult, BREAKER_MIN_REQUESTS,
+    PROBE_PACING_DEFAULT,
 )
 from downloader import VideoDownloadWorker
+from fetch_html import calc_connection_limit, fetch_html, wrap_request
+from hcache import CacheEntry, ResponseCache
+from hparser import ParserPool, make_soup, extract_popup_data, extract_popup_data_bs4, extract_page_data, parse_popup
+from idset import IdSet
 from dscanner import VideoScanWorker
+from dspace import DiskSpaceAdmission, allocated_size
+from dwriter import FileWriter, WriterPool, WriteStats
 # noinspection PyProtectedMember
 from ids import main as ids_main, main_sync as ids_main_sync
 from logger import Log
+from manifest import HashManifest
 # noinspection PyProtectedMember
 from pages import main as pages_main, main_sync as pages_main_sync
 # noinspection PyProtectedMember
 from path_util import found_filenames_dict
+from proxypool import ProxyPool
+from qpolicy import make_queue_policy, project_completion
+from rlimiter import RequestLimiter, TokenBucket
+from rpolicy import RetryPolicy, RetryStats, CircuitBreaker
+from segments import SegmentMap
+from sflight import SingleFlight
+from tagger import valid_page_source
+from transport import ResponseArchive, ReplaySession, make_recorder
 from util import normalize_path
+from verify import main_sync as verify_main_sync
+from vinfo import VideoInfo
 
 RUN_CONN_TESTS = 1
+TESTDATA_DIR = normalize_path(f'{path.dirname(path.abspath(__file__))}/testdata')
+
+POPUP_PAGE_FULL = (
+    '<!DOCTYPE html>\n<html lang="en"><head><meta charset="utf-8"><title>Wizard &amp; Co - Video</title>'
+    '<script>var x = "<div>Tags:</div>";</script></head>\n<body>\n<div class="popup-holder">\n'
+    ' <div class="headline"><h1 class="title_video">Wizard &amp; Co <i>ep.</i> 2</h1></div>\n'
+    ' <div class="rate"><span class="voters count">1 234 likes</span><span class="voters">x</span></div>\n'
+    ' <div class="row">\n'
+    '  <div class="col"><div class="label">Artist:</div>\n'
+    '   <a class="item btn_link" href="/models/a1/"><span class="avatar"><img src="a.jpg"></span><span class="name">Artist One</span></a>\n'
+    '   <a class="item btn_link" href="/models/a2/"><span class="name">Artist&nbsp;Two</span></a>\n'
+    '  </div>\n'
+    '  <div class="col"><div class="label">Categories:</div>\n'
+    '   <a class="item btn_link" href="/c/3d/"><span>3D</span></a><a class="item btn_link" href="/c/ow/"><span>Overwatch</span></a>\n'
+    '  </div>\n'
+    '  <div class="col"><div class="label"> Uploaded By: </div>\n'
+    '   <a class="item btn_link name" href="/members/1/">Uploader_X </a>\n'
+    '  </div>\n'
+    ' </div>\n'
+    ' <div class="row"><em>First line<br>second <b>bold</b> line<br/></em><em>not a description</em></div>\n'
+    ' <div class="wrap"><div class="label">Tags:</div>\n'
+    '  <a class="tag_item" href="/tags/1/">big hat</a><a class="tag_item" href="/tags/2/">wizard</a>\n'
+    '  <a class="tag_item" href="/tags/3/"><span>nested</span></a><a class="tag_item other" href="/tags/4/">a<b>b</b></a>\n'
+    ' </div>\n'
+    ' <div class="wrap"><div class="label">Download:</div>\n'
+    '  <a class="tag_item" href="https://example.com/get_file/1/aa/1/1_360p.mp4/?download=true&amp;v=1">MP4 360p</a>\n'
+    '  <a class="tag_item" href="https://example.com/get_file/1/bb/1/1_720p.mp4/?download=true&amp;v=1">MP4 720p</a>\n'
+    ' </div>\n'
+    ' <div class="comments">\n'
+    '  <div class="item"><div class="comment-info"><a href="/members/2/">user 2</a><span>1 day ago</span>'
+    '<div class="coment-text"> Nice!<br>Very nice &lt;3 </div></div></div>\n'
+    '  <!-- last comment is the oldest one -->\n'
+    '  <div class="item"><div class="comment-info"><a href="/members/1/">Uploader_X</a>'
+    '<div class="coment-text">Made with <a href="/x/">stuff</a>\nenjoy</div></div></div>\n'
+    ' </div>\n'
+    '</div>\n</body></html>\n'
+)
+POPUP_PAGE_PRIVATE = (
+    '<html><head><title>Private video</title></head><body><div class="popup-holder">'
+    '<h1 class="title_video">Hidden</h1><div class="wrap"><div class="label">Categories:</div></div>'
+    '<div class="no-player"><span class="message">This video is a private video uploaded by someone.</span></div>'
+    '<p>unclosed paragraph<p>another</div></body>'
+)
+SEARCH_PAGE = (
+    '<html><body><div class="thumbs clearfix">'
+    '<div class="item"><a class="th js-open-popup" href="/video/3902/v3902/" title="Third"><div class="img wrap_image"'
+    ' data-preview="https://example.com/videos_screenshots/3000/3902/3902_preview.mp4/"></div></a>'
+    '<div class="thumb_title">Third</div></div>'
+    '<div class="item"><a class="th js-open-popup" href="/video/3901/v3901/" title="Second &amp; first"><div class="img wrap_image"'
+    ' data-preview="https://example.com/videos_screenshots/3000/3901/3901_preview.mp4/"></div></a>'
+    '<div class="thumb_title">Second</div></div>'
+    '</div><div class="pagination"><a data-action="ajax" data-parameters="q:x;from_videos:2">2</a>'
+    '<a data-action="ajax" data-parameters="q:x;from_videos:17">Last</a><a data-action="ajax" data-parameters="sort_by:rating">R</a></div>'
+    '</body></html>'
+)
+
+
+def make_search_page(page_num: int, maxpage: int, base_id=4000, step=10) -> str:
+    ids = [base_id + page_num * step + i for i in range(2)]
+    return (
+        '<html><body><div class="thumbs clearfix">' + ''.join(
+            f'<div class="item"><a class="th js-open-popup" href="/video/{vid:d}/v{vid:d}/" title="Video {vid:d}">'
+            f'<div class="img wrap_image" data-preview="https://example.com/screenshots/{vid:d}/{vid:d}_preview.mp4/"></div></a>'
+            f'<div class="thumb_title">Video {vid:d}</div></div>' for vid in ids) +
+        f'</div><div class="pagination"><a data-action="ajax" data-parameters="from_videos:{maxpage:d}">Last</a></div></body></html>'
+    )
+
+
+POPUP_PAGE_404 = '<html><head><title>404 Not Found</title></head><body><h1>Not Found</h1></body></html>'
 
 
 def set_up_test(log=False) -> None:
@@ -135,6 +236,1039 @@ class CmdTests(TestCase):
         self.assertEqual(100, c2.lookahead)
         self.assertEqual(DOWNLOAD_MODE_TOUCH, c2.download_mode)
         self.assertTrue(c2.store_continue_cmdfile)
+        parsed3 = prepare_arglist(['-start', '1000', '-rate', '2.5', '-burst', '3'], False)
+        c3 = BaseConfig()
+        c3.read(parsed3, False)
+        self.assertEqual(2.5, c3.request_rate)
+        self.assertEqual(3, c3.request_burst)
+        parsed4 = prepare_arglist(['-start', '1000', '-rate', '2', '--pacing', 'media:0:1:4,thumbnail:5:2:2'], False)
+        c4 = BaseConfig()
+        c4.read(parsed4, False)
+        self.assertEqual((2.0, 1, 0), c4.pacing[RequestClass.API])
+        self.assertEqual((0.0, 1, 4), c4.pacing[RequestClass.MEDIA])
+        self.assertEqual((5.0, 2, 2), c4.pacing[RequestClass.THUMBNAIL])
+        self.assertEqual(PROBE_PACING_DEFAULT, c4.pacing[RequestClass.PROBE])
+        parsed5 = prepare_arglist(['-start', '1000', '--conn-limit-per-host', '4', '--dns-ttl', '60', '--socket-buffers', '512',
+                                   '-proxy', 'http://127.0.0.1:8080', '-proxy', 'socks5://127.0.0.1:1080'], False)
+        c5 = BaseConfig()
+        c5.read(parsed5, False)
+        self.assertEqual(['http://127.0.0.1:8080', 'socks5://127.0.0.1:1080'], c5.proxies)
+        self.assertEqual('http://127.0.0.1:8080', c5.proxy)
+        self.assertEqual((0, 4, 60), (c5.conn_limit, c5.conn_limit_per_host, c5.dns_ttl))
+        self.assertEqual((512, 512), c5.socket_buffers)
+        with patch('fetch_html.Config', c5):
+            self.assertEqual(2 + 8, calc_connection_limit())
+            c5.save_screenshots, c5.pacing[RequestClass.THUMBNAIL] = True, (5.0, 2, 2)
+            self.assertEqual(2 + 8 + 2, calc_connection_limit())
+            c5.conn_limit = 5
+            self.assertEqual(5, calc_connection_limit())
+        # every segment takes a media slot and a connection of its own
+        parsed6 = prepare_arglist(['-start', '1000', '--segments', '4'], False)
+        c6 = BaseConfig()
+        c6.read(parsed6, False)
+        self.assertEqual((0.0, 1, 8 * 4), c6.pacing[RequestClass.MEDIA])
+        with patch('fetch_html.Config', c6):
+            self.assertEqual(2 + 8 * 4, calc_connection_limit())
+        print(f'{self._testMethodName} passed')
+
+
+class LimiterTests(TestCase):
+    def test_token_bucket(self):
+        set_up_test()
+        order = list()
+
+        async def take(bucket: TokenBucket, idx: int) -> float:
+            await bucket.acquire()
+            order.append(idx)
+            return get_running_loop().time()
+
+        async def run_bucket() -> None:
+            bucket = TokenBucket(20.0, 2)
+            start = get_running_loop().time()
+            times = await gather(*(take(bucket, i) for i in range(6)))
+            self.assertEqual(list(range(6)), order)
+            self.assertLess(times[1] - start, 0.02)  # burst
+            self.assertGreaterEqual(times[-1] - start, 0.19)  # 4 more tokens at 20/s
+        run_async(run_bucket())
+        print(f'{self._testMethodName} passed')
+
+    def test_limiter_slot_generations(self):
+        set_up_test()
+        RequestLimiter.reset()
+        url = 'https://example.com/'
+
+        async def take_slot() -> int:
+            return await RequestLimiter.until_ready(url, RequestClass.API)
+
+        async def slot_is_free() -> bool:
+            try:
+                await wait_for(take_slot(), 0.1)
+                return True
+            except AsyncTimeoutError:
+                return False
+
+        async def run_new_loop(old_generation: int) -> None:
+            generation = await take_slot()
+            self.assertNotEqual(old_generation, generation)
+            # slot taken in previous event loop doesn't free a slot of the new one
+            RequestLimiter.release(RequestClass.API, old_generation)
+            self.assertFalse(await slot_is_free())
+            RequestLimiter.release(RequestClass.API, generation)
+            self.assertTrue(await slot_is_free())
+
+        with patch.dict(Config.pacing, {RequestClass.API: (0.0, 1, 1)}):
+            run_async(run_new_loop(run_async(take_slot())))
+        RequestLimiter.reset()
+        print(f'{self._testMethodName} passed')
+
+    def test_bandwidth_shaper(self):
+        set_up_test()
+        order = list()
+
+        async def transfer(name: str, size: int, priority: bool) -> None:
+            for _ in range(size // (64 * Mem.KB)):
+                await BandwidthShaper.consume(64 * Mem.KB, priority)
+            order.append(name)
+
+        async def run_shaper() -> None:
+            start = get_running_loop().time()
+            await gather(transfer('big1', 512 * Mem.KB, False), transfer('big2', 512 * Mem.KB, False),
+                         transfer('small', 128 * Mem.KB, True))
+            # small file is served first, others share the rest
+            self.assertEqual('small', order[0])
+            self.assertGreaterEqual(get_running_loop().time() - start, 0.5)  # 1152 Kb at 2048 Kb/s
+            self.assertTrue(BandwidthShaper.limiting())
+
+        parsed = prepare_arglist(['-start', '1000', '--bandwidth', '2048', '--bandwidth-schedule', '23:00-07:30=0,12:00-13:00=100'], False)
+        self.assertEqual([(23 * 60, 7 * 60 + 30, 0), (12 * 60, 13 * 60, 100)], parsed.bandwidth_schedule)
+        Config.bandwidth = 2048
+        try:
+            BandwidthShaper.reset()
+            run_async(run_shaper())
+            self.assertEqual(1152 * Mem.KB, BandwidthShaper.bytes_shaped)
+            # schedule interval covering current time takes precedence, bandwidth file overrides both
+            Config.bandwidth_schedule = [(1, 0, 512), (0, 1, 512)]
+            self.assertEqual(512, BandwidthShaper.current_limit())
+            with TemporaryDirectory() as tempdir:
+                Config.bandwidth_file = f'{normalize_path(tempdir)}bandwidth.txt'
+                self.assertEqual(512, BandwidthShaper.current_limit())
+                BandwidthShaper.reset()
+                with open(Config.bandwidth_file, 'wt') as bfile:
+                    bfile.write('0')
+                self.assertEqual(0, BandwidthShaper.current_limit())
+        finally:
+            Config.bandwidth, Config.bandwidth_schedule, Config.bandwidth_file = 0, None, None
+            BandwidthShaper.reset()
+        print(f'{self._testMethodName} passed')
+
+
+class QueuePolicyTests(TestCase):
+    def test_queue_policies(self):
+        set_up_test()
+        mb = Mem.MB
+        waiting = [500 * mb, 0, 2 * mb, 100 * mb, 2 * mb]
+        self.assertEqual(0, make_queue_policy('id').pick(waiting, []))
+        self.assertEqual(2, make_queue_policy('smallest').pick(waiting, []))
+        self.assertEqual(0, make_queue_policy('largest').pick(waiting, []))
+        self.assertEqual(0, make_queue_policy('smallest').pick([0, 0], []))
+        self.assertIsNone(make_queue_policy('largest').pick([], []))
+        # small file lane: large files can't take the last slots
+        mixed = make_queue_policy('mixed')
+        self.assertEqual(0, mixed.pick(waiting, [300 * mb] * 5))
+        self.assertEqual(2, mixed.pick(waiting, [300 * mb] * 5 + [0]))
+        self.assertIsNone(mixed.pick([500 * mb, 0], [300 * mb] * 6))
+        # 10 files of 100 Mb and 10 of 1 Mb at 1 Mb/s: total time doesn't depend on order, average file completion time does
+        sizes = [100 * mb] * 10 + [mb] * 10
+        done_id, avg_id = project_completion(make_queue_policy('id'), sizes, [], mb)
+        done_sjf, avg_sjf = project_completion(make_queue_policy('smallest'), sizes, [], mb)
+        self.assertAlmostEqual(1010.0, done_id)
+        self.assertAlmostEqual(1010.0, done_sjf)
+        self.assertLess(avg_sjf, avg_id * 0.6)
+        self.assertEqual((500.0, 500.0), project_completion(make_queue_policy('id'), [], [(1000 * mb, 500 * mb)], mb))
+        self.assertIsNone(project_completion(make_queue_policy('id'), [0, 0], [], mb))
+        self.assertIsNone(project_completion(make_queue_policy('id'), [mb], [], 0.0))
+        print(f'{self._testMethodName} passed')
+
+
+class SizeProbeTests(TestCase):
+    def test_size_prober(self):
+        set_up_test()
+        events = list()
+
+        async def probe(vi: VideoInfo) -> None:
+            events.append(('probe', vi.id))
+            await sleep(0.05)
+            vi.expected_size = (100 - vi.id) * Mem.MB
+            events.append(('probed', vi.id))
+
+        async def download(vi: VideoInfo) -> DownloadResult:
+            events.append(('download', vi.id))
+            await sleep(0.3)
+            return DownloadResult.SUCCESS
+
+        Config.queue_policy, Config.size_probe = 'smallest', True
+        try:
+            with patch('downloader.SIZE_PROBE_LOOKAHEAD', 4):
+                dwn = VideoDownloadWorker([VideoInfo(idi) for idi in range(20)], download, 0, None, False, probe)
+                run_async(dwn.run())
+        finally:
+            Config.queue_policy, Config.size_probe = 'id', False
+        downloads = [idi for event, idi in events if event == 'download']
+        self.assertEqual(sorted(downloads), list(range(20)))
+        # downloading doesn't wait for probes, unprobed items are started in id order
+        self.assertEqual(0, downloads[0])
+        self.assertLess(events.index(('download', 0)), [event for event, _ in events].index('probed'))
+        # probes are limited to lookahead window, every item is probed once
+        in_flight = max_in_flight = 0
+        for event, _ in events:
+            in_flight += 1 if event == 'probe' else -1 if event == 'probed' else 0
+            max_in_flight = max(max_in_flight, in_flight)
+        self.assertLessEqual(max_in_flight, 4)
+        probes = [idi for event, idi in events if event == 'probe']
+        self.assertEqual(len(set(probes)), len(probes))
+        print(f'{self._testMethodName} passed')
+
+
+class DiskSpaceTests(TestCase):
+    def test_disk_space_mounts(self):
+        set_up_test()
+        events = list()
+        freed = list()
+        deferred = list()
+
+        def disk_usage(folder: str) -> SimpleNamespace:
+            return SimpleNamespace(free=(20 if 'full' in folder and not freed else 100) * Mem.MB)
+
+        async def download(vi: VideoInfo) -> DownloadResult:
+            if vi.id == 3 and not deferred:
+                deferred.append(vi.id)
+                return DownloadResult.FAIL_DEFERRED
+            events.append(('download', vi.id))
+            await sleep(0.1)
+            if vi.id == 3:
+                freed.append(vi.id)
+            return DownloadResult.SUCCESS
+
+        with TemporaryDirectory() as tempdir:
+            Config.dest_base, Config.min_free_space = normalize_path(tempdir), 15
+            vis = [VideoInfo(1, m_subfolder='full', m_filename='1.mp4'), VideoInfo(2, m_subfolder='full', m_filename='2.mp4'),
+                   VideoInfo(3, m_subfolder='other', m_filename='3.mp4')]
+            for vi in vis:
+                vi.expected_size = 10 * Mem.MB
+            try:
+                with patch('dspace.disk_usage', side_effect=disk_usage), patch('dspace.DISK_SPACE_CHECK_INTERVAL', 0.05), \
+                        patch('dspace.stat', side_effect=lambda folder: SimpleNamespace(st_dev=1 if 'full' in folder else 2)):
+                    dwn = VideoDownloadWorker(vis, download, 0, None)
+                    run_async(dwn.run())
+            finally:
+                Config.min_free_space = 0
+        # items held on a full mount don't take download slots, item on another mount starts (and restarts once deferred) first
+        self.assertEqual([3], deferred)
+        self.assertEqual(('download', 3), events[0])
+        self.assertEqual([1, 2], sorted(idi for _, idi in events[1:]))
+        self.assertEqual({1, 2, 3}, dwn.get_completed_ids())
+        print(f'{self._testMethodName} passed')
+
+
+class RetryTests(TestCase):
+    def test_retry_policy(self):
+        set_up_test()
+        RetryStats.reset()
+        policy = RetryPolicy(3, 2)
+        policy.failed(None, False)
+        self.assertFalse(policy.exhausted)
+        self.assertLessEqual(policy.next_delay(None), 1.0)
+        policy.failed(None)
+        policy.failed(None)
+        self.assertTrue(1.0 <= policy.next_delay(None) <= 2.0)
+        r403 = SimpleNamespace(status=403, headers={'Retry-After': '7'})
+        self.assertEqual(7.0, policy.next_delay(r403))
+        policy.failed(r403)
+        self.assertFalse(policy.exhausted)
+        policy.failed(r403)
+        self.assertTrue(policy.exhausted)
+        self.assertEqual((5, 1, 2, 1, 1), (RetryStats.failures, RetryStats.retries_uncounted, RetryStats.retries_403,
+                                           RetryStats.retry_after_waits, RetryStats.gave_up))
+        print(f'{self._testMethodName} passed')
+
+    def test_circuit_breaker(self):
+        set_up_test()
+        RetryStats.reset()
+        CircuitBreaker.reset_all()
+
+        async def run_breaker() -> None:
+            breaker = CircuitBreaker.get('https://example.com/page/1/')
+            self.assertIs(breaker, CircuitBreaker.get('https://example.com/page/2/'))
+            self.assertFalse(await breaker.until_closed())
+            for i in range(10):
+                breaker.record(i % 2 == 1, False)
+            self.assertEqual(CircuitBreaker.State.OPEN, breaker.state)
+            start = get_running_loop().time()
+            waiters = [get_running_loop().create_task(breaker.until_closed()) for _ in range(3)]
+            self.assertTrue(await waiters[0])  # probe
+            self.assertGreaterEqual(get_running_loop().time() - start, 0.05)
+            breaker.record(False, True)  # failed probe, pause again for twice as long
+            self.assertTrue(await waiters[1])
+            self.assertGreaterEqual(get_running_loop().time() - start, 0.15)
+            breaker.record(True, True)
+            self.assertFalse(await waiters[2])
+            self.assertEqual(CircuitBreaker.State.CLOSED, breaker.state)
+        with patch('rpolicy.BREAKER_COOLDOWN_BASE', 0.05):
+            run_async(run_breaker())
+        self.assertEqual(2, RetryStats.breaker_trips)
+        CircuitBreaker.reset_all()
+        print(f'{self._testMethodName} passed')
+
+    def test_circuit_breaker_expired_media(self):
+        set_up_test()
+        CircuitBreaker.reset_all()
+        with TemporaryDirectory() as replaydir:
+            archive = ResponseArchive(normalize_path(replaydir))
+            media_link, api_link = 'https://cdn.example.com/get_file/1/aa/1/1_360p.mp4/', 'https://example.com/popup/1/'
+            for link in (media_link, api_link):
+                archive.store('GET', link, 403, [('Content-Type', 'text/html')], b'<html>Forbidden</html>')
+
+            async def until_ready(*_) -> int:
+                return 0
+
+            async def run_requests(link: str, rclass: RequestClass) -> None:
+                for _ in range(BREAKER_MIN_REQUESTS):
+                    async with await wrap_request(ReplaySession(archive), 'GET', link, rclass=rclass) as r:
+                        self.assertEqual(403, r.status)
+            with patch.object(RequestLimiter, 'until_ready', until_ready), patch.object(RequestLimiter, 'release'):
+                # expired media links are refreshed, they don't pause the host
+                run_async(run_requests(media_link, RequestClass.MEDIA))
+                self.assertEqual(CircuitBreaker.State.CLOSED, CircuitBreaker.get(media_link).state)
+                run_async(run_requests(api_link, RequestClass.API))
+                self.assertEqual(CircuitBreaker.State.OPEN, CircuitBreaker.get(api_link).state)
+        CircuitBreaker.reset_all()
+        print(f'{self._testMethodName} passed')
+
+
+class SingleFlightTests(TestCase):
+    def test_single_flight(self):
+        set_up_test()
+        calls = list()
+
+        async def fetch(key: str) -> str:
+            calls.append(key)
+            await sleep(0.05)
+            if key == 'bad':
+                raise IOError(key)
+            return key.upper()
+
+        async def run_flights() -> None:
+            flights = SingleFlight()
+            results = await gather(*(flights.run(key, lambda k=key: fetch(k)) for key in ('a', 'a', 'b', 'a', 'bad', 'bad')),
+                                   return_exceptions=True)
+            self.assertEqual(['A', 'A', 'B', 'A'], results[:4])
+            self.assertIsInstance(results[4], IOError)
+            self.assertIs(results[4], results[5])
+            self.assertEqual(['a', 'b', 'bad'], calls)
+            self.assertEqual((3, 3), (flights.started, flights.coalesced))
+            # one of two callers is cancelled, call proceeds for the other
+            t1 = get_running_loop().create_task(flights.run('c', lambda: fetch('c')))
+            t2 = get_running_loop().create_task(flights.run('c', lambda: fetch('c')))
+            await sleep(0.01)
+            t1.cancel()
+            self.assertEqual('C', await t2)
+            self.assertRaises(CancelledError, t1.result)
+            self.assertFalse(flights.in_flight('c'))
+            await flights.run('a', lambda: fetch('a'))
+            self.assertEqual(['a', 'b', 'bad', 'c', 'a'], calls)
+        run_async(run_flights())
+        print(f'{self._testMethodName} passed')
+
+
+class ProxyPoolTests(TestCase):
+    def test_proxy_pool(self):
+        set_up_test()
+
+        class FakeSession:
+            def __init__(self, failing: bool) -> None:
+                self.failing = failing
+                self.closed = False
+                self.headers = list()
+
+            async def request(self, *_, headers, **__) -> SimpleNamespace:
+                self.headers.append(headers)
+                if self.failing:
+                    raise ClientConnectionError
+                return SimpleNamespace(content=SimpleNamespace(total_bytes=0))
+
+        async def run_pool() -> None:
+            pool = ProxyPool(['p0', 'p1', 'p2'], lambda proxy, _: FakeSession(proxy == 'p2'))
+            pool.headers.update({'User-Agent': 'test'})
+            p0, p1, p2 = pool.proxies
+            responses = list()
+            for _ in range(9):
+                try:
+                    responses.append(await pool.request('GET', 'https://example.com/', headers={'Range': 'bytes=0-'}))
+                except ClientConnectionError:
+                    pass
+            self.assertEqual(3, p2.requests)
+            self.assertTrue(p2.quarantined(monotonic()))
+            self.assertEqual((3, 3), (p0.inflight, p1.inflight))
+            self.assertEqual(('test', 'bytes=0-'), (p0.session.headers[0]['User-Agent'], p0.session.headers[0]['Range']))
+            [pool.response_closed(r, False) for r in responses]
+            self.assertEqual((0, 0, 0), (p0.inflight, p1.inflight, p2.inflight))
+            p1.error_rate = 0.5  # p1 gets only half of p0 load
+            for _ in range(6):
+                await pool.request('GET', 'https://example.com/')
+            self.assertEqual((4, 2), (p0.inflight, p1.inflight))
+        run_async(run_pool())
+        print(f'{self._testMethodName} passed')
+
+
+class ParserTests(TestCase):
+    def test_popup_parity(self):
+        set_up_test()
+        for page in (POPUP_PAGE_FULL, POPUP_PAGE_PRIVATE, POPUP_PAGE_404):
+            content = page.encode()
+            self.assertEqual(vars(extract_popup_data_bs4(make_soup(content))), vars(parse_popup(content)))
+        full = POPUP_PAGE_FULL.encode()
+        self.assertEqual(vars(extract_popup_data_bs4(make_soup(full))), vars(extract_popup_data(full)))
+        self.assertRaises(ValueError, extract_popup_data, POPUP_PAGE_PRIVATE.encode())
+        print(f'{self._testMethodName} passed')
+
+    def test_popup_saved_pages(self):
+        set_up_test()
+        pages = dict()  # type: Dict[str, bytes]
+        for filename in sorted(listdir(TESTDATA_DIR)):
+            if filename.startswith('popup_'):
+                with open(f'{TESTDATA_DIR}{filename}', 'rb') as infile:
+                    pages[filename] = infile.read()
+        self.assertEqual(['popup_deleted.html', 'popup_full.html', 'popup_minimal.html', 'popup_private.html'], list(pages))
+        for filename, content in pages.items():
+            with self.subTest(page=filename):
+                bs4_data = extract_popup_data_bs4(make_soup(content))
+                self.assertEqual(vars(bs4_data), vars(extract_popup_data(content)))
+                self.assertTrue(bs4_data.complete)
+        full = extract_popup_data(pages['popup_full.html'])
+        self.assertEqual('Lost Temple & the Keeper - part 3', full.title)
+        self.assertEqual(['None', 'Sculptor', 'Voice\xa0Over'], full.artists)
+        self.assertEqual(['temple', 'keeper', '60fps', 'sound', 'animated'], full.tags)
+        self.assertEqual('Keeper_Studio', full.uploader)
+        self.assertEqual(['night_owl', 'Anon & Co', 'Keeper_Studio'], [author for author, _ in full.comments])
+        self.assertEqual(['MP4 360p, 18.20 Mb', 'MP4 720p, 51.96 Mb', 'MP4 1080p, 104.10 Mb'], [ltext for ltext, _ in full.links])
+        self.assertTrue(full.description.startswith('Third part of the series.'))
+        self.assertEqual([], extract_popup_data(pages['popup_minimal.html']).categories)
+        self.assertIsNone(extract_popup_data(pages['popup_private.html']).links)
+        self.assertTrue(extract_popup_data(pages['popup_deleted.html']).not_found)
+        print(f'{self._testMethodName} passed')
+
+    def test_popup_full(self):
+        set_up_test()
+        data = parse_popup(POPUP_PAGE_FULL.encode())
+        self.assertFalse(data.not_found)
+        self.assertEqual('Wizard & Co ep. 2', data.title)
+        self.assertEqual('1 234 likes', data.likes)
+        self.assertEqual(['None', 'Artist One', 'Artist\xa0Two'], data.artists)
+        self.assertEqual(['3D', 'Overwatch'], data.categories)
+        self.assertEqual(['big hat', 'wizard', 'nested', 'None'], data.tags)
+        self.assertEqual('Uploader_X ', data.uploader)
+        self.assertEqual('First line\nsecond \nbold\n line', data.description)
+        self.assertEqual([('user 2', ' Nice!\nVery nice <3 '), ('Uploader_X', 'Made with \nstuff\n\nenjoy')], data.comments)
+        self.assertEqual(['MP4 360p', 'MP4 720p'], [ltext for ltext, _ in data.links])
+        self.assertTrue(data.links[0][1].endswith('download=true&v=1'))
+        self.assertIsNone(data.message)
+        print(f'{self._testMethodName} passed')
+
+    def test_popup_incomplete(self):
+        set_up_test()
+        private = parse_popup(POPUP_PAGE_PRIVATE.encode())
+        self.assertEqual(['This video is a private video uploaded by someone.'], private.categories)
+        self.assertIsNone(private.tags)
+        self.assertIsNone(private.links)
+        self.assertEqual('This video is a private video uploaded by someone.', private.message)
+        self.assertTrue(parse_popup(POPUP_PAGE_404.encode()).not_found)
+        print(f'{self._testMethodName} passed')
+
+
+class ParserPoolTests(TestCase):
+    def test_page_data(self):
+        set_up_test()
+        data = extract_page_data(SEARCH_PAGE.encode(), 'th js-open-popup')
+        self.assertEqual(17, data.maxpage)
+        self.assertEqual([('/video/3902/v3902/', 'Third'), ('/video/3901/v3901/', 'Second & first')], data.refs)
+        self.assertEqual(['Third', 'Second'], [title for _, title in data.previews])
+        self.assertEqual(data.refs, extract_page_data(SEARCH_PAGE.encode(), 'th').refs)
+        self.assertIsNone(extract_page_data(POPUP_PAGE_404.encode(), 'th').previews)
+        print(f'{self._testMethodName} passed')
+
+    def test_parser_modes(self):
+        set_up_test()
+
+        async def parse_all() -> list:
+            return await gather(ParserPool.run(extract_popup_data, POPUP_PAGE_FULL.encode()),
+                                ParserPool.run(partial(extract_page_data, video_ref_class='th'), SEARCH_PAGE.encode()))
+
+        expected = run_async(parse_all())
+        for mode in PARSER_MODES:
+            Config.parser_mode = mode
+            try:
+                popup, page = run_async(parse_all())
+                self.assertEqual(vars(expected[0]), vars(popup))
+                self.assertEqual(vars(expected[1]), vars(page))
+            finally:
+                ParserPool.shutdown()
+                Config.parser_mode = PARSER_MODE_DEFAULT
+        print(f'{self._testMethodName} passed')
+
+
+class CacheTests(TestCase):
+    def test_cache_lru(self):
+        set_up_test()
+        with TemporaryDirectory() as tempdir:
+            Config.dest_base, Config.cache, Config.cache_size = normalize_path(tempdir), True, 1
+            urls = [f'https://example.com/page/{i:d}' for i in range(3)]
+            ResponseCache.store(urls[0], b'0' * (400 * Mem.KB), '"e0"', None)
+            ResponseCache.store(urls[1], b'1' * (400 * Mem.KB), None, None)
+            self.assertEqual('"e0"', ResponseCache.get(urls[0]).revalidation_headers.get('If-None-Match'))
+            ResponseCache.store(urls[2], b'2' * (400 * Mem.KB), None, None)  # 1 is least recently used now
+            self.assertIsNone(ResponseCache.get(urls[1]))
+            self.assertTrue(ResponseCache.get(urls[0]).fresh)
+            self.assertEqual(b'2' * (400 * Mem.KB), ResponseCache.get(urls[2]).content)
+            Config.dest_base, Config.cache, Config.cache_size = None, None, CACHE_SIZE_DEFAULT
+        print(f'{self._testMethodName} passed')
+
+    def test_cache_video_info(self):
+        set_up_test()
+        fetch_time = time() - 60 * (Config.cache_ttl_videos + 1)
+        page = CacheEntry(SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, 1), b'', fetch_time, '"e0"', '')
+        popup = CacheEntry(f'{SITE_AJAX_REQUEST_VIDEO % 3055235}?popup_id=7', b'', fetch_time, '"e1"', '')
+        self.assertTrue(page.fresh)
+        self.assertEqual('"e0"', page.revalidation_headers.get('If-None-Match'))
+        # video info holds signed media links, it expires sooner and is never revalidated
+        self.assertFalse(popup.fresh)
+        self.assertEqual({}, popup.revalidation_headers)
+        print(f'{self._testMethodName} passed')
+
+
+class WriterTests(TestCase):
+    def test_write_behind(self):
+        set_up_test()
+        WriteStats.reset()
+        with TemporaryDirectory() as tempdir:
+            filepath = f'{normalize_path(tempdir)}file.bin'
+            chunks = [bytes([i]) * (256 * Mem.KB) for i in range(16)]
+            written = list()
+
+            async def write_all(offset: int = None) -> None:
+                async with FileWriter(filepath, offset, written.append) as outf:
+                    for chunk in chunks:
+                        await outf.write(chunk)
+
+            Config.write_buffer = 1
+            try:
+                run_async(write_all())
+                with open(filepath, 'rb') as infile:
+                    self.assertEqual(b''.join(chunks), infile.read())
+                # chunks queued while the disk is busy are merged, reader waits once buffer is full
+                self.assertLess(WriteStats.writes, len(chunks))
+                self.assertGreater(WriteStats.backpressure_waits, 0)
+                self.assertEqual(4 * Mem.MB, sum(written))
+                self.assertEqual(0, WriteStats.queued_bytes)
+                run_async(write_all(Mem.MB))
+                with open(filepath, 'rb') as infile:
+                    self.assertEqual(b''.join(chunks[:4] + chunks), infile.read())
+            finally:
+                Config.write_buffer = WRITE_BUFFER_DEFAULT
+                WriterPool.shutdown()
+        print(f'{self._testMethodName} passed')
+
+
+class ReplayTests(TestCase):
+    TEMPFILE_ID = 3055235
+
+    def setUp(self) -> None:
+        tempdir, replaydir = TemporaryDirectory(), TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.addCleanup(replaydir.cleanup)
+        self.tempdir, self.replaydir = normalize_path(tempdir.name), normalize_path(replaydir.name)
+        self.archive = ResponseArchive(self.replaydir)
+
+    @staticmethod
+    def popup_link(tempfile_id: int) -> str:
+        return f'{SITE_AJAX_REQUEST_VIDEO % tempfile_id}?popup_id={2 + tempfile_id % 10:d}'
+
+    @staticmethod
+    def media_link(tempfile_id: int, server=1) -> str:
+        return f'{SITE}/get_file/{server:d}/aa/3055000/{tempfile_id:d}_360p.mp4/?download=true&v=1'
+
+    def store_popup(self, tempfile_id: int, media_link: str) -> None:
+        self.archive.store('GET', self.popup_link(tempfile_id), 200, [('Content-Type', 'text/html; charset=utf-8')],
+                           POPUP_PAGE_FULL.replace('https://example.com/get_file/1/aa/1/1_360p.mp4/?download=true&amp;v=1',
+                                                   media_link.replace('&', '&amp;')).encode())
+
+    def store_video(self, media_body: bytes, tempfile_id=TEMPFILE_ID, headers=(('Accept-Ranges', 'bytes'),)) -> str:
+        """Stores video popup and its media file, returns media link"""
+        media_link = self.media_link(tempfile_id)
+        self.store_popup(tempfile_id, media_link)
+        self.archive.store('GET', media_link, 200, [('Content-Type', 'video/mp4'), *headers], media_body)
+        return media_link
+
+    def ids_args(self, *args: str, tempfile_id=TEMPFILE_ID) -> List[str]:
+        return ['-path', self.tempdir, '-start', str(tempfile_id), '-dmode', 'full', '-naming', 'none', '-quality', '360p',
+                '--replay', self.replaydir, *args]
+
+    def file_path(self, tempfile_id=TEMPFILE_ID) -> str:
+        return f'{self.tempdir}{tempfile_id:d}.mp4'
+
+    def assertFileContent(self, content: bytes, tempfile_id=TEMPFILE_ID) -> None:
+        with open(self.file_path(tempfile_id), 'rb') as infile:
+            self.assertEqual(content, infile.read())
+
+    def write_file(self, content: bytes, tempfile_id=TEMPFILE_ID) -> None:
+        with open(self.file_path(tempfile_id), 'wb') as outfile:
+            outfile.write(content)
+
+    def test_replay_recorder(self):
+        set_up_test()
+        media_body = bytes(range(256)) * 4
+        media_link = self.media_link(self.TEMPFILE_ID)
+        trace_config = make_recorder(self.archive)
+
+        async def record(status: int, first: int, last: int) -> None:
+            headers = CIMultiDict({'Content-Type': 'video/mp4'})
+            if status == 206:
+                headers['Content-Range'] = f'bytes {first:d}-{last:d}/{len(media_body):d}'
+            ctx = SimpleNamespace()
+            response = SimpleNamespace(status=status, reason='OK', headers=headers, url=URL(media_link))
+            await trace_config.on_request_start[0](None, ctx, SimpleNamespace(url=URL(media_link)))
+            await trace_config.on_request_end[0](None, ctx, SimpleNamespace(method='GET', response=response))
+            await trace_config.on_response_chunk_received[0](None, ctx, SimpleNamespace(method='GET', chunk=media_body[first:last + 1]))
+
+        async def replay(range_header: str) -> Tuple[int, str, bytes]:
+            r = await ReplaySession(self.archive).request('GET', media_link, headers={'Range': range_header})
+            return r.status, r.headers.get('Content-Range', ''), await r.read()
+
+        def recorded() -> Tuple[int, int]:
+            return self.archive.load_meta('GET', media_link)['offset'], self.archive.body_size('GET', media_link)
+
+        async def run() -> None:
+            size = len(media_body)
+            await record(206, 100, 599)
+            self.assertEqual(size, self.archive.load_meta('GET', media_link)['total'])
+            # full size comes from recorded 'Content-Range', not from recorded part
+            self.assertEqual((206, f'bytes 100-599/{size:d}', media_body[100:600]), await replay('bytes=100-'))
+            # smaller part does not replace larger one
+            await record(206, 200, 299)
+            self.assertEqual((100, 500), recorded())
+            # continuation extends recorded part
+            await record(206, 500, size - 1)
+            self.assertEqual((100, size - 100), recorded())
+            self.assertEqual((206, f'bytes 100-{size - 1:d}/{size:d}', media_body[100:]), await replay('bytes=100-'))
+            # complete response replaces part of it, but not the other way around
+            await record(200, 0, size - 1)
+            await record(206, 0, 99)
+            self.assertEqual((0, size), recorded())
+            self.assertEqual((206, f'bytes 0-99/{size:d}', media_body[:100]), await replay('bytes=0-99'))
+        run_async(run())
+        print(f'{self._testMethodName} passed')
+
+    def test_ids_replay(self):
+        set_up_test()
+        media_body = bytes(range(256)) * 64
+        self.store_video(media_body)
+        arglist1 = self.ids_args('--replay-latency', '5')
+        ids_main_sync(arglist1)
+        self.assertFileContent(media_body)
+        # interrupted download is resumed using 'Range' request
+        self.write_file(media_body[:1000])
+        set_up_test()
+        ids_main_sync(arglist1 + ['-continue'])
+        self.assertFileContent(media_body)
+        print(f'{self._testMethodName} passed')
+
+    def test_ids_replay_segments(self):
+        set_up_test()
+        tempfile_fullpath = self.file_path()
+        media_body = bytes(range(256)) * 4500
+        self.store_video(media_body)
+        request_orig = ReplaySession.request
+        with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+            ids_main_sync(self.ids_args('--segments', '3', '--segment-threshold', '1'))
+            ranges = [c.kwargs['headers']['Range'] for c in request_mock.call_args_list if 'Range' in (c.kwargs.get('headers') or {})]
+        self.assertEqual(['bytes=0-383999', 'bytes=384000-767999', 'bytes=768000-1151999'], sorted(ranges))
+        self.assertFileContent(media_body)
+        self.assertFalse(path.isfile(SegmentMap.sidecar_path(tempfile_fullpath)))
+        # interrupted segmented download is resumed using its segment map, even without '--segments'
+        segment_map = SegmentMap.create(tempfile_fullpath, len(media_body), 2)
+        segment_map.segments[0].pos = 1000
+        segment_map.segments[1].pos = len(media_body)
+        segment_map.save()
+        self.write_file(media_body[:1000] + bytes(len(media_body) // 2 - 1000) + media_body[len(media_body) // 2:])
+        set_up_test()
+        with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+            ids_main_sync(self.ids_args('-continue'))
+            ranges = [c.kwargs['headers']['Range'] for c in request_mock.call_args_list if 'Range' in (c.kwargs.get('headers') or {})]
+        self.assertEqual([f'bytes=1000-{len(media_body) // 2 - 1:d}'], ranges)
+        self.assertFileContent(media_body)
+        self.assertFalse(path.isfile(SegmentMap.sidecar_path(tempfile_fullpath)))
+        print(f'{self._testMethodName} passed')
+
+    def test_ids_replay_preallocate(self):
+        set_up_test()
+        tempfile_fullpath = self.file_path()
+        media_body = bytes(range(256)) * 1000
+        self.store_video(media_body)
+        arglist1 = self.ids_args('--preallocate', '--drop-cache', '--fsync')
+        ids_main_sync(arglist1)
+        self.assertFileContent(media_body)
+        self.assertFalse(path.isfile(SegmentMap.sidecar_path(tempfile_fullpath)))
+        # preallocated file is complete in size but not in content, it is not considered existing and gets finished
+        segment_map = SegmentMap.create(tempfile_fullpath, len(media_body), 1)
+        segment_map.segments[0].pos = 1000
+        segment_map.save()
+        self.write_file(media_body[:1000] + bytes(len(media_body) - 1000))
+        set_up_test()
+        ids_main_sync(arglist1)
+        self.assertFileContent(media_body)
+        self.assertFalse(path.isfile(SegmentMap.sidecar_path(tempfile_fullpath)))
+        # damaged segment map: preallocated file is not taken for a complete one, it is downloaded again
+        self.write_file(media_body[:1000] + bytes(len(media_body) - 1000))
+        with open(SegmentMap.sidecar_path(tempfile_fullpath), 'wt') as sfile:
+            sfile.write('{"size": 25')
+        set_up_test()
+        ids_main_sync(arglist1)
+        self.assertFileContent(media_body)
+        self.assertFalse(path.isfile(SegmentMap.sidecar_path(tempfile_fullpath)))
+        print(f'{self._testMethodName} passed')
+
+    def test_ids_replay_journal(self):
+        set_up_test()
+        journal_path = f'{self.tempdir}journal.jsonl'
+        media_body1, media_body2 = bytes(range(256)) * 64, bytes(reversed(range(256))) * 64
+        media_link = self.store_video(media_body1, headers=(('ETag', '"v1"'),))
+        arglist1 = self.ids_args('--journal', journal_path)
+        request_orig = ReplaySession.request
+        ids_main_sync(arglist1)
+        # verified file is skipped without any requests
+        set_up_test()
+        with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+            ids_main_sync(arglist1 + ['-continue'])
+            self.assertEqual(0, request_mock.call_count)
+        # truncated file is resumed with range validated by entity tag
+        self.write_file(media_body1[:1000])
+        set_up_test()
+        with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+            ids_main_sync(arglist1 + ['-continue'])
+            media_headers = [c.kwargs['headers'] for c in request_mock.call_args_list if 'Range' in (c.kwargs.get('headers') or {})]
+        self.assertEqual([{'Range': 'bytes=1000-', 'If-Range': '"v1"'}], media_headers)
+        self.assertFileContent(media_body1)
+        # remote file has changed, download is restarted
+        self.archive.store('GET', media_link, 200, [('Content-Type', 'video/mp4'), ('ETag', '"v2"')], media_body2)
+        self.write_file(media_body1[:1000])
+        set_up_test()
+        ids_main_sync(arglist1 + ['-continue'])
+        self.assertFileContent(media_body2)
+        with open(journal_path, 'rt') as jfile:
+            self.assertEqual('"v2"', loads(jfile.readlines()[-1])['etag'])
+        # file is full size but its transfer was never completed: range is not satisfiable, download is restarted
+        self.write_file(media_body2[:1000] + bytes(len(media_body2) - 1000))
+        with open(journal_path, 'at') as jfile:
+            jfile.write(dumps(dict(id=self.TEMPFILE_ID, path=self.file_path(), link=media_link, quality='360p', size=len(media_body2),
+                                   etag='"v2"', modified='', flushed=1000, done=False)) + '\n')
+        set_up_test()
+        ids_main_sync(arglist1 + ['-continue'])
+        self.assertFileContent(media_body2)
+        # file saved in a fallback quality is recognized by the quality requested: scanned once, then skipped without any requests
+        for expected_requests in (1, 0):
+            set_up_test()
+            with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+                ids_main_sync(arglist1 + ['-continue', '-quality', '1080p'])
+                self.assertEqual(expected_requests, request_mock.call_count)
+        with open(journal_path, 'rt') as jfile:
+            last_record = loads(jfile.readlines()[-1])
+        self.assertEqual(('360p', '1080p'), (last_record['quality'], last_record['requested']))
+        self.assertFileContent(media_body2)
+        print(f'{self._testMethodName} passed')
+
+    def test_ids_replay_link_refresh(self):
+        set_up_test()
+        popup_link = self.popup_link(self.TEMPFILE_ID)
+        media_link1, media_link2 = self.media_link(self.TEMPFILE_ID, 1), self.media_link(self.TEMPFILE_ID, 2)
+        media_body = bytes(range(256)) * 64
+
+        async def request_expiring(session: ReplaySession, method: str, url: str, **kwargs):
+            if url == media_link1:
+                self.store_popup(self.TEMPFILE_ID, media_link2)  # link expires after video is scanned
+            return await request_orig(session, method, url, **kwargs)
+
+        self.store_popup(self.TEMPFILE_ID, media_link1)
+        self.archive.store('GET', media_link1, 403, [('Content-Type', 'text/html')], b'<html>Forbidden</html>')
+        self.archive.store('GET', media_link2, 200, [('Content-Type', 'video/mp4'), ('Accept-Ranges', 'bytes')], media_body)
+        self.write_file(media_body[:1000])
+        request_orig = ReplaySession.request
+        RetryStats.reset()
+        with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_expiring) as request_mock:
+            ids_main_sync(self.ids_args('-continue'))
+            requests = [(c.args[2], (c.kwargs.get('headers') or {}).get('Range')) for c in request_mock.call_args_list]
+        # popup is requested again for the new link, download is continued at current offset without spending retries
+        self.assertEqual([(popup_link, None), (media_link1, 'bytes=1000-'), (popup_link, None), (media_link2, 'bytes=1000-')],
+                         requests)
+        self.assertEqual(0, RetryStats.retries_403)
+        self.assertFileContent(media_body)
+        print(f'{self._testMethodName} passed')
+
+    def test_ids_replay_disk_space(self):
+        set_up_test()
+        media_body = bytes(range(256)) * 64
+        media_link = self.store_video(media_body)
+        # space is freed up after a while
+        frees = iter([10 * Mem.MB, 10 * Mem.MB, 20 * Mem.MB])
+        request_orig = ReplaySession.request
+        RetryStats.reset()
+        with patch('dspace.disk_usage', side_effect=lambda _: SimpleNamespace(free=next(frees, 20 * Mem.MB))), \
+                patch('dspace.DISK_SPACE_CHECK_INTERVAL', 0.1), \
+                patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+            ids_main_sync(self.ids_args('--min-free-space', '15'))
+            requests = [c.args[2] for c in request_mock.call_args_list]
+        # held download drops its connection and requests file again once there is enough space, no retries are spent
+        self.assertEqual(2, requests.count(media_link))
+        self.assertEqual((0, 0), (RetryStats.failures, RetryStats.retries))
+        self.assertFileContent(media_body)
+        # reservations on the same mount add up, written data is not counted twice
+        Config.dest_base, Config.min_free_space = self.tempdir, 0
+        vi1, vi2, vi3 = VideoInfo(1, m_filename='1.mp4'), VideoInfo(2, m_filename='2.mp4'), VideoInfo(3, m_filename='3.mp4')
+        space = DiskSpaceAdmission()
+        with patch('dspace.disk_usage', return_value=SimpleNamespace(free=15 * Mem.MB)), \
+                patch('dspace.allocated_size', side_effect=allocated_size) as allocated_size_mock:
+            self.assertTrue(space.try_reserve(vi1, 10 * Mem.MB))
+            self.assertFalse(space.try_reserve(vi2, 10 * Mem.MB))
+            self.assertTrue(space.any_held())
+            # written data shrinks reservation without looking at reserved files
+            space.written(vi1, 6 * Mem.MB)
+            self.assertTrue(space.try_reserve(vi2, 10 * Mem.MB))
+            self.assertFalse(space.any_held())
+            self.assertEqual([vi1.my_fullpath, vi2.my_fullpath, vi2.my_fullpath], [c.args[0] for c in allocated_size_mock.call_args_list])
+            self.assertFalse(space.try_reserve(vi3, 2 * Mem.MB))
+            space.allocated(vi2)
+            space.release(vi1)
+            self.assertTrue(space.try_reserve(vi3, 2 * Mem.MB))
+        print(f'{self._testMethodName} passed')
+
+    def test_ids_replay_manifest(self):
+        set_up_test()
+        media_bodies = {3055235: bytes(range(256)) * 64, 3055236: bytes(range(256)) * 4500}
+        for tempfile_id, media_body in media_bodies.items():
+            self.store_video(media_body, tempfile_id)
+        # second file is downloaded in segments and hashed once completed
+        ids_main_sync(self.ids_args('-count', '2', '--manifest', '--segments', '2', '--segment-threshold', '1'))
+        self.assertEqual({f'{idi:d}.mp4': blake2b(body).hexdigest() for idi, body in media_bodies.items()},
+                         HashManifest.load(self.tempdir))
+        self.assertTrue(verify_main_sync(['-path', self.tempdir, '--workers', '2']))
+        with open(self.file_path(3055236), 'r+b') as outfile:
+            outfile.seek(1000)
+            outfile.write(b'\xff')
+        self.assertFalse(verify_main_sync(['-path', self.tempdir, '--workers', '2']))
+        print(f'{self._testMethodName} passed')
+
+    def test_pages_replay(self):
+        set_up_test()
+        with TemporaryDirectory() as tempdir, TemporaryDirectory() as replaydir:
+            tempdir, replaydir = normalize_path(tempdir), normalize_path(replaydir)
+            archive = ResponseArchive(replaydir)
+            maxpage = 4
+            for pi in range(1, maxpage + 1):
+                archive.store('GET', SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, pi), 200, [('Content-Type', 'text/html')],
+                              make_search_page(pi, maxpage).encode())
+            load_orig = ResponseArchive.load
+            with patch.object(ResponseArchive, 'load', autospec=True, side_effect=load_orig) as load_mock:
+                pages_main_sync(['-path', tempdir, '-pages', '10', '-uploader', '1', '-dmode', 'touch', '-naming', 'none',
+                                 '-quality', 'preview', '--replay', replaydir, '--replay-latency', '20', '--page-prefetch', '2'])
+                requested = sorted(call.args[2] for call in load_mock.call_args_list)
+            self.assertEqual(sorted(SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, pi) for pi in range(1, maxpage + 1)), requested)
+            for pi in range(1, maxpage + 1):
+                for vid in (4000 + pi * 10, 4001 + pi * 10):
+                    self.assertTrue(path.isfile(f'{tempdir}{vid:d}_preview.mp4'))
+        print(f'{self._testMethodName} passed')
+
+    def test_pages_size_probe(self):
+        set_up_test()
+        with TemporaryDirectory() as tempdir, TemporaryDirectory() as replaydir:
+            tempdir, replaydir = normalize_path(tempdir), normalize_path(replaydir)
+            archive = ResponseArchive(replaydir)
+            archive.store('GET', SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, 1), 200, [('Content-Type', 'text/html')],
+                          make_search_page(1, 1).encode())
+            media_bodies = {4010: bytes(range(256)) * 400, 4011: bytes(range(256)) * 4}
+            for vid, media_body in media_bodies.items():
+                archive.store('GET', f'https://example.com/screenshots/{vid:d}/{vid:d}_preview.mp4/', 200,
+                              [('Content-Type', 'video/mp4'), ('Accept-Ranges', 'bytes')], media_body)
+            request_orig = ReplaySession.request
+            with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock, \
+                    patch('download.wrap_request', side_effect=wrap_request) as wrap_mock:
+                pages_main_sync(['-path', tempdir, '-pages', '1', '-uploader', '1', '-dmode', 'full', '-naming', 'none',
+                                 '-quality', 'preview', '--replay', replaydir, '--queue-policy', 'smallest'])
+                requests = [(c.args[2], (c.kwargs.get('headers') or {}).get('Range')) for c in request_mock.call_args_list]
+                probe_classes = [c.kwargs.get('rclass') for c in wrap_mock.call_args_list
+                                 if (c.kwargs.get('headers') or {}).get('Range') == 'bytes=0-0']
+            # sizes are probed while downloads run (size probe is enabled by policy), probes are paced in their own class
+            probes = [url for url, range_header in requests if range_header == 'bytes=0-0']
+            self.assertGreaterEqual(len(probes), 1)
+            self.assertEqual([RequestClass.PROBE] * len(probes), probe_classes)
+            for vid, media_body in media_bodies.items():
+                with open(f'{tempdir}{vid:d}_preview.mp4', 'rb') as infile:
+                    self.assertEqual(media_body, infile.read())
+        print(f'{self._testMethodName} passed')
+
+    def test_pages_sources(self):
+        set_up_test()
+        self.assertRaises(ValueError, valid_page_source, 'unknown:1')
+        self.assertRaises(ValueError, valid_page_source, 'uploader:')
+        self.assertEqual(SITE_AJAX_REQUEST_MODEL_PAGE % ('gray', 3), valid_page_source('model:gray').page_address(3))
+        with TemporaryDirectory() as tempdir, TemporaryDirectory() as replaydir:
+            tempdir, replaydir = normalize_path(tempdir), normalize_path(replaydir)
+            archive = ResponseArchive(replaydir)
+            for pi in range(1, 3):
+                archive.store('GET', SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, pi), 200, [('Content-Type', 'text/html')],
+                              make_search_page(pi, 2).encode())
+                # overlaps with the first source
+                archive.store('GET', SITE_AJAX_REQUEST_UPLOADER_PAGE % (2, pi), 200, [('Content-Type', 'text/html')],
+                              make_search_page(pi, 2, 4000, 20).encode())
+            archive.store('GET', SITE_AJAX_REQUEST_MODEL_PAGE % ('gray', 1), 200, [('Content-Type', 'text/html')],
+                          make_search_page(1, 1, 3000).encode())
+            downloaded = list()
+
+            async def download_mock(sequence, *_) -> None:
+                downloaded.append([vi.id for vi in sequence])
+
+            arglist1 = ['-path', tempdir, '-pages', '10', '-uploader', '1', '-dmode', 'touch', '-naming', 'none', '-quality', 'preview',
+                        '--replay', replaydir, '--source', 'uploader:2', '--source', 'model:gray']
+            with patch('pages.download', download_mock):
+                pages_main_sync(arglist1)
+            # items of all the sources are queued in id order
+            self.assertEqual([[3010, 3011, 4010, 4011, 4020, 4021, 4040, 4041]], downloaded)
+        print(f'{self._testMethodName} passed')
+
+    def test_pages_seen_ids(self):
+        set_up_test()
+        with TemporaryDirectory() as tempdir, TemporaryDirectory() as replaydir:
+            tempdir, replaydir = normalize_path(tempdir), normalize_path(replaydir)
+            archive = ResponseArchive(replaydir)
+            for pi in range(1, 3):
+                archive.store('GET', SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, pi), 200, [('Content-Type', 'text/html')],
+                              make_search_page(pi, 2).encode())
+
+            def store_preview(vid: int) -> None:
+                archive.store('GET', f'https://example.com/screenshots/{vid:d}/{vid:d}_preview.mp4/', 200, [('Content-Type', 'video/mp4')],
+                              bytes(range(256)))
+
+            def requested_previews(request_mock) -> List[int]:
+                return sorted(int(c.args[2].split('/')[-3]) for c in request_mock.call_args_list if c.args[2].endswith('_preview.mp4/'))
+
+            seen_ids_path = f'{tempdir}seen.ids'
+            IdSet([4011, 5000]).save(seen_ids_path)
+            store_preview(4010)
+            store_preview(4020)  # 4021 is not available yet and fails
+            arglist1 = ['-path', tempdir, '-pages', '10', '-uploader', '1', '-dmode', 'full', '-naming', 'none', '-quality', 'preview',
+                        '--replay', replaydir, '--seen-ids', seen_ids_path]
+            request_orig = ReplaySession.request
+            with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+                pages_main_sync(arglist1)
+                self.assertEqual([4010, 4020, 4021], requested_previews(request_mock))
+            # only completed downloads are remembered
+            self.assertEqual([4011, 5000, 4020, 4010], list(IdSet.load(seen_ids_path)))
+            self.assertFalse(path.isfile(f'{seen_ids_path}.tmp'))
+            store_preview(4021)
+            set_up_test()
+            with patch.object(ReplaySession, 'request', autospec=True, side_effect=request_orig) as request_mock:
+                pages_main_sync(arglist1)
+                self.assertEqual([4021], requested_previews(request_mock))
+            self.assertEqual([4011, 5000, 4020, 4010, 4021], list(IdSet.load(seen_ids_path)))
+            self.assertEqual([4021, 4010, 4020, 5000, 4011], list(reversed(IdSet.load(seen_ids_path))))
+        print(f'{self._testMethodName} passed')
+
+    def test_pages_stream(self):
+        set_up_test()
+        with TemporaryDirectory() as tempdir, TemporaryDirectory() as replaydir:
+            tempdir, replaydir = normalize_path(tempdir), normalize_path(replaydir)
+            archive = ResponseArchive(replaydir)
+            maxpage = 4
+            for pi in range(1, maxpage + 1):
+                archive.store('GET', SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, pi), 200, [('Content-Type', 'text/html')],
+                              make_search_page(pi, maxpage).encode())
+            with open(f'{tempdir}4031_preview.mp4', 'wb') as outfile:
+                outfile.write(b'existing')
+            first_page_done_early = list()
+            load_orig = ResponseArchive.load
+
+            def load_checked(self_, method: str, url: str):
+                if url == SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, maxpage):
+                    first_page_done_early.append(path.isfile(f'{tempdir}4010_preview.mp4'))
+                return load_orig(self_, method, url)
+
+            with patch.object(ResponseArchive, 'load', load_checked):
+                pages_main_sync(['-path', tempdir, '-pages', '10', '-uploader', '1', '-dmode', 'touch', '-naming', 'none',
+                                 '-quality', 'preview', '--replay', replaydir, '--replay-latency', '500', '--page-prefetch', '0',
+                                 '--stream'])
+            self.assertEqual([True], first_page_done_early)
+            for pi in range(1, maxpage + 1):
+                for vid in (4000 + pi * 10, 4001 + pi * 10):
+                    self.assertTrue(path.isfile(f'{tempdir}{vid:d}_preview.mp4'))
+            with open(f'{tempdir}4031_preview.mp4', 'rb') as infile:
+                self.assertEqual(b'existing', infile.read())
+        print(f'{self._testMethodName} passed')
+
+    def test_pages_id_bounds(self):
+        set_up_test()
+        with TemporaryDirectory() as tempdir, TemporaryDirectory() as replaydir:
+            tempdir, replaydir = normalize_path(tempdir), normalize_path(replaydir)
+            archive = ResponseArchive(replaydir)
+            maxpage = 20
+            page_urls = {SITE_AJAX_REQUEST_SEARCH_PAGE % ('', '', '', 'abc', pi): pi for pi in range(1, maxpage + 1)}
+            for page_url, pi in page_urls.items():
+                # ids are descending: page 1 - 4990, 4991; page 2 - 4980, 4981; ...
+                archive.store('GET', page_url, 200, [('Content-Type', 'text/html')], make_search_page(pi, maxpage, 5000, -10).encode())
+            downloaded = list()
+
+            async def download_mock(sequence, *_) -> None:
+                downloaded.extend(vi.id for vi in sequence)
+
+            load_orig = ResponseArchive.load
+            with patch.object(ResponseArchive, 'load', autospec=True, side_effect=load_orig) as load_mock, \
+                    patch('pages.download', download_mock):
+                pages_main_sync(['-path', tempdir, '-pages', '100', '-search', 'abc', '-dmode', 'touch', '-naming', 'none',
+                                 '-quality', 'preview', '--replay', replaydir, '-begin_id', '4870', '-stop_id', '4840',
+                                 '--page-prefetch', '0'])
+                requested = sorted(page_urls[call.args[2]] for call in load_mock.call_args_list)
+            self.assertEqual([4840, 4841, 4850, 4851, 4860, 4861, 4870], sorted(downloaded))
+            # first page, binary search over 2..20, then pages 13..17
+            self.assertLessEqual(len(requested), 1 + 5 + 5)
+            self.assertTrue(all(pi in requested for pi in (1, 13, 14, 15, 16, 17)))
+            self.assertFalse(any(pi in requested for pi in (2, 3, 4, 18, 19, 20)))
+        print(f'{self._testMethodName} passed')
+
+    def test_pages_fanout(self):
+        set_up_test()
+        with TemporaryDirectory() as tempdir, TemporaryDirectory() as replaydir:
+            tempdir, replaydir = normalize_path(tempdir), normalize_path(replaydir)
+            archive = ResponseArchive(replaydir)
+            maxpage = 6
+            for pi in range(1, maxpage + 1):
+                archive.store('GET', SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, pi), 200, [('Content-Type', 'text/html')],
+                              make_search_page(pi, maxpage).encode())
+            fails = {SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, 2): 1, SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, 5): 100}
+
+            async def fetch_html_failing(url: str, **kwargs):
+                if fails.get(url, 0) > 0:
+                    fails[url] -= 1
+                    await sleep(0.05)
+                    return None
+                return await fetch_html(url, **kwargs)
+
+            downloaded = list()
+
+            async def download_mock(sequence, *_) -> None:
+                downloaded.extend(vi.id for vi in sequence)
+
+            with patch('pages.fetch_html', fetch_html_failing), patch('pages.download', download_mock):
+                pages_main_sync(['-path', tempdir, '-pages', '10', '-uploader', '1', '-dmode', 'touch', '-naming', 'none',
+                                 '-quality', 'preview', '--replay', replaydir, '--replay-latency', '20', '--page-workers', '3'])
+            # page 5 was skipped, page 2 was retried, order is preserved
+            self.assertEqual(100 - PAGE_RETRIES_MAX, fails[SITE_AJAX_REQUEST_UPLOADER_PAGE % (1, 5)])
+            self.assertEqual([vid for pi in (6, 4, 3, 2, 1) for vid in (4001 + pi * 10, 4000 + pi * 10)], downloaded)
         print(f'{self._testMethodName} passed')
 
 
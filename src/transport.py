@@ -0,0 +1,272 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+from __future__ import annotations
+from asyncio import sleep
+from hashlib import sha1
+from json import loads, dumps
+from os import path, makedirs
+from types import SimpleNamespace
+from typing import AsyncIterator, List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientResponseError, ClientPayloadError, CookieJar, RequestInfo, TraceConfig
+from aiohttp import TraceRequestStartParams, TraceRequestEndParams, TraceResponseChunkReceivedParams
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from config import Config
+from defs import Mem, UTF8
+from logger import Log
+
+__all__ = ('ResponseArchive', 'ReplaySession', 'ReplayResponse', 'make_recorder')
+
+BODY_EXT = 'body'
+META_EXT = 'json'
+# body is stored decoded
+SKIPPED_HEADERS = ('content-encoding', 'transfer-encoding')
+NOT_RECORDED_BODY = b'<html><head><title>404 Not Found</title></head><body>Not recorded</body></html>'
+
+
+def parse_content_range(content_range: str) -> Tuple[int, int, int]:
+    """Parses 'bytes first-last/total' header value, unknown parts are returned as -1"""
+    range_s, total_s = (content_range.replace('bytes ', '').split('/', 1) + [''])[:2]
+    first_s, last_s = (range_s.split('-', 1) + [''])[:2]
+    return tuple(int(v) if v.isnumeric() else -1 for v in (first_s, last_s, total_s))
+
+
+class ResponseArchive:
+    """
+    Recorded responses folder. Each response is stored as raw body and json meta (status, headers, final url),
+    keyed by request method and url. For partial (206) responses their offset within the full resource and its full size are stored too
+    """
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+
+    def _paths(self, method: str, url: str) -> Tuple[str, str]:
+        key = sha1(f'{method.upper()} {url}'.encode(UTF8)).hexdigest()
+        return f'{self.folder}{key}.{BODY_EXT}', f'{self.folder}{key}.{META_EXT}'
+
+    def load_meta(self, method: str, url: str) -> Optional[dict]:
+        meta_path = self._paths(method, url)[1]
+        if not path.isfile(meta_path):
+            return None
+        with open(meta_path, 'rt', encoding=UTF8) as mfile:
+            return loads(mfile.read())
+
+    def load(self, method: str, url: str) -> Optional[Tuple[dict, bytes]]:
+        meta = self.load_meta(method, url)
+        if meta is None:
+            return None
+        with open(self._paths(method, url)[0], 'rb') as bfile:
+            return meta, bfile.read()
+
+    def body_size(self, method: str, url: str) -> int:
+        body_path = self._paths(method, url)[0]
+        return path.getsize(body_path) if path.isfile(body_path) else 0
+
+    def store_meta(self, method: str, url: str, status: int, reason: str, headers: List[Tuple[str, str]], final_url: str,
+                   keep_body=0) -> None:
+        """Stores response meta and truncates stored body to **keep_body** bytes"""
+        if not path.isdir(self.folder):
+            makedirs(self.folder)
+        body_path, meta_path = self._paths(method, url)
+        offset, total = 0, 0
+        if status == 206:
+            first, _, total = parse_content_range(dict(headers).get('Content-Range', ''))
+            offset, total = max(0, first), max(0, total)
+        with open(meta_path, 'wt', encoding=UTF8) as mfile:
+            mfile.write(dumps({'method': method.upper(), 'url': url, 'final_url': final_url, 'status': status, 'reason': reason,
+                               'headers': headers, 'offset': offset, 'total': total}))
+        with open(body_path, 'ab' if keep_body else 'wb') as bfile:
+            bfile.truncate(keep_body)
+
+    def append_body(self, method: str, url: str, chunk: bytes) -> None:
+        with open(self._paths(method, url)[0], 'ab') as bfile:
+            bfile.write(chunk)
+
+    def store(self, method: str, url: str, status: int, headers: List[Tuple[str, str]], body: bytes, reason='OK') -> None:
+        self.store_meta(method, url, status, reason, headers, url)
+        self.append_body(method, url, body)
+
+
+def make_recorder(archive: ResponseArchive) -> TraceConfig:
+    """Creates session trace config which stores every response received by session in **archive**"""
+    async def on_request_start(_: ClientSession, ctx: SimpleNamespace, params: TraceRequestStartParams) -> None:
+        ctx.record_url = str(params.url)
+        ctx.recording = False
+
+    async def on_request_end(_: ClientSession, ctx: SimpleNamespace, params: TraceRequestEndParams) -> None:
+        r = params.response
+        headers = [(k, v) for k, v in r.headers.items() if k.lower() not in SKIPPED_HEADERS]
+        keep_body = 0
+        old_meta = archive.load_meta(params.method, ctx.record_url)
+        if r.status == 206 and old_meta is not None and old_meta['status'] in (200, 206):
+            # never replace recorded response with a smaller part of it, continuation of recorded part extends it instead
+            first, last, total = parse_content_range(r.headers.get('Content-Range', ''))
+            old_first = old_meta['offset']
+            old_end = old_first + archive.body_size(params.method, ctx.record_url)
+            if old_meta['status'] == 206 and old_first <= first <= old_end < last + 1:
+                keep_body = first - old_first
+                headers = [(k, f'bytes {old_first:d}-{last:d}/{total:d}' if k.lower() == 'content-range' else v) for k, v in headers]
+            elif old_meta['status'] == 200 or first < 0 or last - first + 1 <= old_end - old_first:
+                Log.trace(f'[record] {params.method} {ctx.record_url}: {r.status:d}, skipped (more of it is recorded already)')
+                return
+        archive.store_meta(params.method, ctx.record_url, r.status, r.reason or '', headers, str(r.url), keep_body)
+        ctx.recording = True
+        Log.trace(f'[record] {params.method} {ctx.record_url}: {r.status:d}')
+
+    async def on_response_chunk_received(_: ClientSession, ctx: SimpleNamespace, params: TraceResponseChunkReceivedParams) -> None:
+        if getattr(ctx, 'recording', False):
+            archive.append_body(params.method, ctx.record_url, params.chunk)
+
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    return trace_config
+
+
+class ReplayStream:
+    """Response body stream, delivers data no faster than configured bandwidth"""
+    def __init__(self, body: bytes) -> None:
+        self._body = body
+        self._aborted = False
+        self.total_bytes = 0
+
+    def abort(self) -> None:
+        self._aborted = True
+
+    async def _take(self, size: int) -> bytes:
+        if self._aborted:
+            raise ClientPayloadError('Response payload is not completed: connection aborted')
+        chunk = self._body[self.total_bytes:self.total_bytes + size]
+        self.total_bytes += len(chunk)
+        if Config.replay_bandwidth and chunk:
+            await sleep(len(chunk) / (Config.replay_bandwidth * Mem.KB))
+        return chunk
+
+    async def read(self, n=-1) -> bytes:
+        return await self._take(len(self._body) - self.total_bytes if n < 0 else n)
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await self._take(n)
+            if not chunk:
+                break
+            yield chunk
+
+
+class ReplayResponse:
+    """Recorded response, mimics the parts of **ClientResponse** used by the app"""
+    def __init__(self, method: str, url: str, status: int, reason: str, headers: CIMultiDict, body: bytes, final_url: str) -> None:
+        self.method = method
+        self.url = URL(final_url)
+        self.status = status
+        self.reason = reason
+        self.headers = CIMultiDictProxy(headers)
+        self.content = ReplayStream(body)
+        self.connection = SimpleNamespace(transport=SimpleNamespace(abort=self.content.abort))
+        self.closed = False
+        self._request_info = RequestInfo(URL(url), method, CIMultiDictProxy(CIMultiDict()), URL(url))
+
+    @property
+    def content_length(self) -> Optional[int]:
+        length = self.headers.get('Content-Length', '')
+        return int(length) if length.isnumeric() else None
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get('Content-Type', 'application/octet-stream').split(';', 1)[0].strip()
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise ClientResponseError(self._request_info, (), status=self.status, message=self.reason, headers=self.headers)
+
+    async def read(self) -> bytes:
+        return await self.content.read()
+
+    def close(self) -> None:
+        self.closed = True
+
+    def release(self) -> None:
+        self.closed = True
+
+    async def __aenter__(self) -> ReplayResponse:
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+class ReplaySession:
+    """
+    Session-like replacement serving responses from archive instead of network. Honors 'Range', 'If-Range' and 'If-None-Match' headers,
+    applies configured latency and bandwidth. Requests missing from archive receive 404
+    """
+    def __init__(self, archive: ResponseArchive) -> None:
+        self.archive = archive
+        self.cookie_jar = CookieJar()
+        self.headers = CIMultiDict()  # type: CIMultiDict[str]
+        self.closed = False
+
+    async def __aenter__(self) -> ReplaySession:
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        self.closed = True
+
+    async def request(self, method: str, url: str, **kwargs) -> ReplayResponse:
+        req_headers = CIMultiDict(self.headers)
+        req_headers.update(kwargs.get('headers') or {})
+        if Config.replay_latency:
+            await sleep(Config.replay_latency / 1000)
+        recorded = self.archive.load(method, url)
+        if recorded is None:
+            Log.warn(f'[replay] {method} {url} was not recorded!')
+            return ReplayResponse(method, url, 404, 'Not Found', CIMultiDict({'Content-Type': 'text/html'}), NOT_RECORDED_BODY, url)
+        meta, body = recorded
+        headers = CIMultiDict(meta['headers'])
+        etag = headers.get('ETag')
+        if etag and req_headers.get('If-None-Match') == etag:
+            return ReplayResponse(method, url, 304, 'Not Modified', headers, b'', meta['final_url'])
+        status, offset = meta['status'], meta['offset']
+        range_header = req_headers.get('Range', '')
+        if_range = req_headers.get('If-Range')
+        if if_range is not None and if_range not in (etag, headers.get('Last-Modified')):
+            range_header = ''  # resource has changed, full one is sent
+        if range_header.startswith('bytes=') and status in (200, 206):
+            recorded_end = offset + len(body)
+            total = max(meta.get('total', 0), recorded_end)
+            first_s, last_s = range_header[len('bytes='):].split('-', 1)
+            first = int(first_s) if first_s else 0
+            last = min(int(last_s), total - 1) if last_s else total - 1
+            if first >= total:
+                headers['Content-Range'] = f'bytes */{total:d}'
+                headers['Content-Length'] = '0'
+                return ReplayResponse(method, url, 416, 'Range Not Satisfiable', headers, b'', meta['final_url'])
+            if first < offset:
+                Log.warn(f'[replay] {method} {url}: range \'{range_header}\' starts before recorded part ({offset:d})!')
+                first = offset
+            if last >= recorded_end:
+                Log.warn(f'[replay] {method} {url}: range \'{range_header}\' ends after recorded part ({recorded_end:d})!')
+                last = recorded_end - 1
+            if first > last:
+                return ReplayResponse(method, url, 404, 'Not Found', CIMultiDict({'Content-Type': 'text/html'}), NOT_RECORDED_BODY, url)
+            body = body[first - offset:last - offset + 1]
+            status = 206
+            headers['Content-Range'] = f'bytes {first:d}-{last:d}/{total:d}'
+        headers['Content-Length'] = str(len(body))
+        Log.trace(f'[replay] {method} {url}: {status:d}')
+        return ReplayResponse(method, url, status, meta['reason'], headers, body, meta['final_url'])
+
+#
+#
+#########################################
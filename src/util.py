@@ -6,6 +6,7 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 #
 #
 
+import os
 import sys
 from datetime import datetime
 
@@ -59,6 +60,21 @@ def calc_sleep_time(base_time: float) -> float:
     return base_time if Config.download_mode == DOWNLOAD_MODE_FULL else max(1.0, base_time / 3.0)
 
 
+def fallocate(fd: int, size: int) -> None:
+    """Reserves disk space for the first **size** bytes of file, does nothing if not supported by OS or file system"""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as err:
+            Log.trace(f'posix_fallocate failed: {str(err)}')
+
+
+def fadvise_dontneed(fd: int, offset: int, length: int) -> None:
+    """Tells OS cached file data in range is not going to be needed again, does nothing if not supported by OS"""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
 def at_startup() -> None:
     """Inits logger. Reports python version and run options"""
     Log.init()
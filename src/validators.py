@@ -6,12 +6,17 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 #
 #
 
+import os
 from argparse import ArgumentError
 from ipaddress import IPv4Address
 from os import path
+from typing import Dict, List, Tuple
 
 from config import Config
-from defs import NamingFlags, LoggingFlags, SLASH, NAMING_FLAGS, LOGGING_FLAGS, DOWNLOAD_POLICY_DEFAULT, DEFAULT_QUALITY, SEARCH_RULE_ALL
+from defs import (
+    NamingFlags, LoggingFlags, RequestClass, SLASH, NAMING_FLAGS, LOGGING_FLAGS, REQUEST_CLASSES, DOWNLOAD_POLICY_DEFAULT, DEFAULT_QUALITY,
+    SEARCH_RULE_ALL, UTF8, QUEUE_POLICY_DEFAULT,
+)
 from logger import Log
 from rex import re_non_search_symbols, re_session_id
 from util import normalize_path, has_naming_flag
@@ -28,6 +33,10 @@ def find_and_resolve_config_conflicts(full_download=True) -> bool:
         Log.fatal(f'\nError: invalid video id bounds: start ({Config.start_id:d}) > end ({Config.end_id:d})')
         raise ValueError
 
+    if Config.get_maxid and Config.page_sources:
+        Log.fatal('\nError: cannot get max id using multiple page sources! Please use one or the other')
+        raise ValueError
+
     if Config.get_maxid:
         Config.logging_flags = LoggingFlags.FATAL
         Config.start = Config.end = Config.start_id = Config.end_id = 1
@@ -38,12 +47,30 @@ def find_and_resolve_config_conflicts(full_download=True) -> bool:
         Config.search_arts = f'{SEARCH_RULE_ALL},{Config.search_arts}'
     if ',' in Config.search_cats and Config.search_rule_cat == SEARCH_RULE_ALL:
         Config.search_cats = f'{SEARCH_RULE_ALL},{Config.search_cats}'
+    for source in Config.page_sources or ():
+        if ',' in source.search_tags and Config.search_rule_tag == SEARCH_RULE_ALL:
+            source.search_tags = f'{SEARCH_RULE_ALL},{source.search_tags}'
+        if ',' in source.search_arts and Config.search_rule_art == SEARCH_RULE_ALL:
+            source.search_arts = f'{SEARCH_RULE_ALL},{source.search_arts}'
+        if ',' in source.search_cats and Config.search_rule_cat == SEARCH_RULE_ALL:
+            source.search_cats = f'{SEARCH_RULE_ALL},{source.search_cats}'
 
     delay_for_message = False
+    if Config.preallocate and not hasattr(os, 'posix_fallocate'):
+        Log.info('Info: file preallocation is not supported on this platform, files are only going to be resized in advance')
+        delay_for_message = True
+    if Config.drop_cache and not hasattr(os, 'posix_fadvise'):
+        Log.info('Info: page cache control is not supported on this platform. Disabled!')
+        Config.drop_cache = False
+        delay_for_message = True
     if Config.save_comments is True and Config.session_id is None:
         Log.info('Info: Comments cannot be accessed without `-session_id`, saving comments is impossible. Disabled!')
         Config.save_comments = False
         delay_for_message = True
+    if Config.queue_policy != QUEUE_POLICY_DEFAULT and not Config.size_probe:
+        Log.info(f'Info: queue policy \'{Config.queue_policy}\' requires file sizes, size probe is enabled')
+        Config.size_probe = True
+        delay_for_message = True
     if Config.scenario is not None:
         if Config.utp != DOWNLOAD_POLICY_DEFAULT:
             Log.info('Info: running download script, outer untagged policy will be ignored')
@@ -94,6 +121,15 @@ def valid_int(val: str) -> int:
         raise ArgumentError
 
 
+def positive_int(val: str) -> int:
+    try:
+        val = int(val)
+        assert val >= 0
+        return val
+    except Exception:
+        raise ArgumentError
+
+
 def positive_nonzero_int(val: str) -> int:
     try:
         val = int(val)
@@ -103,6 +139,15 @@ def positive_nonzero_int(val: str) -> int:
         raise ArgumentError
 
 
+def positive_nonzero_float(val: str) -> float:
+    try:
+        val = float(val)
+        assert val > 0.0
+        return val
+    except Exception:
+        raise ArgumentError
+
+
 def valid_rating(val: str) -> int:
     try:
         val = int(val)
@@ -130,6 +175,28 @@ def valid_filepath_abs(pathstr: str) -> str:
         raise ArgumentError
 
 
+def valid_filepath_new(pathstr: str) -> str:
+    """File which may not exist yet but can be created"""
+    try:
+        newpath = normalize_path(path.abspath(path.expanduser(pathstr.strip('\'"'))), False)
+        assert not path.isdir(newpath) and path.isdir(path.dirname(newpath))
+        return newpath
+    except Exception:
+        raise ArgumentError
+
+
+def valid_proxy_file(pathstr: str) -> List[str]:
+    try:
+        with open(valid_filepath_abs(path.abspath(pathstr)), 'rt', encoding=UTF8) as pfile:
+            lines = [line.strip() for line in pfile.readlines()]
+        proxies = [valid_proxy(line) for line in lines if line and not line.startswith('#')]
+        assert len(proxies) > 0
+        return proxies
+    except Exception:
+        Log.error(f'Invalid proxy file \'{pathstr}\'!')
+        raise ArgumentError
+
+
 def valid_search_string(search_str: str) -> str:
     try:
         assert len(search_str) == 0 or re_non_search_symbols.search(search_str) is None
@@ -189,6 +256,46 @@ def log_level(level: str) -> int:
         raise ArgumentError
 
 
+def valid_pacing(pacing: str) -> Dict[RequestClass, Tuple[float, int, int]]:
+    try:
+        pacing_dict = dict()  # type: Dict[RequestClass, Tuple[float, int, int]]
+        for class_pacing in pacing.split(','):
+            cname, rate, burst, limit = tuple(class_pacing.split(':'))
+            rclass, rate, burst, limit = REQUEST_CLASSES[cname], float(rate), int(burst), int(limit)
+            assert rclass not in pacing_dict and rate >= 0.0 and burst > 0 and limit >= 0
+            pacing_dict[rclass] = (rate, burst, limit)
+        return pacing_dict
+    except Exception:
+        raise ArgumentError
+
+
+def valid_socket_buffers(buffers: str) -> Tuple[int, int]:
+    try:
+        sizes = tuple(int(size) for size in buffers.split(':'))
+        assert len(sizes) in (1, 2) and all(size >= 0 for size in sizes)
+        return sizes[0], sizes[-1]
+    except Exception:
+        raise ArgumentError
+
+
+def valid_bandwidth_schedule(schedule: str) -> List[Tuple[int, int, int]]:
+    """'HH:MM-HH:MM=RATE,...' -> [(begin_minute, end_minute, rate), ...]"""
+    def day_minute(hhmm: str) -> int:
+        hh, mm = tuple(int(v) for v in hhmm.split(':'))
+        assert 0 <= hh <= 23 and 0 <= mm <= 59
+        return hh * 60 + mm
+    try:
+        intervals = list()  # type: List[Tuple[int, int, int]]
+        for interval in schedule.split(','):
+            times, rate = tuple(interval.split('='))
+            begin, end = tuple(times.split('-'))
+            intervals.append((day_minute(begin), day_minute(end), int(rate)))
+            assert intervals[-1][0] != intervals[-1][1] and intervals[-1][2] >= 0
+        return intervals
+    except Exception:
+        raise ArgumentError
+
+
 def valid_session_id(sessionid: str) -> str:
     try:
         assert (not sessionid) or re_session_id.fullmatch(sessionid)
@@ -0,0 +1,89 @@
+# coding=UTF-8
+"""
+Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
+"""
+#########################################
+#
+#
+
+import sys
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from os import path, walk, cpu_count
+from typing import Dict, List, Sequence, Tuple
+
+from cmdargs import HelpPrintExitException, prepare_arglist_verify
+from config import Config
+from logger import Log
+from manifest import HashManifest, hash_file
+from util import at_startup, normalize_path
+
+__all__ = ('main_sync',)
+
+
+def collect_entries(base_folder: str) -> List[Tuple[str, str]]:
+    """Returns (fullpath, digest) for each file listed in manifests of **base_folder** and its subfolders"""
+    entries = list()  # type: List[Tuple[str, str]]
+    for dirpath, _, _ in walk(base_folder):
+        folder = normalize_path(dirpath)
+        entries.extend((f'{folder}{filename}', digest) for filename, digest in HashManifest.load(folder).items())
+    return entries
+
+
+def verify(base_folder: str, workers: int) -> bool:
+    """Re-hashes files listed in manifests using **workers** processes, returns True if all of them are intact"""
+    entries = collect_entries(base_folder)
+    if not entries:
+        Log.fatal(f'\nNo hashed files found in \'{base_folder}\'. Aborted.')
+        return False
+    Log.info(f'Verifying {len(entries):d} file(s) using {workers:d} process(es)...')
+    missing = [filepath for filepath, _ in entries if not path.isfile(filepath)]
+    mismatched = list()  # type: List[str]
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(hash_file, filepath): (filepath, digest)
+                   for filepath, digest in entries if path.isfile(filepath)}  # type: Dict[Future[str], Tuple[str, str]]
+        for future in as_completed(futures):
+            filepath, digest = futures[future]
+            try:
+                if future.result() != digest:
+                    Log.error(f'Hash mismatch: \'{filepath}\'!')
+                    mismatched.append(filepath)
+                else:
+                    Log.trace(f'OK: \'{filepath}\'')
+            except Exception as e:
+                Log.error(f'Unable to hash \'{filepath}\': {str(e)}')
+                mismatched.append(filepath)
+    for filepath in missing:
+        Log.error(f'File is missing: \'{filepath}\'!')
+    Log.info(f'\nVerified {len(entries) - len(missing) - len(mismatched):d} / {len(entries):d} file(s).'
+             f' Mismatched: {len(mismatched):d}, missing: {len(missing):d}')
+    return not (missing or mismatched)
+
+
+def main(args: Sequence[str]) -> bool:
+    try:
+        arglist = prepare_arglist_verify(args)
+    except HelpPrintExitException:
+        return True
+
+    Config.dest_base = arglist.path
+    Config.logging_flags = arglist.log_level
+    return verify(arglist.path, arglist.workers or cpu_count() or 1)
+
+
+def main_sync(args: Sequence[str]) -> bool:
+    assert sys.version_info >= (3, 7), 'Minimum python version required is 3.7!'
+
+    try:
+        return main(args)
+    except (KeyboardInterrupt, SystemExit):
+        Log.warn('Warning: catched KeyboardInterrupt/SystemExit...')
+        return False
+
+
+if __name__ == '__main__':
+    at_startup()
+    exit(0 if main_sync(sys.argv[1:]) else 1)
+
+#
+#
+#########################################
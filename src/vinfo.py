@@ -8,10 +8,11 @@ Author: trickerer (https://github.com/trickerer, https://github.com/trickerer01)
 
 from __future__ import annotations
 from enum import IntEnum
-from typing import Dict, Iterable, Union, Tuple
+from typing import Dict, Iterable, Optional, Union, Tuple
 
 from config import Config
 from defs import PREFIX, UTF8, DEFAULT_QUALITY, DEFAULT_EXT
+from segments import SegmentMap
 from util import normalize_path, normalize_filename
 
 __all__ = ('VideoInfo', 'get_min_max_ids', 'export_video_info')
@@ -44,6 +45,7 @@ class VideoInfo:  # up to ~3 Kb (when all info is filled, asizeof)
         self.filename = m_filename or ''
         self.rating = m_rating or ''
         self.quality = Config.quality or DEFAULT_QUALITY  # type: str
+        self.requested_quality = ''  # type: str  # set if requested quality is not available and another one is selected
         self.tags = ''
         self.description = ''
         self.comments = ''
@@ -52,6 +54,7 @@ class VideoInfo:  # up to ~3 Kb (when all info is filled, asizeof)
         self.start_time = 0
         self.last_check_size = 0
         self.last_check_time = 0
+        self.segment_map = None  # type: Optional[SegmentMap]
 
         self._state = VideoInfo.State.NEW
         self._flags = VideoInfo.Flags.NONE